@@ -37,7 +37,7 @@ def get_packages(package):
 setup(
     name="sstarlette",
     version=get_version("sstarlette"),
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     license="BSD",
     description="Enhancing Starlette Application",
     long_description=get_long_description(),
@@ -53,7 +53,7 @@ setup(
         "pydantic[email]==1.2",
     ],
     extras_require={"sentry": ["sentry-sdk"],"sql":[
-        "databases==0.2.6",]},
+        "databases==0.2.6",],"http": ["httpx"],"providers": ["httpx", "cryptography"]},
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Environment :: Web Environment",
@@ -62,7 +62,6 @@ setup(
         "Operating System :: OS Independent",
         "Topic :: Internet :: WWW/HTTP",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
     ],
     zip_safe=False,
@@ -1,3 +1,12 @@
 from .models import build_abstract_user
 from .helpers import token_encoder_and_decoder
 from .service_layer import build_service_layer, CreateUserResult
+from .cache import PermissionCache
+from .projection import Principal, PrincipalProjection
+from .revocation import TokenRevocationList
+from .hashing import PasswordHasher
+from .notifications import NotificationDispatcher
+from .providers import ProviderVerifier
+from .bulk import BulkImporter, UserExporter
+from .search import UserSearch
+from .queries import UserQueries
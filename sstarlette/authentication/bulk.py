@@ -0,0 +1,259 @@
+import asyncio
+import csv
+import io
+import json
+import typing
+
+from sstarlette.authentication import fields
+
+
+def is_integrity_error(error: Exception) -> bool:
+    # asyncpg, sqlite3 and pymysql share no base class for constraint errors
+    return any(
+        x.__name__ in ("IntegrityError", "IntegrityConstraintViolationError")
+        for x in type(error).__mro__
+    )
+
+
+async def to_ndjson(items: typing.AsyncIterable[dict]) -> typing.AsyncIterator[str]:
+    async for item in items:
+        yield json.dumps(item, default=str) + "\n"
+
+
+class BulkImporter:
+    """Creates users in batches, for migrating accounts from elsewhere.
+
+    Each batch is validated, checked for emails that are repeated in the
+    input or already taken, hashed through the user class's password hasher
+    and written with one COPY on PostgreSQL or executemany elsewhere, then
+    added to the principal projection. Emails are compared case-insensitively,
+    an index on lower(email) keeps the lookup of taken ones fast. `run()`
+    yields a progress entry per batch with the errors of its rows. Rows can
+    not set `protected_fields`, imported users get no roles.
+    """
+
+    # staff can import users, these would let them grant more than they have
+    protected_fields = (
+        "id",
+        "roles",
+        "additional_permissions",
+        "signup_info",
+        "is_active",
+    )
+
+    def __init__(
+        self, user_klass, database, table_name: str = "users", batch_size: int = 500
+    ):
+        self.user_klass = user_klass
+        self.database = database
+        self.table_name = table_name
+        self.batch_size = batch_size
+
+    @property
+    def is_postgres(self) -> bool:
+        return self.database.url.dialect == "postgresql"
+
+    async def fetch_by_email(self, columns: str, emails: typing.List[str]):
+        emails = [x.lower() for x in emails]
+        if self.is_postgres:
+            condition = "lower(email) = ANY(:emails)"
+            values = {"emails": emails}
+        else:
+            names = [f"email_{i}" for i in range(len(emails))]
+            condition = f"lower(email) IN ({', '.join(':' + x for x in names)})"
+            values = dict(zip(names, emails))
+        return await self.database.fetch_all(
+            query=f"SELECT {columns} FROM {self.table_name} WHERE {condition}",
+            values=values,
+        )
+
+    async def existing_emails(self, emails: typing.List[str]) -> typing.Set[str]:
+        """The lowercased emails that are already taken."""
+        if not emails:
+            return set()
+        records = await self.fetch_by_email("email", emails)
+        return {x["email"].lower() for x in records}
+
+    async def sync_principals(self, instances: typing.List[typing.Any]):
+        # these writes bypass save(), which keeps the projection in sync
+        get_projection = getattr(self.user_klass, "get_principal_projection", None)
+        projection = get_projection() if get_projection else None
+        if projection is None or not instances:
+            return
+        records = await self.fetch_by_email("id, email", [x.email for x in instances])
+        ids = {x["email"].lower(): x["id"] for x in records}
+        for instance in instances:
+            instance.id = ids[instance.email.lower()]
+        await projection.upsert_many(instances)
+
+    def prepare(self, row: dict, email_verified: bool):
+        row = dict(row)
+        protected = [x for x in row if x in self.protected_fields]
+        if protected:
+            return None, None, {x: ["value_error.not_allowed"] for x in protected}
+        errors = self.user_klass.validate_model(**row)
+        if errors:
+            return None, None, errors
+        password = row.pop("password", None)
+        instance = self.user_klass(**self.user_klass.with_defaults(row))
+        instance.signup_info = {"verified": email_verified}
+        return instance, password, None
+
+    async def _insert_each(self, rows, errors: dict) -> typing.List[typing.Any]:
+        # a row taken since the up front check fails the whole COPY
+        inserted = []
+        for index, instance in rows:
+            values = instance.dalchemy_insert_values()
+            try:
+                await self.database.execute(
+                    query=self.user_klass.dalchemy_insert_query(
+                        self.table_name, values
+                    ),
+                    values=values,
+                )
+            except Exception as e:
+                if not is_integrity_error(e):
+                    raise
+                errors[index] = {"email": ["value_error.duplicate"]}
+            else:
+                inserted.append(instance)
+        return inserted
+
+    async def load(
+        self, rows: typing.List[tuple], errors: dict
+    ) -> typing.List[typing.Any]:
+        """Writes the rows, returning the instances that were inserted."""
+        values = [instance.dalchemy_insert_values() for _, instance in rows]
+        columns = list(values[0])
+        try:
+            if self.is_postgres:
+                async with self.database.connection() as connection:
+                    await connection.raw_connection.copy_records_to_table(
+                        self.table_name,
+                        records=[tuple(x[c] for c in columns) for x in values],
+                        columns=columns,
+                    )
+            else:
+                # rolled back as a whole so the rows can be retried one by one
+                async with self.database.transaction():
+                    await self.database.execute_many(
+                        query=self.user_klass.dalchemy_insert_query(
+                            self.table_name, columns
+                        ),
+                        values=values,
+                    )
+        except Exception as e:
+            if not is_integrity_error(e):
+                raise
+            return await self._insert_each(rows, errors)
+        return [instance for _, instance in rows]
+
+    async def run(
+        self, rows: typing.List[dict], email_verified: bool = False
+    ) -> typing.AsyncIterator[dict]:
+        total = len(rows)
+        imported = 0
+        seen: typing.Set[str] = set()
+        for start in range(0, total, self.batch_size):
+            errors: typing.Dict[int, typing.Any] = {}
+            prepared = []
+            for index, row in enumerate(rows[start : start + self.batch_size], start):
+                if not isinstance(row, dict):
+                    errors[index] = {"row": ["type_error.dict"]}
+                    continue
+                instance, password, row_errors = self.prepare(row, email_verified)
+                if row_errors:
+                    errors[index] = row_errors
+                elif instance.email.lower() in seen:
+                    errors[index] = {"email": ["value_error.duplicate"]}
+                else:
+                    seen.add(instance.email.lower())
+                    prepared.append((index, instance, password))
+            taken = await self.existing_emails([x[1].email for x in prepared])
+            for index, instance, _ in prepared:
+                if instance.email.lower() in taken:
+                    errors[index] = {"email": ["value_error.duplicate"]}
+            prepared = [x for x in prepared if x[1].email.lower() not in taken]
+            await asyncio.gather(
+                *[instance.aset_password(x) for _, instance, x in prepared if x]
+            )
+            if prepared:
+                inserted = await self.load([x[:2] for x in prepared], errors)
+                await self.sync_principals(inserted)
+                imported += len(inserted)
+            yield {
+                "processed": min(start + self.batch_size, total),
+                "total": total,
+                "imported": imported,
+                "errors": [
+                    {"row": index, "errors": value}
+                    for index, value in sorted(errors.items())
+                ],
+            }
+
+
+class UserExporter:
+    """Streams the user table in chunks of `chunk_size` rows.
+
+    Rows are read through `database.iterate`, a server-side cursor on
+    PostgreSQL, so memory stays flat however large the table is; pass the
+    replica as `database` to keep exports off the primary. Columns can be
+    any of `dalchemy_table_config()` except the password.
+    """
+
+    formats = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+    def __init__(
+        self, user_klass, database, table_name: str = "users", chunk_size: int = 500
+    ):
+        self.user_klass = user_klass
+        self.database = database
+        self.table_name = table_name
+        self.chunk_size = chunk_size
+        self.columns = [
+            x for x in user_klass.dalchemy_table_config() if x != "password"
+        ]
+        self.json_columns = set(fields.json_fields(user_klass))
+
+    def invalid_columns(self, columns: typing.List[str]) -> typing.List[str]:
+        return [x for x in columns if x not in self.columns]
+
+    def _row(self, record, columns: typing.List[str]) -> dict:
+        row = {}
+        for column in columns:
+            value = record[column]
+            if column in self.json_columns and isinstance(value, str):
+                value = json.loads(value)
+            row[column] = value
+        return row
+
+    def _encode(self, rows: typing.List[dict], columns, format: str, header: bool):
+        if format == "ndjson":
+            return "".join(json.dumps(x, default=str) + "\n" for x in rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+        for row in rows:
+            writer.writerow(
+                [
+                    json.dumps(row[x]) if isinstance(row[x], (dict, list)) else row[x]
+                    for x in columns
+                ]
+            )
+        return buffer.getvalue()
+
+    async def run(
+        self, columns: typing.List[str] = None, format: str = "ndjson"
+    ) -> typing.AsyncIterator[str]:
+        columns = columns or self.columns
+        query = f"SELECT {', '.join(columns)} FROM {self.table_name} ORDER BY id"
+        rows = []
+        header = True
+        async for record in self.database.iterate(query=query):
+            rows.append(self._row(record, columns))
+            if len(rows) >= self.chunk_size:
+                yield self._encode(rows, columns, format, header)
+                rows, header = [], False
+        if rows or header:
+            yield self._encode(rows, columns, format, header)
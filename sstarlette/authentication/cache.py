@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import typing
+
+logger = logging.getLogger(__name__)
+
+PermissionLoader = typing.Callable[
+    [], typing.Awaitable[typing.Iterable[typing.Tuple[typing.Optional[str], str]]]
+]
+
+
+class PermissionCache:
+    """In-process copy of the role -> permission mapping.
+
+    `loader` returns `(role_name, permission_name)` pairs, with `None` as the
+    role for permissions not attached to any role. Every worker listens on a
+    Postgres channel and reloads when notified; other backends poll. A lost
+    listener connection is reopened every `reconnect_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        loader: PermissionLoader,
+        channel: str = "sstarlette_permissions",
+        poll_interval: float = 30,
+        reconnect_interval: float = 5,
+    ):
+        self.loader = loader
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.reconnect_interval = reconnect_interval
+        self.roles: typing.Dict[str, typing.FrozenSet[str]] = {}
+        self.permissions: typing.FrozenSet[str] = frozenset()
+        self.loaded = False
+        self._callbacks: typing.List[typing.Callable[..., typing.Awaitable]] = []
+        self._connection = None
+        self._poller: typing.Optional[asyncio.Future] = None
+        self._pending: typing.Optional[asyncio.Future] = None
+        self._dirty = False
+
+    def on_change(self, callback: typing.Callable[..., typing.Awaitable]):
+        """Register `callback(changed_roles)` to run after every reload."""
+        self._callbacks.append(callback)
+        return callback
+
+    def permission_names(
+        self, roles: typing.Iterable[str], additional_permissions=None
+    ) -> typing.List[str]:
+        names = set()
+        for role in roles or []:
+            names.update(self.roles.get(role, ()))
+        names.update(x for x in additional_permissions or [] if x in self.permissions)
+        return list(names)
+
+    async def load(self) -> typing.Set[str]:
+        roles: typing.Dict[str, set] = {}
+        permissions = set()
+        for role, permission in await self.loader():
+            permissions.add(permission)
+            if role:
+                roles.setdefault(role, set()).add(permission)
+        new_roles = {key: frozenset(value) for key, value in roles.items()}
+        changed = {
+            key
+            for key in set(new_roles) | set(self.roles)
+            if new_roles.get(key) != self.roles.get(key)
+        }
+        self.roles = new_roles
+        self.permissions = frozenset(permissions)
+        was_loaded, self.loaded = self.loaded, True
+        if was_loaded and changed:
+            for callback in self._callbacks:
+                await callback(changed)
+        return changed
+
+    async def reload(self):
+        try:
+            await self.load()
+        except Exception:
+            # keep serving the previous mapping rather than failing logins
+            logger.exception("Could not reload permission cache")
+
+    async def _reload_pending(self):
+        # a notification during a reload may come after its rows were read
+        while True:
+            self._dirty = False
+            await self.reload()
+            if not self._dirty:
+                return
+
+    def _on_notification(self, *args):
+        # notifications during a reload are folded into one more reload
+        if self._pending and not self._pending.done():
+            self._dirty = True
+            return
+        self._pending = asyncio.ensure_future(self._reload_pending())
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.reload()
+
+    async def _listen(self, database):
+        import asyncpg
+
+        self._connection = await asyncpg.connect(str(database.url))
+        await self._connection.add_listener(self.channel, self._on_notification)
+
+    async def _watch(self, database):
+        while True:
+            await asyncio.sleep(self.reconnect_interval)
+            if self._connection is not None and not self._connection.is_closed():
+                continue
+            try:
+                await self._listen(database)
+            except Exception:
+                logger.exception("Could not reconnect permission listener")
+                continue
+            # notifications sent while disconnected were lost
+            self._on_notification()
+
+    async def start(self, database=None):
+        if database is not None and database.url.dialect == "postgresql":
+            # listen before loading so changes made meanwhile are not missed
+            await self._listen(database)
+            self._poller = asyncio.ensure_future(self._watch(database))
+        elif self.poll_interval:
+            self._poller = asyncio.ensure_future(self._poll())
+        self._pending = asyncio.ensure_future(self.load())
+        await self._pending
+        if self._dirty:
+            self._on_notification()
+
+    async def stop(self):
+        for task in (self._poller, self._pending):
+            if task and not task.done():
+                task.cancel()
+        self._poller = None
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    async def invalidate(self, database=None):
+        """Signal every worker that roles or permissions changed."""
+        if database is not None and database.url.dialect == "postgresql":
+            await database.execute(
+                query="SELECT pg_notify(:channel, '')", values={"channel": self.channel}
+            )
+        else:
+            await self.reload()
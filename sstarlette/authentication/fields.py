@@ -1,4 +1,6 @@
+import json
 import typing
+import weakref
 from pydantic import BaseModel
 from pydantic.dataclasses import dataclass
 
@@ -31,3 +33,64 @@ JSON_TYPE = typing.Union[dict, list, tuple, set]
 def JSON():
     return JSON_TYPE
 
+
+# model classes are built per settings, so they must not be kept alive here
+_field_kinds = weakref.WeakKeyDictionary()
+
+
+def field_kinds(klass) -> typing.Dict[str, typing.Optional[str]]:
+    """"json", "related" or None for each field, worked out once per class."""
+    kinds = _field_kinds.get(klass)
+    if kinds is None:
+        kinds = {}
+        for name, field in klass.__fields__.items():
+            if is_json_field(field.outer_type_):
+                kinds[name] = "json"
+            elif is_related_field(field.outer_type_):
+                kinds[name] = "related"
+            else:
+                kinds[name] = None
+        _field_kinds[klass] = kinds
+    return kinds
+
+
+def json_fields(klass) -> typing.List[str]:
+    return [name for name, kind in field_kinds(klass).items() if kind == "json"]
+
+
+class LazyJSON:
+    """Keeps the JSON text a field was loaded with until it is first read.
+
+    A JSON field never validates to a string, so a string stored for it is
+    text still to be decoded.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        try:
+            value = instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+        if isinstance(value, str):
+            value = json.loads(value)
+            instance.__dict__[self.name] = value
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+def make_json_lazy(klass):
+    for name in json_fields(klass):
+        setattr(klass, name, LazyJSON(name))
+    return klass
+
+
+def lazy_json_fields(klass) -> typing.List[str]:
+    return [
+        x for x in json_fields(klass) if isinstance(getattr(klass, x, None), LazyJSON)
+    ]
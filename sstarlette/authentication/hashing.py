@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import json
+import math
+import time
+import typing
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256", "pbkdf2_sha1", "argon2", "bcrypt_sha256"],
+    deprecated="auto",
+)
+
+
+# module level so they can be pickled into worker processes
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    return pwd_context.verify(password, hashed)
+
+
+def verify_and_update_password(
+    password: str, hashed: str
+) -> typing.Tuple[bool, typing.Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+def configure_rounds(rounds: typing.Optional[typing.Dict[str, int]]):
+    """Pin the cost of each scheme; hashes with any other cost need updating."""
+    if not rounds:
+        return
+    options = {}
+    for scheme, value in rounds.items():
+        options[f"{scheme}__default_rounds"] = value
+        options[f"{scheme}__min_rounds"] = value
+        options[f"{scheme}__max_rounds"] = value
+    pwd_context.update(**options)
+
+
+# bcrypt's cost is a power of two, the others grow linearly with rounds
+LOG_ROUNDS = {"bcrypt_sha256"}
+
+
+def _time_hash(handler, rounds: int, password: str) -> float:
+    start = time.perf_counter()
+    handler.using(rounds=rounds).hash(password)
+    return time.perf_counter() - start
+
+
+def calibrate(
+    target_ms: float = 50,
+    schemes: typing.Iterable[str] = None,
+    password: str = "calibration password",
+) -> typing.Dict[str, int]:
+    """Find the cost per scheme that takes about `target_ms` on this machine."""
+    result = {}
+    target = target_ms / 1000
+    for scheme in schemes or pwd_context.schemes():
+        handler = pwd_context.handler(scheme)
+        if hasattr(handler, "has_backend") and not handler.has_backend():
+            continue
+        rounds = handler.default_rounds
+        for _ in range(3):
+            elapsed = max(_time_hash(handler, rounds, password), 1e-6)
+            if scheme in LOG_ROUNDS:
+                rounds = rounds + int(round(math.log2(target / elapsed)))
+            else:
+                rounds = int(rounds * target / elapsed)
+            rounds = min(max(rounds, handler.min_rounds), handler.max_rounds)
+        result[scheme] = rounds
+    return result
+
+
+class PasswordHasher:
+    """Runs password hashing off the event loop.
+
+    Work goes to the loop's default thread pool unless `max_workers` asks for
+    a process pool of that many processes, which `shutdown()` stops again.
+    `max_concurrency` bounds how many hashes one application worker hands to
+    the pool at a time.
+    """
+
+    def __init__(
+        self,
+        max_workers: typing.Optional[int] = None,
+        max_concurrency: typing.Optional[int] = None,
+        executor: Executor = None,
+        rounds: typing.Optional[typing.Dict[str, int]] = None,
+    ):
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.rounds = rounds
+        configure_rounds(rounds)
+        self._executor = executor
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_settings(cls, settings) -> "PasswordHasher":
+        rounds = getattr(settings, "PASSWORD_HASH_ROUNDS", None)
+        if isinstance(rounds, str):
+            rounds = json.loads(rounds)
+        return cls(
+            max_workers=int(getattr(settings, "PASSWORD_HASH_WORKERS", 0) or 0),
+            max_concurrency=getattr(settings, "PASSWORD_HASH_CONCURRENCY", None),
+            rounds=rounds,
+        )
+
+    @property
+    def executor(self) -> typing.Optional[Executor]:
+        if self._executor is None and self.max_workers:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=configure_rounds,
+                initargs=(self.rounds,),
+            )
+        return self._executor
+
+    async def _run(self, func: typing.Callable, *args):
+        loop = asyncio.get_event_loop()
+        if not self.max_concurrency:
+            return await loop.run_in_executor(self.executor, func, *args)
+        # created lazily so it binds to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+
+    async def verify_and_update(
+        self, password: str, hashed: str
+    ) -> typing.Tuple[bool, typing.Optional[str]]:
+        return await self._run(verify_and_update_password, password, hashed)
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calibrate password hashing cost for this machine"
+    )
+    parser.add_argument("--target-ms", type=float, default=50)
+    parser.add_argument("--scheme", action="append", dest="schemes")
+    args = parser.parse_args()
+    print("PASSWORD_HASH_ROUNDS=" + json.dumps(calibrate(args.target_ms, args.schemes)))
@@ -1,3 +1,4 @@
+import uuid
 from datetime import datetime, timedelta
 import jwt
 
@@ -18,6 +19,7 @@ def create_app_access_token(
     audience=None,
 ):
     to_encode = data.copy()
+    to_encode.setdefault("jti", uuid.uuid4().hex)
     if expire:
         to_encode.update({"exp": expire})
     to_encode.update({"iss": issuer, "sub": access_token_jwt_subject, "iat": timestamp})
@@ -55,3 +57,17 @@ def token_encoder_and_decoder(settings):
 
     return create_access_token, decode_access_token
 
+
+def validate_access_token(token, permissions, decode_access_token) -> bool:
+    decoded_token = jwt.decode(token, verify=False)
+    kwargs = {}
+    if "aud" in decoded_token:
+        kwargs["audience"] = permissions[0]
+    if "exp" in decoded_token:
+        kwargs["verify_exp"] = True
+    try:
+        decode_access_token(token, **kwargs)
+    except (jwt.exceptions.InvalidAudienceError, jwt.exceptions.ExpiredSignatureError):
+        return False
+    else:
+        return True
@@ -0,0 +1,119 @@
+import typing
+
+SEARCH_KINDS = ("trigram", "prefix")
+
+USER_SEARCH_INDEXES = {
+    "full_name": {"search": "trigram"},
+    "email": {"search": ["trigram", "prefix"]},
+}
+
+SIGNUP_INFO_INDEXES = {
+    "signup_info": {
+        "json_indexes": {"provider": "text", "department": "text"},
+        "gin": True,
+    }
+}
+
+
+def search_columns(config: dict) -> typing.Dict[str, typing.List[str]]:
+    """Columns declared with a "search" option in `dalchemy_index_config`."""
+    result = {}
+    for column, options in config.items():
+        kinds = options.get("search")
+        if not kinds:
+            continue
+        kinds = [kinds] if isinstance(kinds, str) else list(kinds)
+        for kind in kinds:
+            if kind not in SEARCH_KINDS:
+                raise ValueError(f"Unknown search index {kind} on {column}")
+        result[column] = kinds
+    return result
+
+
+def search_index_statements(table_name: str, config: dict) -> typing.List[str]:
+    columns = search_columns(config)
+    statements = []
+    if any("trigram" in x for x in columns.values()):
+        statements.append("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for column, kinds in columns.items():
+        # built concurrently so adding them does not lock a large table
+        if "trigram" in kinds:
+            statements.append(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table_name}_{column}_trgm_idx "
+                f"ON {table_name} USING gin (lower({column}) gin_trgm_ops)"
+            )
+        if "prefix" in kinds:
+            statements.append(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table_name}_{column}_prefix_idx "
+                f"ON {table_name} (lower({column}) text_pattern_ops)"
+            )
+    return statements
+
+
+# casts applied to `column->>'attribute'`, which is always text
+JSON_INDEX_TYPES = {
+    "text": "",
+    "boolean": "::boolean",
+    "integer": "::integer",
+    "numeric": "::numeric",
+}
+
+
+def json_index_columns(config: dict) -> typing.Dict[str, dict]:
+    """Columns declared with "json_indexes" and/or "gin" options.
+
+    `{"json_indexes": {"provider": "text"}, "gin": True}` indexes the
+    `provider` attribute as an expression and the whole document with a
+    jsonb_path_ops GIN index for `@>` containment queries.
+    """
+    result = {}
+    for column, options in config.items():
+        attributes = options.get("json_indexes") or {}
+        for attribute, kind in attributes.items():
+            if kind not in JSON_INDEX_TYPES:
+                raise ValueError(f"Unknown json index type {kind} on {column}")
+        if attributes or options.get("gin"):
+            result[column] = {
+                "attributes": dict(attributes),
+                "gin": bool(options.get("gin")),
+            }
+    return result
+
+
+def json_attribute(column: str, attribute: str, kind: str = "text") -> str:
+    # queries must repeat this exact expression to be served by the index
+    return f"({column}->>'{attribute}'){JSON_INDEX_TYPES[kind]}"
+
+
+def jsonb_document(column: str) -> str:
+    # jsonb_path_ops and @> only exist for jsonb, the column may be json
+    return f"({column}::jsonb)"
+
+
+def json_index_statements(table_name: str, config: dict) -> typing.List[str]:
+    statements = []
+    for column, options in json_index_columns(config).items():
+        for attribute, kind in options["attributes"].items():
+            statements.append(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                f"{table_name}_{column}_{attribute}_idx "
+                f"ON {table_name} (({json_attribute(column, attribute, kind)}))"
+            )
+        if options["gin"]:
+            statements.append(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table_name}_{column}_gin_idx "
+                f"ON {table_name} USING gin ({jsonb_document(column)} jsonb_path_ops)"
+            )
+    return statements
+
+
+def index_statements(table_name: str, config: dict) -> typing.List[str]:
+    return search_index_statements(table_name, config) + json_index_statements(
+        table_name, config
+    )
+
+
+async def create_indexes(database, statements: typing.List[str]):
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction
+    for statement in statements:
+        await database.execute(query=statement)
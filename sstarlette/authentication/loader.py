@@ -0,0 +1,103 @@
+import asyncio
+import contextvars
+import copy
+import typing
+
+from sstarlette.context import request_cache
+from sstarlette.unit_of_work import current_unit_of_work
+
+
+class UserLoader:
+    """Loads users by email the way a DataLoader does.
+
+    Lookups for the same email that overlap share one query, distinct emails
+    requested in the same loop tick are fetched together through
+    `_util_klass.get_users(emails)` when the util class has it, and a user
+    is only loaded once per request. When a lookup was shared every caller
+    but the last gets its own copy, so changes made by one handler stay
+    with it. Inside a unit of work users are read on its transaction
+    connection instead, without batching, so its earlier writes are seen.
+    """
+
+    def __init__(self, util_klass, max_batch: int = 100):
+        self.util_klass = util_klass
+        self.max_batch = max_batch
+        self._in_flight: typing.Dict[str, asyncio.Future] = {}
+        self._pending: typing.List[str] = []
+        self._callers: typing.Dict[asyncio.Future, int] = {}
+
+    async def load(self, email: str):
+        cache = request_cache()
+        key = ("user", email)
+        if cache is not None and key in cache:
+            return cache[key]
+        unit_of_work = current_unit_of_work()
+        if unit_of_work is None:
+            user = await self._load_shared(email)
+        else:
+            # on the unit of work's transaction connection, which sees its
+            # uncommitted writes and is not shared with other callers
+            user = await self.util_klass.get_user(email=email)
+            if user is not None:
+                unit_of_work.track(user)
+        if cache is not None:
+            cache[key] = user
+        return user
+
+    async def _load_shared(self, email: str):
+        future = self._in_flight.get(email)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = self._in_flight[email] = loop.create_future()
+            if not self._pending:
+                # not the first caller's context, the batch is not its own
+                loop.call_soon(self._dispatch, context=contextvars.Context())
+            self._pending.append(email)
+        self._callers[future] = self._callers.get(future, 0) + 1
+        try:
+            user = await asyncio.shield(future)
+        finally:
+            self._callers[future] -= 1
+            shared = self._callers[future] > 0
+            if not shared:
+                del self._callers[future]
+        if user is not None and shared:
+            # nested values like signup_info must not be shared either.
+            # deepcopy goes through __getstate__, unlike pydantic's copy()
+            # it leaves JSON fields that were not read yet undecoded
+            user = copy.deepcopy(user)
+        return user
+
+    def forget(self, email: str):
+        cache = request_cache()
+        if cache is not None:
+            cache.pop(("user", email), None)
+
+    def _dispatch(self):
+        emails, self._pending = self._pending, []
+        for i in range(0, len(emails), self.max_batch):
+            asyncio.ensure_future(self._load_batch(emails[i : i + self.max_batch]))
+
+    async def _fetch(self, emails: typing.List[str]) -> typing.List[typing.Any]:
+        get_users = getattr(self.util_klass, "get_users", None)
+        if get_users and len(emails) > 1:
+            by_email = {user.email: user for user in await get_users(emails)}
+            return [by_email.get(email) for email in emails]
+        return await asyncio.gather(
+            *[self.util_klass.get_user(email=email) for email in emails],
+            return_exceptions=True,
+        )
+
+    async def _load_batch(self, emails: typing.List[str]):
+        try:
+            results = await self._fetch(emails)
+        except Exception as e:
+            results = [e] * len(emails)
+        for email, result in zip(emails, results):
+            future = self._in_flight.pop(email)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
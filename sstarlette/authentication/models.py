@@ -1,24 +1,26 @@
 import asyncio
+import copy
 import datetime
 
 import enum
+import functools
+import json
 import typing
 import jwt
 import asyncpg
 from sstarlette.authentication import fields
-from passlib.context import CryptContext
 from pydantic import EmailStr, SecretStr, validator
 from pydantic import BaseModel
+from pydantic.main import validate_model
 from starlette.authentication import BaseUser
-from .helpers import current_time, token_encoder_and_decoder
+from sstarlette.unit_of_work import current_unit_of_work
+from .hashing import PasswordHasher, pwd_context
+from .helpers import current_time, token_encoder_and_decoder, validate_access_token
 
-pwd_context = CryptContext(
-    schemes=["pbkdf2_sha256", "pbkdf2_sha1", "argon2", "bcrypt_sha256"],
-    deprecated="auto",
-)
 
+def build_abstract_user(settings, permission_cache=None, principal_projection=None):
+    password_hasher = PasswordHasher.from_settings(settings)
 
-def build_abstract_user(settings):
     class AbstractUser(BaseModel, BaseUser):
         full_name: str
         email: EmailStr
@@ -29,8 +31,13 @@ def build_abstract_user(settings):
         signup_info: typing.Optional[fields.JSON()] = {}
         roles: typing.Optional[fields.JSON()] = []
         additional_permissions: typing.Optional[fields.JSON()] = []
+        # where save_fields() writes, the service layer sets them from the
+        # util's database and table_name when those are configured
+        dalchemy_database: typing.ClassVar[typing.Any] = None
+        dalchemy_table: typing.ClassVar[typing.Optional[str]] = None
 
-        @validator("signup_info", pre=True, always=True)
+        # the factory builds a class per call, each with this validator
+        @validator("signup_info", pre=True, always=True, allow_reuse=True)
         def set_default_signup_info(cls, v):
             return v or {}
 
@@ -43,6 +50,32 @@ def build_abstract_user(settings):
                 value = value.get_secret_value()
             return pwd_context.verify(password, value)
 
+        async def aset_password(self, password: str):
+            self.password = await password_hasher.hash(password)
+
+        async def acheck_password(self, password: str):
+            value = self.password
+            if isinstance(value, SecretStr):
+                value = value.get_secret_value()
+            return await password_hasher.verify(password, value)
+
+        async def acheck_password_and_update(
+            self, password: str
+        ) -> typing.Tuple[bool, typing.Optional[str]]:
+            """Verify and return a new hash when the stored one is outdated."""
+            value = self.password
+            if isinstance(value, SecretStr):
+                value = value.get_secret_value()
+            return await password_hasher.verify_and_update(password, value)
+
+        @classmethod
+        def get_password_hasher(cls) -> PasswordHasher:
+            return password_hasher
+
+        @classmethod
+        def get_principal_projection(cls):
+            return principal_projection
+
         # auth properties
 
         @property
@@ -69,22 +102,8 @@ def build_abstract_user(settings):
                 return False
 
         async def validate_token(self, token):
-            decoded_token = jwt.decode(token, verify=False)
             permissions = await self.permission_names()
-            kwargs = {}
-            if "aud" in decoded_token:
-                kwargs["audience"] = permissions[0]
-            if "exp" in decoded_token:
-                kwargs["verify_exp"] = True
-            try:
-                decoded_token = self.decode_access_token(token, **kwargs)
-            except (
-                jwt.exceptions.InvalidAudienceError,
-                jwt.exceptions.ExpiredSignatureError,
-            ):
-                return False
-            else:
-                return True
+            return validate_access_token(token, permissions, self.decode_access_token)
 
         @property
         def is_staff(self):
@@ -104,9 +123,38 @@ def build_abstract_user(settings):
         def email_verified(self):
             return self.verified
 
+        async def save_changes(self):
+            # deferred to the commit inside a route's unit of work
+            unit_of_work = current_unit_of_work()
+            if unit_of_work is None:
+                await self.save()
+            else:
+                unit_of_work.save_later(self)
+
         async def verify_user(self):
             self.signup_info["verified"] = True
-            await self.save()
+            await self.save_changes()
+
+        async def sync_principal(self):
+            # save() calls this, writes that bypass it must call it themselves
+            if principal_projection is not None:
+                await principal_projection.upsert(self)
+
+        def __init_subclass__(cls, **kwargs):
+            # save() comes from the model class the user is mixed into
+            super().__init_subclass__(**kwargs)
+            save = getattr(cls, "save", None)
+            if save is None or getattr(save, "syncs_principal", False):
+                return
+
+            @functools.wraps(save)
+            async def save_and_sync(self, *args, **kwargs):
+                result = await save(self, *args, **kwargs)
+                await self.sync_principal()
+                return result
+
+            save_and_sync.syncs_principal = True
+            cls.save = save_and_sync
 
         async def get_permissions(self):
             raise NotImplementedError()  # pragma: no cover
@@ -115,6 +163,10 @@ def build_abstract_user(settings):
             raise NotImplementedError()  # pragma: no cover
 
         async def permission_names(self):
+            if permission_cache is not None and permission_cache.loaded:
+                return permission_cache.permission_names(
+                    self.roles, self.additional_permissions
+                )
             permissions = await self.get_permissions()
             audience = list({x.name for x in permissions})
             return audience
@@ -131,12 +183,15 @@ def build_abstract_user(settings):
             expires=None,
             with_permissions: bool = True,
             additional_info: dict = None,
+            permissions: typing.List[str] = None,
         ):
 
             info = await self.get_fields_to_generate_access_token()
             audience = None
             if with_permissions:
-                audience = await self.permission_names()
+                if permissions is None:
+                    permissions = await self.permission_names()
+                audience = list(permissions)
             if additional_info:
                 info.update(additional_info)
             create_access_token, _ = token_encoder_and_decoder(settings)
@@ -147,6 +202,57 @@ def build_abstract_user(settings):
         async def create_user_token(self, **kwargs):
             return await self.generate_access_token(with_permissions=False, **kwargs)
 
+        @classmethod
+        def from_db_row(cls, row) -> "AbstractUser":
+            """Builds a user from a row of the users table without validating it.
+
+            Rows were validated when they were written, so only the work
+            validation would do to their types is repeated. User input must
+            still go through the constructor; call `ensure_valid()` on a row
+            that may have been changed outside of this model.
+            """
+            row = dict(row)
+            kinds = fields.field_kinds(cls)
+            lazy = fields.lazy_json_fields(cls)
+            values = {}
+            for name, field in cls.__fields__.items():
+                if name not in row:
+                    if not field.required:
+                        values[name] = copy.deepcopy(field.default)
+                    continue
+                value = row[name]
+                # JSONB comes back from asyncpg as text, lazy fields keep it
+                eager = kinds[name] == "json" and name not in lazy
+                if eager and isinstance(value, str):
+                    value = json.loads(value)
+                values[name] = value
+            values["signup_info"] = values.get("signup_info") or {}
+            if isinstance(values.get("password"), str):
+                values["password"] = SecretStr(values["password"])
+            instance = cls.__new__(cls)
+            object.__setattr__(instance, "__dict__", values)
+            object.__setattr__(instance, "__fields_set__", set(row) & set(values))
+            return instance
+
+        def materialize(self) -> "AbstractUser":
+            """Decodes the JSON fields that have not been read yet."""
+            for name in fields.lazy_json_fields(self.__class__):
+                getattr(self, name)
+            return self
+
+        def _iter(self, *args, **kwargs):
+            # dict(), json() and copy() read __dict__ directly
+            self.materialize()
+            yield from super()._iter(*args, **kwargs)
+
+        def ensure_valid(self) -> "AbstractUser":
+            self.materialize()
+            values, _, error = validate_model(self.__class__, self.__dict__)
+            if error:
+                raise error
+            object.__setattr__(self, "__dict__", values)
+            return self
+
         @classmethod
         def dalchemy_table_config(self, additional_fields: dict = None) -> dict:
             obj = {
@@ -164,6 +270,106 @@ def build_abstract_user(settings):
                 obj.update(additional_fields)
             return obj
 
+        @classmethod
+        def dalchemy_index_config(cls) -> dict:
+            """Indexes built outside of the table, see `indexes.py`.
+
+            None by default; override to opt in, e.g. returning
+            `indexes.USER_SEARCH_INDEXES` to enable `UserSearch` or
+            `indexes.SIGNUP_INFO_INDEXES` for `UserQueries`.
+            """
+            return {}
+
+        @classmethod
+        def dalchemy_insert_query(
+            cls,
+            table_name: str,
+            columns: typing.Iterable[str],
+            permissions_query: str = None,
+        ) -> str:
+            """INSERT ... RETURNING the new row in one statement.
+
+            `permissions_query` selects the permission names of the role bound
+            to `:role`; its result comes back as `permission_names`.
+            """
+            columns = list(columns)
+            insert = (
+                f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(':' + x for x in columns)}) RETURNING *"
+            )
+            if not permissions_query:
+                return insert
+            return (
+                f"WITH inserted AS ({insert}) SELECT inserted.*, "
+                f"ARRAY({permissions_query}) AS permission_names FROM inserted"
+            )
+
+        def dalchemy_insert_values(self) -> dict:
+            values = {}
+            for key, value in self.dict().items():
+                if key == "id" and value is None:
+                    continue
+                if isinstance(value, SecretStr):
+                    value = value.get_secret_value()
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value)
+                values[key] = value
+            return values
+
+        async def dalchemy_insert(
+            self, database, table_name: str, role: str = None, permissions_query=None
+        ) -> typing.Optional[typing.List[str]]:
+            """Inserts the row, returning the token's permissions when asked for.
+
+            None means they have to be looked up the usual way.
+            """
+            values = self.dalchemy_insert_values()
+            query = self.dalchemy_insert_query(
+                table_name, values, permissions_query if role else None
+            )
+            if role and permissions_query:
+                values["role"] = role
+            record = await database.fetch_one(query=query, values=values)
+            if "id" in self.__fields__:
+                self.id = record["id"]
+            if not role or not permissions_query:
+                return None
+            names = set(record["permission_names"])
+            if not self.additional_permissions:
+                return list(names)
+            if permission_cache is None or not permission_cache.loaded:
+                return None
+            # like PermissionCache, permissions that no longer exist are dropped
+            known = permission_cache.permissions
+            names.update(x for x in self.additional_permissions if x in known)
+            return list(names)
+
+        @classmethod
+        def dalchemy_update_query(cls, table_name: str, columns: typing.Iterable[str]):
+            assignments = ", ".join(f"{x} = :{x}" for x in columns)
+            return f"UPDATE {table_name} SET {assignments} WHERE id = :id"
+
+        async def dalchemy_update(self, database, table_name: str, fields):
+            """Writes only `fields` of the row, and `modified`."""
+            if "modified" in self.__fields__:
+                self.modified = datetime.datetime.now()
+                fields = set(fields) | {"modified"}
+            values = {
+                key: value
+                for key, value in self.dalchemy_insert_values().items()
+                if key in fields and key != "id"
+            }
+            query = self.dalchemy_update_query(table_name, values)
+            await database.execute(query=query, values={**values, "id": self.id})
+
+        async def save_fields(self, fields: typing.Iterable[str]):
+            # called by the unit of work at commit with the changed fields
+            database, table_name = self.dalchemy_database, self.dalchemy_table
+            if database is None or not table_name or getattr(self, "id", None) is None:
+                return await self.save()
+            await self.dalchemy_update(database, table_name, fields)
+            await self.sync_principal()
+
         @staticmethod
         async def dalchemy_create_unverified_user(
             cls,
@@ -171,6 +377,9 @@ def build_abstract_user(settings):
             provider="",
             role_task: asyncio.Future = None,
             additional_info: dict = None,
+            database=None,
+            table_name: str = None,
+            permissions_query: str = None,
             **kwargs,
         ):
             department = kwargs.pop("department", None)
@@ -181,8 +390,11 @@ def build_abstract_user(settings):
             if not errors:
                 password = kwargs.pop("password", None)
                 instance = cls(**cls.with_defaults(kwargs))
-                if password:
-                    instance.set_password(password)
+                # hash while the role lookup is still running
+                pending = [instance.aset_password(password)] if password else []
+                if task:
+                    pending.append(task)
+                results = await asyncio.gather(*pending)
                 instance.signup_info = {"verified": email_verified}
                 if provider:
                     instance.signup_info["provider"] = provider
@@ -192,19 +404,30 @@ def build_abstract_user(settings):
                         instance.signup_info["department"] = department
                 try:
                     with_permissions = False
+                    permissions = None
                     if task:
-                        role_values = await task
-                        instance.roles = [role_values.name]
+                        instance.roles = [results[-1].name]
                         with_permissions = True
-                    await instance.save()
+                    if database is not None and table_name:
+                        permissions = await instance.dalchemy_insert(
+                            database,
+                            table_name,
+                            role=instance.roles[0] if task else None,
+                            permissions_query=permissions_query,
+                        )
+                        await instance.sync_principal()
+                    else:
+                        await instance.save()
                     token = await instance.generate_access_token(
                         additional_info=additional_info,
                         with_permissions=with_permissions,
+                        permissions=permissions,
                     )
                 except asyncpg.exceptions.UniqueViolationError as e:
                     errors = {"email": ["value_error.duplicate"]}
                     instance = None
             return (errors, instance, token)
 
-    return AbstractUser
+    # rows from from_db_row decode their JSON columns on first access
+    return fields.make_json_lazy(AbstractUser)
 
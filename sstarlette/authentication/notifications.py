@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+def purpose_for(token: str = None, callback_url: str = None) -> str:
+    if token and callback_url:
+        return "login-link"
+    if callback_url:
+        return "forgot-password"
+    return "verify-email"
+
+
+def build_payload(email: str, purpose: str, **kwargs) -> dict:
+    return {"email": email, "purpose": purpose, **kwargs}
+
+
+class NotificationDispatcher:
+    """Batches `email_verification` calls into bulk notification requests.
+
+    Instances are called like the `email_verification` hook from
+    `build_utils()`. Calls are collected for `window` seconds, or until
+    `max_batch` are pending, and posted together to `url` as
+    `{"notifications": [...]}` over one keep-alive client. Each call returns
+    once its batch was accepted and raises when it was not, so retries see
+    the failure. A call for an (email, purpose) that is being sent, or was
+    sent less than `dedupe_interval` seconds ago, is dropped.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        window: float = 0.05,
+        dedupe_interval: float = 60,
+        max_batch: int = 100,
+        client=None,
+        timeout: float = 10,
+        payload_builder: typing.Callable[..., dict] = build_payload,
+    ):
+        self.url = url
+        self.window = window
+        self.dedupe_interval = dedupe_interval
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.payload_builder = payload_builder
+        self._client = client
+        self._pending: typing.List[typing.Tuple[tuple, dict, asyncio.Future]] = []
+        self._recent: typing.Dict[typing.Tuple[str, str], float] = {}
+        self._sending: typing.Set[typing.Tuple[str, str]] = set()
+        self._flush_handle: typing.Optional[asyncio.Handle] = None
+        self._flushes: typing.Set[asyncio.Future] = set()
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    def _is_duplicate(self, key: typing.Tuple[str, str]) -> bool:
+        now = time.monotonic()
+        if len(self._recent) > 10000:
+            self._recent = {
+                k: v for k, v in self._recent.items() if now - v < self.dedupe_interval
+            }
+        if key in self._sending:
+            return True
+        sent_at = self._recent.get(key)
+        return sent_at is not None and now - sent_at < self.dedupe_interval
+
+    async def __call__(
+        self, email: str, token: str = None, callback_url: str = None, **kwargs
+    ) -> bool:
+        purpose = kwargs.pop("purpose", None) or purpose_for(token, callback_url)
+        key = (email.strip().lower(), purpose)
+        if self._is_duplicate(key):
+            return False
+        if token:
+            kwargs["token"] = token
+        if callback_url:
+            kwargs["callback_url"] = callback_url
+        future = asyncio.get_event_loop().create_future()
+        self._sending.add(key)
+        self._pending.append(
+            (key, self.payload_builder(email, purpose, **kwargs), future)
+        )
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(self.window)
+        return await future
+
+    def _schedule_flush(self, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = asyncio.get_event_loop().call_later(
+            delay, self._start_flush
+        )
+
+    def _start_flush(self):
+        self._flush_handle = None
+        future = asyncio.ensure_future(self.flush())
+        self._flushes.add(future)
+        future.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+            try:
+                response = await self.client.post(
+                    self.url, json={"notifications": [x[1] for x in batch]}
+                )
+                response.raise_for_status()
+            except Exception as e:
+                logger.exception("Could not send %s notifications", len(batch))
+                for key, _, future in batch:
+                    self._sending.discard(key)
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                now = time.monotonic()
+                for key, _, future in batch:
+                    # only delivered notifications make repeats duplicates
+                    self._sending.discard(key)
+                    self._recent[key] = now
+                    if not future.done():
+                        future.set_result(True)
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        await self.flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
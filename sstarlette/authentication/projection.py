@@ -0,0 +1,328 @@
+import asyncio
+import importlib
+import json
+import sys
+import typing
+
+from starlette.authentication import BaseUser
+
+from .cache import PermissionCache
+from .helpers import validate_access_token
+
+
+def _json_value(value, default):
+    if value is None:
+        return default
+    if isinstance(value, (str, bytes)):
+        return json.loads(value)
+    return value
+
+
+class Principal(BaseUser):
+    """The authentication view of a user, read from the projection table."""
+
+    def __init__(
+        self,
+        *,
+        id: typing.Any,
+        email: str,
+        roles: typing.List[str],
+        permissions: typing.List[str],
+        is_active: bool,
+        verified: bool,
+        decode_access_token: typing.Callable = None,
+    ):
+        self.id = id
+        self.email = email
+        self.roles = roles
+        self.permissions = permissions
+        self.is_active = is_active
+        self.verified = verified
+        self.decode_access_token = decode_access_token
+
+    @classmethod
+    def from_record(cls, record, decode_access_token=None) -> "Principal":
+        return cls(
+            id=record["id"],
+            email=record["email"],
+            roles=_json_value(record["roles"], []),
+            permissions=_json_value(record["permissions"], []),
+            is_active=record["is_active"],
+            verified=record["verified"],
+            decode_access_token=decode_access_token,
+        )
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def display_name(self) -> str:
+        return self.email
+
+    @property
+    def email_verified(self):
+        return self.verified
+
+    @property
+    def is_staff(self):
+        if self.is_superuser:
+            return True
+        return "staff" in [x.lower() for x in self.roles]
+
+    @property
+    def is_superuser(self):
+        return "admin" in [x.lower() for x in self.roles]
+
+    async def permission_names(self):
+        return list(self.permissions)
+
+    async def validate_token(self, token):
+        return validate_access_token(token, self.permissions, self.decode_access_token)
+
+
+class PrincipalProjection:
+    """Denormalized copy of what authentication needs from a user.
+
+    One row per user holds roles, resolved permission names and the active and
+    verified flags, so a principal is a single indexed lookup by email or id.
+    Rows are refreshed on every `save()` of a user and, by one worker,
+    whenever the permission cache reports changed roles. Postgres only.
+    """
+
+    def __init__(
+        self,
+        database,
+        permission_cache: PermissionCache,
+        table_name: str = "auth_principals",
+        user_table: str = "users",
+    ):
+        self.database = database
+        self.permission_cache = permission_cache
+        self.table_name = table_name
+        self.user_table = user_table
+        permission_cache.on_change(self.refresh_roles)
+
+    def create_table_statements(self) -> typing.List[str]:
+        return [
+            f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                email VARCHAR(255) PRIMARY KEY,
+                id INTEGER NOT NULL,
+                roles JSONB NOT NULL DEFAULT '[]',
+                additional_permissions JSONB NOT NULL DEFAULT '[]',
+                permissions JSONB NOT NULL DEFAULT '[]',
+                is_active BOOLEAN NOT NULL DEFAULT TRUE,
+                verified BOOLEAN NOT NULL DEFAULT FALSE
+            )""",
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {self.table_name}_id_idx "
+            f"ON {self.table_name} (id)",
+            f"CREATE INDEX IF NOT EXISTS {self.table_name}_roles_idx "
+            f"ON {self.table_name} USING gin (roles)",
+        ]
+
+    async def create_table(self):
+        for statement in self.create_table_statements():
+            await self.database.execute(query=statement)
+
+    @property
+    def _upsert_query(self) -> str:
+        return f"""INSERT INTO {self.table_name}
+            (email, id, roles, additional_permissions, permissions, is_active, verified)
+            VALUES (:email, :id, CAST(:roles AS JSONB),
+                CAST(:additional_permissions AS JSONB), CAST(:permissions AS JSONB),
+                :is_active, :verified)
+            ON CONFLICT (email) DO UPDATE SET
+                id = EXCLUDED.id,
+                roles = EXCLUDED.roles,
+                additional_permissions = EXCLUDED.additional_permissions,
+                permissions = EXCLUDED.permissions,
+                is_active = EXCLUDED.is_active,
+                verified = EXCLUDED.verified"""
+
+    def _values(
+        self, *, id, email, roles, additional_permissions, is_active, verified
+    ) -> dict:
+        roles = roles or []
+        additional_permissions = additional_permissions or []
+        return {
+            "id": id,
+            "email": email,
+            "roles": json.dumps(roles),
+            "additional_permissions": json.dumps(additional_permissions),
+            "permissions": json.dumps(
+                sorted(
+                    self.permission_cache.permission_names(
+                        roles, additional_permissions
+                    )
+                )
+            ),
+            "is_active": bool(is_active),
+            "verified": bool(verified),
+        }
+
+    async def _ensure_permissions(self):
+        if not self.permission_cache.loaded:
+            await self.permission_cache.load()
+
+    async def upsert(self, user):
+        await self._ensure_permissions()
+        await self.database.execute(
+            query=self._upsert_query,
+            values=self._values(
+                id=user.id,
+                email=user.email,
+                roles=user.roles,
+                additional_permissions=user.additional_permissions,
+                is_active=user.is_active,
+                verified=user.verified,
+            ),
+        )
+
+    async def upsert_many(self, users: typing.List[typing.Any]):
+        if not users:
+            return
+        await self._ensure_permissions()
+        await self.database.execute_many(
+            query=self._upsert_query,
+            values=[
+                self._values(
+                    id=user.id,
+                    email=user.email,
+                    roles=user.roles,
+                    additional_permissions=user.additional_permissions,
+                    is_active=user.is_active,
+                    verified=user.verified,
+                )
+                for user in users
+            ],
+        )
+
+    async def delete(self, email: str):
+        await self.database.execute(
+            query=f"DELETE FROM {self.table_name} WHERE email = :email",
+            values={"email": email},
+        )
+
+    async def get(self, *, email: str = None, id=None, decode_access_token=None):
+        if email is not None:
+            query, values = "email = :email", {"email": email}
+        else:
+            query, values = "id = :id", {"id": id}
+        record = await self.database.fetch_one(
+            query=f"SELECT * FROM {self.table_name} WHERE {query}", values=values
+        )
+        if not record:
+            return None
+        return Principal.from_record(record, decode_access_token)
+
+    @property
+    def _refresh_query(self) -> str:
+        # the same union of role and known additional permissions, sorted,
+        # that _values() computes for a single user
+        return f"""UPDATE {self.table_name} AS principal
+            SET permissions = computed.permissions
+            FROM (
+                SELECT p.email, COALESCE(
+                    jsonb_agg(DISTINCT n.name ORDER BY n.name)
+                        FILTER (WHERE n.name IS NOT NULL),
+                    '[]'
+                ) AS permissions
+                FROM {self.table_name} AS p
+                LEFT JOIN LATERAL (
+                    SELECT jsonb_array_elements_text(
+                        CAST(:role_permissions AS JSONB) -> role.name
+                    ) AS name
+                    FROM jsonb_array_elements_text(p.roles) AS role(name)
+                    UNION
+                    SELECT extra.name
+                    FROM jsonb_array_elements_text(p.additional_permissions)
+                        AS extra(name)
+                    WHERE extra.name = ANY(:permissions)
+                ) AS n ON TRUE
+                WHERE p.roles ?| :roles
+                GROUP BY p.email
+            ) AS computed
+            WHERE principal.email = computed.email"""
+
+    async def refresh_roles(self, changed_roles: typing.Iterable[str]):
+        """Recompute the permissions of principals holding `changed_roles`.
+
+        Every worker reloads on a role change, but only the one that takes the
+        advisory lock writes; the rows are updated in a single statement.
+        """
+        async with self.database.transaction():
+            # a holder working from an older reload is notified again and
+            # refreshes once more after releasing the lock
+            locked = await self.database.fetch_val(
+                query="SELECT pg_try_advisory_xact_lock(hashtext(:name))",
+                values={"name": self.table_name},
+            )
+            if not locked:
+                return
+            await self.database.execute(
+                query=self._refresh_query,
+                values={
+                    "roles": list(changed_roles),
+                    "role_permissions": json.dumps(
+                        {
+                            role: sorted(permissions)
+                            for role, permissions in self.permission_cache.roles.items()
+                        }
+                    ),
+                    "permissions": sorted(self.permission_cache.permissions),
+                },
+            )
+
+    async def rebuild(self, batch_size: int = 1000) -> int:
+        """Backfill the projection from the user table."""
+        await self._ensure_permissions()
+        # pages by id, writes can not share the connection an iterate() holds
+        columns = "id, email, roles, additional_permissions, is_active, signup_info"
+        count = 0
+        where, values = "", {"limit": batch_size}
+        while True:
+            records = await self.database.fetch_all(
+                query=f"SELECT {columns} FROM {self.user_table} {where} "
+                "ORDER BY id LIMIT :limit",
+                values=values,
+            )
+            if not records:
+                return count
+            batch = []
+            for record in records:
+                signup_info = _json_value(record["signup_info"], {}) or {}
+                batch.append(
+                    self._values(
+                        id=record["id"],
+                        email=record["email"],
+                        roles=_json_value(record["roles"], []),
+                        additional_permissions=_json_value(
+                            record["additional_permissions"], []
+                        ),
+                        is_active=record["is_active"],
+                        verified=signup_info.get("verified"),
+                    )
+                )
+            await self.database.execute_many(query=self._upsert_query, values=batch)
+            count += len(batch)
+            where, values["after"] = "WHERE id > :after", records[-1]["id"]
+
+
+async def rebuild_projection(projection: PrincipalProjection) -> int:
+    connected = not projection.database.is_connected
+    if connected:
+        await projection.database.connect()
+    try:
+        await projection.create_table()
+        return await projection.rebuild()
+    finally:
+        if connected:
+            await projection.database.disconnect()
+
+
+if __name__ == "__main__":
+    # python -m sstarlette.authentication.projection package.module:projection
+    module_name, attribute = sys.argv[1].split(":")
+    projection = getattr(importlib.import_module(module_name), attribute)
+    count = asyncio.get_event_loop().run_until_complete(rebuild_projection(projection))
+    print(f"Rebuilt {count} principals in {projection.table_name}")
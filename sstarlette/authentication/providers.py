@@ -0,0 +1,218 @@
+import asyncio
+import collections
+import json
+import logging
+import re
+import time
+import typing
+
+import jwt
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+FACEBOOK_GRAPH_URL = "https://graph.facebook.com"
+
+MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class JWKSCache:
+    """Signing keys from a JWKS endpoint, kept fresh in the background.
+
+    Keys are cached for the `max-age` the endpoint sends in Cache-Control and
+    refetched `refresh_margin` seconds before they expire, so verification
+    only waits on the network for the first request or an unknown key id.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        get_client: typing.Callable,
+        default_max_age: float = 3600,
+        refresh_margin: float = 60,
+    ):
+        self.url = url
+        self.get_client = get_client
+        self.default_max_age = default_max_age
+        self.refresh_margin = refresh_margin
+        self.keys: typing.Dict[str, typing.Any] = {}
+        self.expires_at = 0.0
+        self._refreshing: typing.Optional[asyncio.Future] = None
+        self._refresh_handle: typing.Optional[asyncio.Handle] = None
+
+    async def _fetch(self):
+        response = await self.get_client().get(self.url)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json()["keys"]:
+            keys[jwk["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        match = MAX_AGE.search(response.headers.get("cache-control", ""))
+        max_age = int(match.group(1)) if match else self.default_max_age
+        self.keys = keys
+        self.expires_at = time.monotonic() + max_age
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+        self._refresh_handle = asyncio.get_event_loop().call_later(
+            max(1, max_age - self.refresh_margin), self._background_refresh
+        )
+
+    def refresh(self) -> asyncio.Future:
+        # concurrent callers share one request
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self._fetch())
+        return self._refreshing
+
+    def _background_refresh(self):
+        self._refresh_handle = None
+
+        def log_failure(future: asyncio.Future):
+            if not future.cancelled() and future.exception():
+                logger.warning("Could not refresh keys from %s", self.url)
+
+        self.refresh().add_done_callback(log_failure)
+
+    async def get_key(self, kid: str):
+        if kid not in self.keys or time.monotonic() >= self.expires_at:
+            await asyncio.shield(self.refresh())
+        return self.keys.get(kid)
+
+    def close(self):
+        if self._refresh_handle is not None:
+            self._refresh_handle.cancel()
+            self._refresh_handle = None
+        if self._refreshing is not None and not self._refreshing.done():
+            self._refreshing.cancel()
+
+
+class ProviderVerifier:
+    """A `provider_verification` hook for Google and Facebook logins.
+
+    Google ID tokens are checked locally against Google's cached signing keys.
+    Facebook tokens need the Graph API, called over one shared client. A token
+    that passed is remembered until it expires. Tokens are only accepted when
+    they were issued to one of `google_client_ids` or to `facebook_app_id`.
+    Providers other than these two go to `fallback`, which has the same
+    signature as the hook.
+    """
+
+    def __init__(
+        self,
+        google_client_ids: typing.Iterable[str] = (),
+        facebook_app_id: str = None,
+        facebook_app_secret: str = None,
+        fallback: typing.Callable[..., typing.Awaitable] = None,
+        client=None,
+        timeout: float = 10,
+        max_cached: int = 10000,
+    ):
+        self.google_client_ids = list(google_client_ids)
+        self.facebook_app_id = facebook_app_id
+        self.facebook_app_secret = facebook_app_secret
+        self.fallback = fallback
+        self.timeout = timeout
+        self.max_cached = max_cached
+        self._client = client
+        self.google_keys = JWKSCache(GOOGLE_CERTS_URL, lambda: self.client)
+        self._verified: typing.MutableMapping[
+            typing.Tuple[str, str], typing.Tuple[str, float]
+        ] = collections.OrderedDict()
+
+    @property
+    def client(self):
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        return self._client
+
+    def _cached_email(self, provider: str, token: str) -> typing.Optional[str]:
+        cached = self._verified.get((provider, token))
+        if not cached:
+            return None
+        email, expires = cached
+        if time.time() >= expires:
+            del self._verified[(provider, token)]
+            return None
+        return email
+
+    def _remember(self, provider: str, token: str, email: str, expires: float):
+        self._verified[(provider, token)] = (email, expires)
+        while len(self._verified) > self.max_cached:
+            self._verified.popitem(last=False)
+
+    async def verify_google(
+        self, token: str
+    ) -> typing.Tuple[typing.Optional[str], float]:
+        # a token issued to any other client would otherwise log in here
+        if not self.google_client_ids:
+            raise jwt.exceptions.InvalidAudienceError("No Google client ids set")
+        header = jwt.get_unverified_header(token)
+        key = await self.google_keys.get_key(header.get("kid"))
+        if key is None:
+            raise jwt.exceptions.InvalidTokenError("Unknown signing key")
+        claims = jwt.decode(
+            token, key, algorithms=["RS256"], audience=self.google_client_ids
+        )
+        if claims.get("iss") not in GOOGLE_ISSUERS:
+            raise jwt.exceptions.InvalidIssuerError("Invalid issuer")
+        if not claims.get("email_verified"):
+            return None, 0
+        return claims.get("email"), claims["exp"]
+
+    async def verify_facebook(
+        self, token: str
+    ) -> typing.Tuple[typing.Optional[str], float]:
+        if not self.facebook_app_id or not self.facebook_app_secret:
+            raise ValueError("No Facebook app configured")
+        app_token = f"{self.facebook_app_id}|{self.facebook_app_secret}"
+        debug, profile = await asyncio.gather(
+            self.client.get(
+                f"{FACEBOOK_GRAPH_URL}/debug_token",
+                params={"input_token": token, "access_token": app_token},
+            ),
+            self.client.get(
+                f"{FACEBOOK_GRAPH_URL}/me",
+                params={"fields": "email", "access_token": token},
+            ),
+        )
+        info = debug.json().get("data") or {}
+        if not info.get("is_valid") or str(info.get("app_id")) != str(
+            self.facebook_app_id
+        ):
+            return None, 0
+        # tokens without an expiry are only trusted for an hour
+        expires = info.get("expires_at") or time.time() + 3600
+        return profile.json().get("email"), expires
+
+    async def __call__(
+        self, signup_info: dict, bearer_token: str, data: dict
+    ) -> typing.Optional[typing.Dict[str, str]]:
+        provider = signup_info.get("provider") or ""
+        name = provider.lower()
+        if name not in ("google", "facebook"):
+            if self.fallback:
+                return await self.fallback(signup_info, bearer_token, data)
+            return None
+        email = self._cached_email(name, bearer_token)
+        if email is None:
+            try:
+                if name == "google":
+                    email, expires = await self.verify_google(bearer_token)
+                else:
+                    email, expires = await self.verify_facebook(bearer_token)
+            except Exception:
+                logger.info("Rejected %s token", name, exc_info=True)
+                return {provider: "Invalid token"}
+            if not email:
+                return {provider: "Invalid token"}
+            self._remember(name, bearer_token, email, expires)
+        if email.lower() != (data.get("email") or "").strip().lower():
+            return {provider: "Email does not match token"}
+        return None
+
+    async def close(self):
+        self.google_keys.close()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
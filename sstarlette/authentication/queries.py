@@ -0,0 +1,71 @@
+import json
+import typing
+
+from .indexes import json_attribute, json_index_columns, jsonb_document
+
+
+class UserQueries:
+    """Lookups on attributes of JSON columns, answered from their indexes.
+
+    Declared attributes are compared through the same expression their
+    index was built on and other attributes through `@>` on columns with a
+    GIN index; anything else would scan the table and is refused. Results
+    are streamed with `database.iterate` so a reconciliation job can walk
+    every match without loading them all.
+    """
+
+    def __init__(self, user_klass, database, table_name: str = "users"):
+        self.user_klass = user_klass
+        self.database = database
+        self.table_name = table_name
+        self.indexed = json_index_columns(user_klass.dalchemy_index_config())
+
+    def conditions(
+        self, column: str, attributes: dict, values: dict
+    ) -> typing.List[str]:
+        options = self.indexed.get(column)
+        if not options:
+            raise ValueError(f"{column} has no json indexes")
+        result, contained = [], {}
+        for attribute, value in attributes.items():
+            kind = options["attributes"].get(attribute)
+            if kind is None:
+                contained[attribute] = value
+                continue
+            name = f"{column}_{attribute}"
+            result.append(f"{json_attribute(column, attribute, kind)} = :{name}")
+            values[name] = value
+        if contained:
+            if not options["gin"]:
+                raise ValueError(f"{', '.join(contained)} of {column} are not indexed")
+            result.append(
+                f"{jsonb_document(column)} @> CAST(:{column}_contains AS jsonb)"
+            )
+            values[f"{column}_contains"] = json.dumps(contained)
+        return result
+
+    async def iterate(
+        self, conditions: typing.List[str], values: dict
+    ) -> typing.AsyncIterator[typing.Any]:
+        query = (
+            f"SELECT * FROM {self.table_name} "
+            f"WHERE {' AND '.join(conditions)} ORDER BY id"
+        )
+        async for record in self.database.iterate(query=query, values=values):
+            yield self.user_klass.from_db_row(record)
+
+    def where(self, column: str = "signup_info", **attributes):
+        values: dict = {}
+        return self.iterate(self.conditions(column, attributes, values), values)
+
+    def unverified_provider_users(self, provider: str):
+        values: dict = {}
+        conditions = self.conditions("signup_info", {"provider": provider}, values)
+        # a missing "verified" is unverified, so this filters the provider's rows
+        conditions.append(
+            f"{json_attribute('signup_info', 'verified', 'boolean')} IS NOT TRUE"
+        )
+        return self.iterate(conditions, values)
+
+    def staff_in_department(self, department: str):
+        return self.where(provider="staff", department=department)
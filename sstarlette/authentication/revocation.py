@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import math
+import typing
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(
+            8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        )
+        self.hash_count = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> typing.Iterator[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class TokenRevocationList:
+    """Revoked token ids, stored in the database and mirrored per worker.
+
+    Each worker keeps the revoked `jti`s in a Bloom filter and pulls new rows
+    every `refresh_interval` seconds. Only filter hits are confirmed against
+    the table, so tokens that were never revoked cost a few hash probes.
+    """
+
+    def __init__(
+        self,
+        database,
+        table_name: str = "revoked_tokens",
+        refresh_interval: float = 5,
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        overlap: int = 1000,
+    ):
+        self.database = database
+        self.table_name = table_name
+        self.refresh_interval = refresh_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # re-read a window of ids so rows committed out of order are not missed
+        self.overlap = overlap
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.last_id = 0
+        self._confirmed: typing.Set[str] = set()
+        self._refresher: typing.Optional[asyncio.Future] = None
+
+    def create_table_statements(self) -> typing.List[str]:
+        return [
+            f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                id BIGSERIAL PRIMARY KEY,
+                jti VARCHAR(64) NOT NULL UNIQUE,
+                expires TIMESTAMP NULL,
+                created TIMESTAMP NOT NULL DEFAULT now()
+            )"""
+        ]
+
+    async def create_table(self):
+        for statement in self.create_table_statements():
+            await self.database.execute(query=statement)
+
+    async def revoke(self, jti: str, expires: datetime.datetime = None):
+        await self.database.execute(
+            query=f"""INSERT INTO {self.table_name} (jti, expires)
+                VALUES (:jti, :expires) ON CONFLICT (jti) DO NOTHING""",
+            values={"jti": jti, "expires": expires},
+        )
+        self.bloom.add(jti)
+        self._confirmed.add(jti)
+
+    async def is_revoked(self, jti: str) -> bool:
+        if jti not in self.bloom:
+            return False
+        if jti in self._confirmed:
+            return True
+        record = await self.database.fetch_one(
+            query=f"SELECT 1 FROM {self.table_name} WHERE jti = :jti",
+            values={"jti": jti},
+        )
+        if record:
+            self._confirmed.add(jti)
+        return bool(record)
+
+    async def refresh(self):
+        records = await self.database.fetch_all(
+            query=f"""SELECT id, jti FROM {self.table_name}
+                WHERE id > :last_id ORDER BY id""",
+            values={"last_id": max(0, self.last_id - self.overlap)},
+        )
+        for record in records:
+            if record["jti"] not in self.bloom:
+                self.bloom.add(record["jti"])
+            self.last_id = max(self.last_id, record["id"])
+        if self.bloom.count > self.capacity:
+            await self.rebuild()
+
+    async def rebuild(self):
+        """Drop expired rows and start a fresh filter from the rest."""
+        await self.database.execute(
+            query=f"DELETE FROM {self.table_name} WHERE expires < :now",
+            values={"now": datetime.datetime.utcnow()},
+        )
+        records = await self.database.fetch_all(
+            query=f"SELECT id, jti FROM {self.table_name} ORDER BY id"
+        )
+        while len(records) > self.capacity // 2:
+            self.capacity *= 2
+        self.bloom = BloomFilter(self.capacity, self.error_rate)
+        self._confirmed = set()
+        self.last_id = 0
+        for record in records:
+            self.bloom.add(record["jti"])
+            self.last_id = max(self.last_id, record["id"])
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Could not refresh token revocation list")
+
+    async def start(self):
+        await self.rebuild()
+        if self.refresh_interval:
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self):
+        if self._refresher and not self._refresher.done():
+            self._refresher.cancel()
+        self._refresher = None
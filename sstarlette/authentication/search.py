@@ -0,0 +1,83 @@
+import json
+import typing
+
+from sstarlette.authentication import fields
+from .indexes import search_columns
+
+
+def like_prefix(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
+
+class UserSearch:
+    """Ranked, paginated search over the columns declared with "search".
+
+    Trigram columns match through the `%` similarity operator and prefix
+    columns through `lower(column) LIKE 'term%'`, so both are answered from
+    the indexes `search_index_statements()` creates. Results are ordered by
+    the best similarity, with prefix matches ranked first.
+    """
+
+    def __init__(
+        self,
+        user_klass,
+        database,
+        table_name: str = "users",
+        columns: typing.Sequence[str] = ("id", "full_name", "email", "roles"),
+        max_page_size: int = 100,
+    ):
+        self.database = database
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.max_page_size = max_page_size
+        self.searchable = search_columns(user_klass.dalchemy_index_config())
+        if not self.searchable:
+            raise ValueError("No column of the user table is declared searchable")
+        self.json_columns = set(fields.json_fields(user_klass))
+
+    @property
+    def query(self) -> str:
+        conditions, scores = [], []
+        for column, kinds in self.searchable.items():
+            if "trigram" in kinds:
+                conditions.append(f"lower({column}) % :term")
+                scores.append(f"similarity(lower({column}), :term)")
+            if "prefix" in kinds:
+                conditions.append(f"lower({column}) LIKE :prefix")
+                scores.append(
+                    f"CASE WHEN lower({column}) LIKE :prefix THEN 1 ELSE 0 END"
+                )
+        return (
+            f"SELECT {', '.join(self.columns)}, GREATEST({', '.join(scores)}) AS score "
+            f"FROM {self.table_name} WHERE {' OR '.join(conditions)} "
+            "ORDER BY score DESC, id LIMIT :limit OFFSET :offset"
+        )
+
+    def _row(self, record) -> dict:
+        row = {}
+        for column in self.columns:
+            value = record[column]
+            # JSONB comes back from asyncpg as text
+            if column in self.json_columns and isinstance(value, str):
+                value = json.loads(value)
+            row[column] = value
+        return row
+
+    async def search(
+        self, term: str, page: int = 1, page_size: int = 20
+    ) -> typing.Tuple[typing.List[dict], bool]:
+        term = term.strip().lower()
+        page = max(1, page)
+        page_size = max(1, min(page_size, self.max_page_size))
+        records = await self.database.fetch_all(
+            query=self.query,
+            values={
+                "term": term,
+                "prefix": like_prefix(term),
+                # one extra row tells whether there is a next page
+                "limit": page_size + 1,
+                "offset": (page - 1) * page_size,
+            },
+        )
+        return [self._row(x) for x in records[:page_size]], len(records) > page_size
@@ -1,10 +1,22 @@
+import asyncio
+import calendar
 import datetime
 import typing
 
+import jwt
 from pydantic import BaseModel
 from starlette import background, datastructures, requests
 from starlette.background import BackgroundTasks
-from .helpers import token_encoder_and_decoder
+from sstarlette.ratelimit import RateLimiter
+from sstarlette.resilience import HookGuard
+from .bulk import BulkImporter, UserExporter, to_ndjson
+from .cache import PermissionCache
+from .helpers import current_time, token_encoder_and_decoder
+from .loader import UserLoader
+from .projection import Principal, PrincipalProjection
+from .revocation import TokenRevocationList
+from .queries import UserQueries
+from .search import UserSearch
 
 
 class CreateUserResult:
@@ -13,26 +25,93 @@ class CreateUserResult:
         errors: dict = None,
         task: typing.List[typing.Any] = None,
         data: dict = None,
+        stream: typing.AsyncIterable[typing.Union[str, bytes]] = None,
+        media_type: str = None,
     ):
         self.errors = errors
         self.task = task
         self.data = data
+        self.stream = stream
+        self.media_type = media_type
 
 
 class SettingsType:
     REDIRECT_URL_ON_EMAIL_VERIFICATION: str
     REDIRECT_ERROR_AS_JSON: bool
     STAFF_ACCESS_CODE: str
+    INTROSPECTION_MAX_TOKENS: int
+    RATE_LIMITS: typing.Dict[str, typing.Dict[str, str]]
+    TRUSTED_PROXIES: typing.List[str]
+    HOOK_POLICIES: typing.Dict[str, dict]
 
 
 class BaseModelUtil:
     klass = typing.Any
-    get_user: typing.Callable[..., typing.Coroutine]
     create_user: typing.Callable[..., typing.Coroutine]
+    permission_cache: typing.Optional[PermissionCache] = None
+    principal_projection: typing.Optional[PrincipalProjection] = None
+    token_revocation: typing.Optional[TokenRevocationList] = None
+    user_importer: typing.Optional[BulkImporter] = None
+    user_exporter: typing.Optional[UserExporter] = None
+    user_search: typing.Optional[UserSearch] = None
+    # indexed lookups on signup_info for reconciliation jobs
+    user_queries: typing.Optional[UserQueries] = None
+    # set both to load users without overriding get_user/get_users and to
+    # insert signups with one INSERT ... RETURNING statement, permissions_query
+    # selects the permission names of the role bound to :role
+    database: typing.Any = None
+    table_name: typing.Optional[str] = None
+    permissions_query: typing.Optional[str] = None
+
+    @classmethod
+    async def get_user(cls, email: str):
+        # stored rows were validated when they were written
+        record = await cls.database.fetch_one(
+            query=f"SELECT * FROM {cls.table_name} WHERE email = :email",
+            values={"email": email},
+        )
+        if record is None:
+            return None
+        return cls.klass.from_db_row(record)
+
+    @classmethod
+    async def get_users(cls, emails: typing.List[str]) -> list:
+        """Loads the users that exist, used to batch concurrent lookups."""
+        default = BaseModelUtil.get_user.__func__
+        if getattr(cls.get_user, "__func__", None) is not default:
+            # an overridden get_user knows where users come from, this does not
+            users = await asyncio.gather(*[cls.get_user(email=x) for x in emails])
+            return [x for x in users if x is not None]
+        names = [f"email_{i}" for i in range(len(emails))]
+        records = await cls.database.fetch_all(
+            query=f"SELECT * FROM {cls.table_name} "
+            f"WHERE email IN ({', '.join(':' + x for x in names)})",
+            values=dict(zip(names, emails)),
+        )
+        return [cls.klass.from_db_row(x) for x in records]
 
 
 BM = typing.TypeVar("BM", bound=BaseModelUtil)
 
+# passed to create_user by the service layer, never taken from a signup body
+SIGNUP_ARGUMENTS = (
+    "email_verified",
+    "provider",
+    "role",
+    "role_task",
+    "additional_info",
+    "database",
+    "table_name",
+    "permissions_query",
+)
+
+# a starting point for settings.RATE_LIMITS, limits are off unless set
+DEFAULT_RATE_LIMITS = {
+    "/login": {"ip": "30/minute", "email": "10/minute"},
+    "/signup": {"ip": "10/minute"},
+    "/forgot-password": {"ip": "10/minute", "email": "3/minute"},
+}
+
 
 def build_service_layer(
     settings: SettingsType,
@@ -49,19 +128,41 @@ def build_service_layer(
         def email(self) -> str:
             return self.user.email
 
+    hook_guard = HookGuard(getattr(settings, "HOOK_POLICIES", None))
+    klass = getattr(_util_klass, "klass", None)
+    database = getattr(_util_klass, "database", None)
+    table_name = getattr(_util_klass, "table_name", None)
+    if database is not None and table_name and hasattr(klass, "dalchemy_table"):
+        # units of work write only the changed fields of these users
+        if klass.dalchemy_table is None:
+            klass.dalchemy_database, klass.dalchemy_table = database, table_name
+
     def get_func_from_utils(
         func_name: str
     ) -> typing.Optional[typing.Callable[..., typing.Coroutine]]:
         utils = build_utils()
-        return utils.get(func_name)
+        return hook_guard.wrap(func_name, utils.get(func_name))
+
+    projection = getattr(_util_klass, "principal_projection", None)
+    revocation = getattr(_util_klass, "token_revocation", None)
+    user_loader = UserLoader(_util_klass)
+
+    async def get_full_user(user):
+        # principals from the projection do not carry the password or profile
+        if isinstance(user, Principal):
+            return await user_loader.load(user.email)
+        return user
 
     async def delete_user(token_user) -> CreateUserResult:
-        record = await _util_klass.get_user(email=token_user["email"])
+        record = await user_loader.load(token_user["email"])
         if not record:
             return CreateUserResult(
                 errors={"msg": "Missing user record"}
             )  # type: ignore
         await record.delete()
+        user_loader.forget(record.email)
+        if projection:
+            await projection.delete(record.email)
         return CreateUserResult(data={"msg": "Done"})  # type: ignore
 
     async def on_signup(
@@ -111,21 +212,30 @@ def build_service_layer(
             if provider != "facebook":
                 email_verified = True
         tasks = []
+        # the body shares create_user's keyword arguments with these
+        data = {k: v for k, v in data.items() if k not in SIGNUP_ARGUMENTS}
+        insert = {}
+        if database is not None and table_name:
+            insert = {
+                "database": database,
+                "table_name": table_name,
+                "permissions_query": getattr(_util_klass, "permissions_query", None),
+            }
         errors, instance, access_token = await _util_klass.create_user(
             email_verified=email_verified,
             provider=provider,
             role=signup_info.get("role"),
+            **insert,
             **data,
         )
         if not errors:
             # email or identity verification.
             if "email" in (signup_info.get("verification") or ""):
                 temp_token = await instance.create_user_token()
-                # wrapped in a lambda for easy passage as a background function
+                # passed as arguments so a durable task queue can persist it
                 email_verification = get_func_from_utils("email_verification")
                 if email_verification:
-                    task = lambda: email_verification(instance.email, temp_token)
-                    tasks.append(task)
+                    tasks.append([email_verification, instance.email, temp_token])
 
         if errors:
             return CreateUserResult(errors={"errors": errors})  # type: ignore
@@ -146,8 +256,8 @@ def build_service_layer(
         tasks = []
 
         async def callback():
-            _user = user.user
-            _user.set_password(password)
+            _user = await get_full_user(user.user)
+            await _user.aset_password(password)
             await _user.save()
 
         tasks.append(callback)
@@ -161,11 +271,11 @@ def build_service_layer(
         )
         if result.errors:
             return CreateUserResult(errors=result.errors)
-        if result.task:
-            tasks = []
-            tasks.append(result.task)
-            return CreateUserResult(data={"msg": "Email verification sent"}, task=tasks)
-        return CreateUserResult(data=result.data)
+        if not result.data:
+            return CreateUserResult(
+                data={"msg": "Email verification sent"}, task=result.task
+            )
+        return CreateUserResult(data=result.data, task=result.task)
 
     async def authenticate_user(login_info: dict, bearer_token=None, **data):
         email = data.get("email") or ""
@@ -204,6 +314,7 @@ def build_service_layer(
         # not requiring a password to login
         if callback_url:
             provider = "token"  # force generation of access token
+        tasks = []
         access_token = await _authenticate_user(
             email=email.strip(),
             number=number,
@@ -211,19 +322,22 @@ def build_service_layer(
             role=bearer_token,
             provider=provider,
             endpoint=endpoint,
+            tasks=tasks,
         )
         if not access_token:
             return CreateUserResult(errors={"msg": "Invalid credentials"})
         email_verification = get_func_from_utils("email_verification")
         if email_verification:
-            tasks = []
             if callback_url:
-                task = lambda: email_verification(
-                    email, token=access_token, callback_url=callback_url
+                tasks.append(
+                    [
+                        email_verification,
+                        email,
+                        dict(token=access_token, callback_url=callback_url),
+                    ]
                 )
-                tasks.append(task)
                 return CreateUserResult(task=tasks)
-        return CreateUserResult(data={"access_token": access_token})
+        return CreateUserResult(data={"access_token": access_token}, task=tasks)
 
     async def on_email_confirmation(
         email: str, token: str, callback_url: str = None
@@ -231,7 +345,7 @@ def build_service_layer(
         if not all([email, token]):
             return CreateUserResult(errors={"msg": "Missing query parameters"})
 
-        user = await _util_klass.get_user(email=email.strip())
+        user = await user_loader.load(email.strip())
         redirect_url = None
         if user:
             is_valid = await user.validate_token(token)
@@ -249,6 +363,14 @@ def build_service_layer(
                 return CreateUserResult(errors={"msg": "Invalid user or token"})
         return CreateUserResult(data=dict(redirect_url=redirect_url))
 
+    def build_rehash_task(user, new_hash: str):
+        # saved after the response so login does not wait on the write
+        async def update_password_hash():
+            user.password = new_hash
+            await user.save()
+
+        return update_password_hash
+
     async def _authenticate_user(
         email: str = None,
         number: str = None,
@@ -256,6 +378,7 @@ def build_service_layer(
         password: typing.Optional[str] = "",
         role: str = None,
         provider: str = None,
+        tasks: typing.List[typing.Any] = None,
     ):
         _email = email
         get_email_from_number = get_func_from_utils("get_email_from_number")
@@ -264,10 +387,13 @@ def build_service_layer(
                 _email = await get_email_from_number(number, endpoint)
         access_token = None
         if _email:
-            user = await _util_klass.get_user(email=_email)
+            user = await user_loader.load(_email)
             if user:
                 if password:
-                    if user.check_password(password):
+                    is_valid, new_hash = await user.acheck_password_and_update(password)
+                    if is_valid:
+                        if new_hash and tasks is not None:
+                            tasks.append(build_rehash_task(user, new_hash))
                         access_token = await user.create_user_token()
                         if role:
                             if role == settings.STAFF_ACCESS_CODE:
@@ -286,7 +412,7 @@ def build_service_layer(
             return CreateUserResult(errors={"msg": "Token is invalid or expired"})
         if not email:
             return CreateUserResult(errors={"msg": "Missing email"})
-        user_to_hijack = await _util_klass.get_user(email=email)
+        user_to_hijack = await user_loader.load(email)
         access_token = None
         if user_to_hijack:
             access_token = await user_to_hijack.generate_access_token(
@@ -296,17 +422,154 @@ def build_service_layer(
             return CreateUserResult(errors={"msg": "No user with email"})
         return CreateUserResult(data=dict(access_token=access_token))
 
-    async def verify_access_token(bearer_token: str) -> VerifiedUser:
-        _, decode_access_token = token_encoder_and_decoder(settings)
-        user_data = decode_access_token(bearer_token, verify=False)
-        email = user_data["email"]
-        user = await _util_klass.get_user(email=email)
+    async def get_principal(email: str):
+        user = None
+        if projection:
+            _, decode_access_token = token_encoder_and_decoder(settings)
+            user = await projection.get(
+                email=email, decode_access_token=decode_access_token
+            )
+        if not user:
+            user = await user_loader.load(email)
+        return user
+
+    def get_auth_roles(user, user_data: dict) -> typing.List[str]:
         auth_roles = ["authenticated"]
         if user.is_staff and "aud" in user_data:
             auth_roles.append("staff")
         if user.is_superuser and "aud" in user_data:
             auth_roles.append("admin")
-        return VerifiedUser(user=user, auth_roles=auth_roles)
+        return auth_roles
+
+    async def verify_access_token(bearer_token: str) -> VerifiedUser:
+        _, decode_access_token = token_encoder_and_decoder(settings)
+        user_data = decode_access_token(bearer_token, verify=False)
+        email = user_data["email"]
+        if revocation and "jti" in user_data:
+            if await revocation.is_revoked(user_data["jti"]):
+                raise ValueError("Token has been revoked")
+        user = await get_principal(email)
+        return VerifiedUser(user=user, auth_roles=get_auth_roles(user, user_data))
+
+    async def introspect_tokens(tokens: typing.List[str]) -> CreateUserResult:
+        max_tokens = getattr(settings, "INTROSPECTION_MAX_TOKENS", 100)
+        if not isinstance(tokens, list) or not tokens:
+            return CreateUserResult(errors={"msg": "Expected a list of tokens"})
+        if len(tokens) > max_tokens:
+            return CreateUserResult(
+                errors={"msg": f"At most {max_tokens} tokens can be introspected"}
+            )
+        _, decode_access_token = token_encoder_and_decoder(settings)
+
+        async def decode(token):
+            try:
+                user_data = decode_access_token(token, options={"verify_aud": False})
+            except (jwt.exceptions.InvalidTokenError, TypeError):
+                return None
+            if "email" not in user_data:
+                return None
+            if revocation and "jti" in user_data:
+                if await revocation.is_revoked(user_data["jti"]):
+                    return None
+            return user_data
+
+        decoded = await asyncio.gather(*[decode(x) for x in tokens])
+        # each user is loaded once no matter how many of their tokens are sent
+        emails = list({x["email"] for x in decoded if x})
+        users = dict(
+            zip(emails, await asyncio.gather(*[get_principal(x) for x in emails]))
+        )
+        now = calendar.timegm(current_time().utctimetuple())
+        result = []
+        for user_data in decoded:
+            user = users.get(user_data["email"]) if user_data else None
+            if not user or not user.is_active:
+                result.append({"active": False})
+                continue
+            info = {
+                "active": True,
+                "email": user.email,
+                "roles": user.roles,
+                "auth_roles": get_auth_roles(user, user_data),
+                "exp": user_data.get("exp"),
+                "ttl": None,
+            }
+            if "exp" in user_data:
+                info["ttl"] = max(0, int(user_data["exp"] - now))
+            if "hijacker" in user_data:
+                info["hijacker"] = user_data["hijacker"]
+            result.append(info)
+        return CreateUserResult(data={"tokens": result})
+
+    async def revoke_token(
+        user: VerifiedUser, bearer_token: str, token: str = None, **kwargs
+    ) -> CreateUserResult:
+        if not revocation:
+            return CreateUserResult(errors={"msg": "Token revocation not enabled"})
+        # staff can revoke any token, e.g one minted by hijack-user
+        if token and "staff" not in user.auth_roles:
+            return CreateUserResult(errors={"msg": "Not Authorized"})
+        _, decode_access_token = token_encoder_and_decoder(settings)
+        try:
+            # a forged token must not be able to revoke the jti it names
+            token_data = decode_access_token(
+                token or bearer_token, options={"verify_aud": False}
+            )
+        except jwt.exceptions.InvalidTokenError:
+            return CreateUserResult(errors={"msg": "Invalid token"})
+        if "jti" not in token_data:
+            return CreateUserResult(errors={"msg": "Token can not be revoked"})
+        expires = None
+        if "exp" in token_data:
+            expires = datetime.datetime.utcfromtimestamp(token_data["exp"])
+        await revocation.revoke(token_data["jti"], expires=expires)
+        return CreateUserResult(data={"msg": "Token revoked"})
+
+    async def import_users(
+        users: typing.List[dict], email_verified: bool = False
+    ) -> CreateUserResult:
+        importer = getattr(_util_klass, "user_importer", None)
+        if not importer:
+            return CreateUserResult(errors={"msg": "Bulk import not enabled"})
+        if not isinstance(users, list):
+            return CreateUserResult(errors={"msg": "Expected a list of users"})
+        return CreateUserResult(
+            stream=to_ndjson(importer.run(users, email_verified=email_verified))
+        )
+
+    async def export_users(
+        columns: typing.List[str] = None, format: str = "ndjson"
+    ) -> CreateUserResult:
+        exporter = getattr(_util_klass, "user_exporter", None)
+        if not exporter:
+            return CreateUserResult(errors={"msg": "Export not enabled"})
+        if format not in exporter.formats:
+            return CreateUserResult(errors={"msg": f"Unsupported format {format}"})
+        invalid = exporter.invalid_columns(columns or [])
+        if invalid:
+            return CreateUserResult(
+                errors={"msg": f"Unknown columns {', '.join(invalid)}"}
+            )
+        return CreateUserResult(
+            stream=exporter.run(columns, format=format),
+            media_type=exporter.formats[format],
+        )
+
+    async def search_users(
+        term: str, page: int = 1, page_size: int = 20
+    ) -> CreateUserResult:
+        user_search = getattr(_util_klass, "user_search", None)
+        if not user_search:
+            return CreateUserResult(errors={"msg": "Search not enabled"})
+        if not term or len(term.strip()) < 2:
+            return CreateUserResult(errors={"msg": "Search term is too short"})
+        users, has_more = await user_search.search(term, page, page_size)
+        return CreateUserResult(
+            data={"users": users, "page": page, "has_more": has_more}
+        )
+
+    async def hook_metrics() -> CreateUserResult:
+        return CreateUserResult(data={"hooks": hook_guard.snapshot()})
 
     async def forgot_password_action(email: str, callback_url) -> CreateUserResult:
         if not email or not callback_url:
@@ -328,10 +591,16 @@ def build_service_layer(
         "hijack-user": get_hijacked_user_token,
         "delete-user": delete_user,
         "verify-access-token": verify_access_token,
+        "revoke-token": revoke_token,
+        "introspect-tokens": introspect_tokens,
+        "hook-metrics": hook_metrics,
+        "import-users": import_users,
+        "export-users": export_users,
+        "search-users": search_users,
     }
 
 
-def build_view(service_layer, staff_key="StaffAuth"):
+def build_view(service_layer, staff_key="StaffAuth", rate_limits=None):
     def get_token(headers: requests.Headers) -> str:
         auth = headers["Authorization"]
         bearer_token = auth.replace("Bearer", "").strip()
@@ -378,6 +647,44 @@ def build_view(service_layer, staff_key="StaffAuth"):
             email=email, token=token, callback_url=callback_url
         )
 
+    async def revoke_token(post_data, **kwargs) -> CreateUserResult:
+        return await service_layer["revoke-token"](
+            kwargs["user"], get_token(kwargs["headers"]), **(post_data or {})
+        )
+
+    async def introspect(post_data, **kwargs) -> CreateUserResult:
+        if not isinstance(post_data, dict):
+            return CreateUserResult(errors={"msg": "Expected a list of tokens"})
+        return await service_layer["introspect-tokens"](post_data.get("tokens"))
+
+    async def import_users(post_data, **kwargs) -> CreateUserResult:
+        post_data = post_data or {}
+        return await service_layer["import-users"](
+            post_data.get("users"),
+            email_verified=post_data.get("email_verified", False),
+        )
+
+    async def export_users(**kwargs) -> CreateUserResult:
+        params = kwargs["query_params"]
+        columns = [x.strip() for x in (params.get("columns") or "").split(",")]
+        return await service_layer["export-users"](
+            [x for x in columns if x], format=params.get("format") or "ndjson"
+        )
+
+    async def search_users(**kwargs) -> CreateUserResult:
+        params = kwargs["query_params"]
+        try:
+            page = int(params.get("page") or 1)
+            page_size = int(params.get("page_size") or 20)
+        except ValueError:
+            return CreateUserResult(errors={"msg": "Invalid page"})
+        return await service_layer["search-users"](
+            params.get("q") or "", page=page, page_size=page_size
+        )
+
+    async def hook_metrics(**kwargs) -> CreateUserResult:
+        return await service_layer["hook-metrics"]()
+
     async def hijack_user(**kwargs) -> CreateUserResult:
         # validate the token to see if it is expired
         return await service_layer["hijack-user"](
@@ -386,24 +693,81 @@ def build_view(service_layer, staff_key="StaffAuth"):
             email=kwargs["query_params"].get("email"),
         )
 
-    return {
-        "/delete-user": {"func": delete_user, "methods": ["POST"]},
-        "/hijack-user": {"func": hijack_user, "methods": ["GET"], "auth": "staff"},
-        "/signup": {"func": signup, "methods": ["POST"]},
-        "/login": {"func": login, "methods": ["POST"]},
+    routes = {
+        "/delete-user": {
+            "func": delete_user,
+            "methods": ["POST"],
+            "priority": "low",
+            "unit_of_work": True,
+        },
+        "/hijack-user": {
+            "func": hijack_user,
+            "methods": ["GET"],
+            "auth": "staff",
+            "priority": "low",
+        },
+        "/import-users": {
+            "func": import_users,
+            "methods": ["POST"],
+            "auth": "staff",
+            "priority": "low",
+        },
+        "/export-users": {
+            "func": export_users,
+            "methods": ["GET"],
+            "auth": "staff",
+            "priority": "low",
+        },
+        "/users/search": {
+            "func": search_users,
+            "methods": ["GET"],
+            "auth": "staff",
+            "priority": "low",
+        },
+        "/hook-metrics": {
+            "func": hook_metrics,
+            "methods": ["GET"],
+            "auth": "staff",
+            "priority": "low",
+        },
+        "/signup": {
+            "func": signup,
+            "methods": ["POST"],
+            "priority": "low",
+            "idempotent": True,
+            "unit_of_work": True,
+        },
+        "/login": {"func": login, "methods": ["POST"], "priority": "high"},
         "/verify-email": {
             "func": on_email_confirmation,
             "methods": ["GET"],
             "redirect": True,
             "redirect_key": "redirect_url",
+            "unit_of_work": True,
         },
         "/forgot-password": {"func": forgot_password, "methods": ["GET"]},
         "/reset-password": {
             "func": reset_password,
             "methods": ["POST"],
             "auth": "authenticated",
+            "idempotent": True,
+        },
+        "/introspect": {
+            "func": introspect,
+            "methods": ["POST"],
+            "auth": "staff",
+            "priority": "high",
+        },
+        "/revoke-token": {
+            "func": revoke_token,
+            "methods": ["POST"],
+            "auth": "authenticated",
         },
     }
+    for path, rules in (rate_limits or {}).items():
+        if path in routes:
+            routes[path] = {**routes[path], "rate_limit": rules}
+    return routes
 
 
 def build_app(
@@ -412,12 +776,28 @@ def build_app(
     from sstarlette.base import SStarlette
 
     service_layer = build_service_layer(settings, _util_klass, build_utils)
+    trusted_proxies = getattr(settings, "TRUSTED_PROXIES", None)
+    if trusted_proxies and "rate_limiter" not in kwargs:
+        kwargs["rate_limiter"] = RateLimiter(trusted_proxies=trusted_proxies)
+    klass = getattr(_util_klass, "klass", None)
+    if hasattr(klass, "get_password_hasher"):
+        # stops the hashing processes when a pool was configured
+        kwargs["on_shutdown"] = [
+            *kwargs.get("on_shutdown", []),
+            klass.get_password_hasher().shutdown,
+        ]
     return SStarlette(
         str(settings.DATABASE_URL),
         auth_token_verify_user_callback=service_layer["verify-access-token"],
         serverless=settings.ENVIRONMENT == "serverless",
         model_initializer=_util_klass.model_initializer,
-        service_layer=build_view(service_layer, staff_key=staff_key),
+        permission_cache=getattr(_util_klass, "permission_cache", None),
+        token_revocation=getattr(_util_klass, "token_revocation", None),
+        service_layer=build_view(
+            service_layer,
+            staff_key=staff_key,
+            rate_limits=getattr(settings, "RATE_LIMITS", None),
+        ),
         routes=routes,
         **kwargs,
     )
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+import typing
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+def task_name(func: typing.Callable) -> str:
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', func)}"
+
+
+class TaskMetrics:
+    def __init__(self):
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.shed = 0
+        self.deferred = 0
+        self.total_time = 0.0
+
+    def as_dict(self) -> dict:
+        finished = self.completed + self.failed + self.timed_out
+        return {
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "shed": self.shed,
+            "deferred": self.deferred,
+            "mean_time": self.total_time / finished if finished else 0.0,
+        }
+
+
+class TaskScheduler:
+    """Runs post-response tasks on a fixed set of workers shared by all requests.
+
+    At most `max_concurrency` tasks run at once and each gets `timeout`
+    seconds. When `max_queue` tasks are already waiting, `overflow` decides:
+    "defer" hands the task back so it runs after the response as before,
+    "shed" drops it.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 10,
+        max_queue: int = 1000,
+        timeout: typing.Optional[float] = 30,
+        overflow: str = "defer",
+    ):
+        if overflow not in ("defer", "shed"):
+            raise ValueError("overflow must be 'defer' or 'shed'")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.overflow = overflow
+        self.metrics: typing.Dict[str, TaskMetrics] = {}
+        self.queue: typing.Optional[asyncio.Queue] = None
+        self._workers: typing.List[asyncio.Future] = []
+
+    def _metrics(self, func) -> TaskMetrics:
+        name = task_name(func)
+        if name not in self.metrics:
+            self.metrics[name] = TaskMetrics()
+        return self.metrics[name]
+
+    @property
+    def running(self) -> bool:
+        return bool(self._workers)
+
+    def schedule(self, func: typing.Callable, *args, **kwargs) -> bool:
+        """Returns False when the caller should run the task itself."""
+        if not self.running:
+            return False
+        metrics = self._metrics(func)
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except asyncio.QueueFull:
+            if self.overflow == "defer":
+                metrics.deferred += 1
+                return False
+            metrics.shed += 1
+            logger.warning("Shedding background task %s", task_name(func))
+            return True
+        metrics.scheduled += 1
+        return True
+
+    async def _run(self, func, args, kwargs):
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        result = await run_in_threadpool(func, *args, **kwargs)
+        # lambdas wrapping a coroutine function return the coroutine
+        if asyncio.iscoroutine(result):
+            return await result
+        return result
+
+    async def _work(self):
+        while True:
+            func, args, kwargs = await self.queue.get()
+            metrics = self._metrics(func)
+            start = time.monotonic()
+            try:
+                await asyncio.wait_for(self._run(func, args, kwargs), self.timeout)
+            except asyncio.TimeoutError:
+                metrics.timed_out += 1
+                logger.warning("Background task %s timed out", task_name(func))
+            except Exception:
+                metrics.failed += 1
+                logger.exception("Background task %s failed", task_name(func))
+            else:
+                metrics.completed += 1
+            finally:
+                metrics.total_time += time.monotonic() - start
+                self.queue.task_done()
+
+    def snapshot(self) -> dict:
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "tasks": {name: value.as_dict() for name, value in self.metrics.items()},
+        }
+
+    def start(self):
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._workers = [
+            asyncio.ensure_future(self._work()) for _ in range(self.max_concurrency)
+        ]
+
+    async def stop(self, timeout: float = 10):
+        if not self.running:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "%s background tasks dropped on shutdown", self.queue.qsize()
+            )
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
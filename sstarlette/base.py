@@ -1,7 +1,24 @@
+import asyncio
+import time
 import typing
 
 import jwt
+from sstarlette.background import TaskScheduler
+from sstarlette.context import (
+    RequestCacheMiddleware,
+    get_deadline,
+    remaining_time,
+    reset_deadline,
+    set_deadline,
+)
+from sstarlette.idempotency import IdempotencyCache
+from sstarlette.limiter import AdaptiveLimiter
+from sstarlette.monitoring import LoopLagMonitor
+from sstarlette.ratelimit import RateLimiter
+from sstarlette.resilience import BulkheadFullError, CircuitOpenError
 from sstarlette.sentry_patch import serverless_function
+from sstarlette.task_queue import DurableTaskQueue
+from sstarlette.unit_of_work import UnitOfWork
 from starlette.applications import Starlette
 from starlette.authentication import (
     AuthCredentials,
@@ -14,7 +31,7 @@ from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import HTTPConnection, Request
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
 from starlette.routing import Route
 
 
@@ -24,16 +41,41 @@ class SResult:
         errors: dict = None,
         data: dict = None,
         task: typing.List[typing.Any] = None,
+        stream: typing.AsyncIterable[typing.Union[str, bytes]] = None,
+        media_type: str = None,
     ):
         self.errors = errors
         self.data = data
         self.task = task
+        # an async iterable sent as the response body instead of `data`
+        self.stream = stream
+        self.media_type = media_type
+
+
+def task_arguments(
+    task: typing.Any
+) -> typing.Tuple[typing.Callable, typing.Sequence, typing.Dict[str, typing.Any]]:
+    if type(task) in [list, tuple]:
+        try:
+            dict_index = [type(o) for o in task].index(dict)
+        except ValueError:
+            return task[0], task[1:], {}
+        return task[0], task[1:dict_index], task[dict_index]
+    return task, (), {}
 
 
 def on_auth_error(request: Request, exc: Exception):
     return JSONResponse({"status": False, "msg": str(exc)}, status_code=403)
 
 
+def too_many_requests(retry_after: int) -> JSONResponse:
+    return JSONResponse(
+        {"status": False, "msg": "Too many requests"},
+        status_code=429,
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
 async def not_authorized(request, exc):
     return JSONResponse(
         {"status": False, "msg": "Not Authorized"}, status_code=exc.status_code
@@ -80,6 +122,31 @@ class SStarlette(Starlette):
                 self.replica_database = databases.Database(str(replica_database_url))
         self.is_serverless = kwargs.pop("serverless", False)
         self.model_initializer = kwargs.pop("model_initializer", None)
+        self.permission_cache = kwargs.pop("permission_cache", None)
+        self.token_revocation = kwargs.pop("token_revocation", None)
+        self.loop_monitor = kwargs.pop("loop_monitor", None)
+        self.task_scheduler: typing.Optional[TaskScheduler] = kwargs.pop(
+            "task_scheduler", None
+        )
+        self.task_queue: typing.Optional[DurableTaskQueue] = kwargs.pop(
+            "task_queue", None
+        )
+        self.default_timeout: typing.Optional[float] = kwargs.pop(
+            "default_timeout", None
+        )
+        self.concurrency_limiter: typing.Optional[AdaptiveLimiter] = kwargs.pop(
+            "concurrency_limiter", None
+        )
+        if self.loop_monitor is True:
+            self.loop_monitor = LoopLagMonitor()
+        if self.concurrency_limiter is True:
+            self.concurrency_limiter = AdaptiveLimiter()
+        self.rate_limiter: typing.Optional[RateLimiter] = kwargs.pop(
+            "rate_limiter", None
+        )
+        self.idempotency: typing.Optional[IdempotencyCache] = kwargs.pop(
+            "idempotency", None
+        )
         additional_middlewares = kwargs.pop("middleware", []) or []
         middlewares = self.populate_middlewares(
             auth_token_verify_user_callback,
@@ -122,7 +189,8 @@ class SStarlette(Starlette):
     def populate_middlewares(
         self, auth_token_verify_user_callback=None, cors=True, debug=False
     ) -> typing.List[Middleware]:
-        middlewares = []
+        # first, so the auth backend and the handler share the cache
+        middlewares = [Middleware(RequestCacheMiddleware)]
         if auth_token_verify_user_callback:
             token_class = build_token_backend(auth_token_verify_user_callback)
             middlewares.append(
@@ -208,11 +276,31 @@ class SStarlette(Starlette):
         no_db=False,
         redirect=False,
         redirect_key=None,
+        timeout: float = None,
     ) -> typing.Union[JSONResponse, RedirectResponse]:
         if self.is_serverless and not no_db:
             await self.connect_db()
-        result: SResult = await coroutine
         tasks = BackgroundTasks()
+        try:
+            result: SResult = await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            return self.json_response(
+                {"status": False, "msg": "Request timed out"},
+                status_code=504,
+                tasks=tasks,
+                no_db=no_db,
+            )
+        except (CircuitOpenError, BulkheadFullError) as e:
+            # a hook's dependency is down or saturated, retrying later can work
+            response = self.json_response(
+                {"status": False, "msg": "Service unavailable"},
+                status_code=503,
+                tasks=tasks,
+                no_db=no_db,
+            )
+            retry_after = getattr(e, "retry_after", 0)
+            response.headers["Retry-After"] = str(max(int(retry_after), 1))
+            return response
         if result.errors:
             return self.json_response(
                 {"status": False, **result.errors},
@@ -222,19 +310,27 @@ class SStarlette(Starlette):
             )
         if result.task:
             for i in result.task:
-                if type(i) in [list, tuple]:
-                    try:
-                        dict_index = [type(o) for o in i].index(dict)
-                        kwarg_props = i[dict_index]
-                        args_props = i[0:dict_index]
-                        tasks.add_task(*args_props, **kwarg_props)
-                    except ValueError:
-                        tasks.add_task(*i)
-                else:
-                    tasks.add_task(i)
+                func, args, kwargs = task_arguments(i)
+                if self.task_queue:
+                    if await self.task_queue.enqueue(func, *args, **kwargs):
+                        continue
+                if self.task_scheduler and not self.is_serverless:
+                    if self.task_scheduler.schedule(func, *args, **kwargs):
+                        continue
+                tasks.add_task(func, *args, **kwargs)
         if redirect and redirect_key and result.data:
             redirect_url = result.data.get(redirect_key)
             return self.json_response(redirect_url, redirect=True, status_code=301)
+        stream = getattr(result, "stream", None)
+        if stream is not None:
+            if self.is_serverless and not no_db:
+                tasks.add_task(self.disconnect_db)
+            return StreamingResponse(
+                stream,
+                media_type=getattr(result, "media_type", None)
+                or "application/x-ndjson",
+                background=tasks,
+            )
         _result: typing.Dict[str, typing.Any] = {"status": True}
         if result.data:
             _result.update(data=result.data)
@@ -250,8 +346,20 @@ class SStarlette(Starlette):
         redirect_key: str = None,
         no_db: bool = False,
         skip: bool = False,
+        timeout: float = None,
+        priority: str = "normal",
+        rate_limit: typing.Dict[str, typing.Any] = None,
+        idempotent: bool = False,
+        unit_of_work: bool = False,
     ):
-        async def f(request: Request):
+        if timeout is None:
+            timeout = self.default_timeout
+        if rate_limit and not self.rate_limiter:
+            self.rate_limiter = RateLimiter()
+        if idempotent and not self.idempotency:
+            self.idempotency = IdempotencyCache()
+
+        async def view(request: Request):
             post_data = None
             headers = request.headers
             user = None
@@ -261,25 +369,77 @@ class SStarlette(Starlette):
                     redirect_key=redirect_key,
                     redirect=redirect,
                     no_db=no_db,
+                    timeout=remaining_time(),
                 )
             if "POST" in methods:
                 post_data = await request.json()
+            if rate_limit:
+                retry_after = await self.rate_limiter.check(
+                    path, rate_limit, request, post_data, body_parsed=True
+                )
+                if retry_after:
+                    return too_many_requests(retry_after)
             if auth:
                 user = request.user
+            coroutine = func(
+                post_data=post_data,
+                query_params=request.query_params,
+                headers=request.headers,
+                path_params=request.path_params,
+                user=user,
+                request=request,
+            )
+            if unit_of_work and self.database:
+                coroutine = UnitOfWork(self.database).run(coroutine)
             return await self.build_response(
-                func(
-                    post_data=post_data,
-                    query_params=request.query_params,
-                    headers=request.headers,
-                    path_params=request.path_params,
-                    user=user,
-                    request=request,
-                ),
+                coroutine,
                 redirect_key=redirect_key,
                 redirect=redirect,
                 no_db=no_db,
+                timeout=remaining_time(),
             )
 
+        async def limited_view(request: Request):
+            limiter = self.concurrency_limiter
+            if not limiter:
+                return await view(request)
+            if not await limiter.acquire(priority, remaining_time()):
+                return JSONResponse(
+                    {"status": False, "msg": "Service overloaded"},
+                    status_code=503,
+                    headers={"Retry-After": str(limiter.retry_after)},
+                )
+            start = time.monotonic()
+            try:
+                return await view(request)
+            finally:
+                limiter.release(time.monotonic() - start)
+
+        async def guarded_view(request: Request):
+            if rate_limit:
+                # per ip limits are checked before the body is read
+                retry_after = await self.rate_limiter.check(path, rate_limit, request)
+                if retry_after:
+                    return too_many_requests(retry_after)
+            key = await self.idempotency.scope(path, request) if idempotent else None
+            if not key:
+                return await limited_view(request)
+            # retries replay the stored response without taking a slot
+            return await self.idempotency.run(
+                key, request, lambda: limited_view(request)
+            )
+
+        async def f(request: Request):
+            if not timeout:
+                return await guarded_view(request)
+            # the remaining budget is visible to the service function
+            token = set_deadline(timeout)
+            request.state.deadline = get_deadline()
+            try:
+                return await guarded_view(request)
+            finally:
+                reset_deadline(token)
+
         function = f
         if auth:
             function = requires(auth)(f)
@@ -289,6 +449,24 @@ class SStarlette(Starlette):
 
     async def startup(self):
         await self.connect_db()
+        if self.permission_cache:
+            await self.permission_cache.start(self.database)
+        if self.token_revocation:
+            await self.token_revocation.start()
+        if self.loop_monitor:
+            self.loop_monitor.start()
+        if self.task_queue:
+            await self.task_queue.setup()
+        if self.task_scheduler and not self.is_serverless:
+            self.task_scheduler.start()
 
     async def shutdown(self):
+        if self.task_scheduler:
+            await self.task_scheduler.stop()
+        if self.loop_monitor:
+            self.loop_monitor.stop()
+        if self.token_revocation:
+            await self.token_revocation.stop()
+        if self.permission_cache:
+            await self.permission_cache.stop()
         await self.disconnect_db()
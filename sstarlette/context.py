@@ -0,0 +1,60 @@
+import contextvars
+import time
+import typing
+
+_deadline: contextvars.ContextVar[typing.Optional[float]] = contextvars.ContextVar(
+    "sstarlette_deadline", default=None
+)
+
+
+def set_deadline(timeout: float) -> contextvars.Token:
+    """Starts a deadline `timeout` seconds from now, never later than the current one."""
+    deadline = time.monotonic() + timeout
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token: contextvars.Token):
+    _deadline.reset(token)
+
+
+def get_deadline() -> typing.Optional[float]:
+    return _deadline.get()
+
+
+def remaining_time() -> typing.Optional[float]:
+    """Seconds left before the current request times out, None without a deadline.
+
+    Service functions can pass this on as the timeout of downstream calls.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+_request_cache: contextvars.ContextVar[typing.Optional[dict]] = contextvars.ContextVar(
+    "sstarlette_request_cache", default=None
+)
+
+
+def request_cache() -> typing.Optional[dict]:
+    """A dict that lives for the current request, None outside of one."""
+    return _request_cache.get()
+
+
+class RequestCacheMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _request_cache.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_cache.reset(token)
@@ -0,0 +1,169 @@
+import asyncio
+import base64
+import hashlib
+import json
+import time
+import typing
+
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+
+class MemoryStore:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.records: typing.Dict[str, typing.Tuple[float, dict]] = {}
+
+    async def get(self, key: str) -> typing.Optional[dict]:
+        value = self.records.get(key)
+        if value is None:
+            return None
+        expires, record = value
+        if time.monotonic() >= expires:
+            del self.records[key]
+            return None
+        return record
+
+    async def set(self, key: str, record: dict, ttl: float):
+        now = time.monotonic()
+        if len(self.records) >= self.max_keys:
+            self.records = {k: v for k, v in self.records.items() if v[0] > now}
+        self.records[key] = (now + ttl, record)
+
+
+class RedisStore:
+    """Records shared by all processes. `redis` is an aioredis connection or pool."""
+
+    def __init__(self, redis, prefix: str = "idempotency:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def get(self, key: str) -> typing.Optional[dict]:
+        value = await self.redis.get(self.prefix + key)
+        if value is None:
+            return None
+        record = json.loads(value)
+        record["body"] = base64.b64decode(record["body"])
+        return record
+
+    async def set(self, key: str, record: dict, ttl: float):
+        value = {**record, "body": base64.b64encode(record["body"]).decode()}
+        await self.redis.set(self.prefix + key, json.dumps(value), expire=int(ttl))
+
+
+class IdempotencyCache:
+    """Replays the response of a request retried with the same Idempotency-Key.
+
+    The first request with a key runs and its response is stored for `ttl`
+    seconds; background tasks are queued only by that first execution and
+    their outcome is replayed in the Idempotent-Tasks header. Retries that
+    arrive while it is running wait for it instead of running again. Server
+    errors and rate limited responses are not stored. Keys are scoped to the
+    route and the Authorization header or, for anonymous requests such as a
+    signup, to the body, so clients whose keys collide never share a response.
+    """
+
+    header = "Idempotency-Key"
+
+    def __init__(
+        self, store: typing.Union[MemoryStore, RedisStore] = None, ttl: float = 86400
+    ):
+        self.store = store or MemoryStore()
+        self.ttl = ttl
+        self.replayed = 0
+        self._in_flight: typing.Dict[str, asyncio.Future] = {}
+
+    async def scope(self, path: str, request: Request) -> typing.Optional[str]:
+        key = request.headers.get(self.header)
+        if not key:
+            return None
+        owner = request.headers.get("Authorization")
+        if not owner:
+            # only a client that sent the same body gets the stored response
+            owner = "body:" + hashlib.sha256(await request.body()).hexdigest()
+        return hashlib.sha256(f"{path}\0{owner}\0{key}".encode()).hexdigest()
+
+    def serialize(self, response: Response, fingerprint: str) -> dict:
+        background = getattr(response.background, "tasks", None)
+        if background is None and response.background is not None:
+            background = [response.background]
+        return {
+            "fingerprint": fingerprint,
+            "status_code": response.status_code,
+            "headers": [
+                [name, value]
+                for name, value in response.headers.items()
+                if name != "content-length"
+            ],
+            "body": response.body,
+            "tasks": {
+                "count": len(background or []),
+                "outcome": "pending" if background else "none",
+            },
+        }
+
+    def track_tasks(self, key: str, record: dict, response: Response):
+        """Stores how the response's background tasks ended once they ran."""
+        background = response.background
+        if background is None:
+            return
+
+        async def run_and_record():
+            outcome = "failed"
+            try:
+                await background()
+                outcome = "completed"
+            finally:
+                tasks = {**record["tasks"], "outcome": outcome}
+                await self.store.set(key, {**record, "tasks": tasks}, self.ttl)
+
+        response.background = BackgroundTask(run_and_record)
+
+    def replay(self, record: dict, fingerprint: str) -> Response:
+        if record["fingerprint"] != fingerprint:
+            return JSONResponse(
+                {"status": False, "msg": "Idempotency key reused with another body"},
+                status_code=422,
+            )
+        self.replayed += 1
+        response = Response(record["body"], status_code=record["status_code"])
+        for name, value in record["headers"]:
+            response.headers.append(name, value)
+        response.headers["Idempotent-Replayed"] = "true"
+        response.headers["Idempotent-Tasks"] = record["tasks"]["outcome"]
+        return response
+
+    async def run(
+        self,
+        key: str,
+        request: Request,
+        call: typing.Callable[[], typing.Awaitable[Response]],
+    ) -> Response:
+        fingerprint = hashlib.sha256(await request.body()).hexdigest()
+        record = await self.store.get(key)
+        if record is not None:
+            return self.replay(record, fingerprint)
+        if key in self._in_flight:
+            record = await asyncio.shield(self._in_flight[key])
+            if record is not None:
+                return self.replay(record, fingerprint)
+            return await call()
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        record = None
+        try:
+            response = await call()
+            # rejected or failed requests are left for the retry to redo
+            if (
+                response.status_code < 500
+                and response.status_code != 429
+                and hasattr(response, "body")
+            ):
+                record = self.serialize(response, fingerprint)
+                await self.store.set(key, record, self.ttl)
+                self.track_tasks(key, record, response)
+            return response
+        finally:
+            future.set_result(record)
+            del self._in_flight[key]
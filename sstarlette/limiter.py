@@ -0,0 +1,117 @@
+import asyncio
+import collections
+import time
+import typing
+
+PRIORITIES = ("high", "normal", "low")
+
+
+class AdaptiveLimiter:
+    """Adapts how many requests run at once to the latency they observe.
+
+    The limit grows by one per window of requests that finish within
+    `target_latency` and is multiplied by `backoff` when they get slower
+    (AIMD). Requests over the limit wait in priority order. A request is
+    rejected straight away when the expected wait already exceeds its
+    deadline, or after `max_queue_time` of waiting.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 20,
+        min_limit: int = 1,
+        max_limit: int = 500,
+        target_latency: float = 0.25,
+        backoff: float = 0.9,
+        max_queue_time: float = 1.0,
+        retry_after: int = 1,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.max_queue_time = max_queue_time
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.latency = target_latency
+        self.rejected: typing.Dict[str, int] = {x: 0 for x in PRIORITIES}
+        self._waiters: typing.Dict[str, typing.Deque[asyncio.Future]] = {
+            x: collections.deque() for x in PRIORITIES
+        }
+        self._last_decrease = 0.0
+
+    def _queued_ahead(self, priority: str) -> int:
+        ahead = 0
+        for name in PRIORITIES:
+            ahead += len(self._waiters[name])
+            if name == priority:
+                break
+        return ahead
+
+    async def acquire(
+        self, priority: str = "normal", budget: typing.Optional[float] = None
+    ) -> bool:
+        if priority not in self._waiters:
+            raise ValueError(f"Unknown priority {priority}")
+        if self.in_flight < int(self.limit) and not self._queued_ahead(priority):
+            self.in_flight += 1
+            return True
+        if budget is None or budget > self.max_queue_time:
+            budget = self.max_queue_time
+        expected_wait = (self._queued_ahead(priority) + 1) / self.limit * self.latency
+        if expected_wait > budget:
+            self.rejected[priority] += 1
+            return False
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), budget)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # the slot was handed over as the wait expired
+                return True
+            waiter.cancel()
+            self.rejected[priority] += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done():
+                self.in_flight -= 1
+                self._wake()
+            waiter.cancel()
+            raise
+        finally:
+            if waiter in self._waiters[priority]:
+                self._waiters[priority].remove(waiter)
+        return True
+
+    def release(self, latency: float):
+        self.latency = 0.9 * self.latency + 0.1 * latency
+        now = time.monotonic()
+        if latency > self.target_latency:
+            # decrease once per latency window, not once per slow request
+            if now - self._last_decrease > self.latency:
+                self._last_decrease = now
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters and self.in_flight < int(self.limit):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+
+    def snapshot(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "queued": {x: len(self._waiters[x]) for x in PRIORITIES},
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,130 @@
+import asyncio
+import bisect
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def find_route(frame) -> typing.Optional[str]:
+    # the ASGI scope of the request being served sits in an outer frame
+    while frame is not None:
+        scope = frame.f_locals.get("scope")
+        if isinstance(scope, dict) and scope.get("type") in ("http", "websocket"):
+            return f"{scope.get('method', 'WS')} {scope.get('path')}"
+        frame = frame.f_back
+    return None
+
+
+class LoopLagMonitor:
+    """Samples event loop lag and reports what was blocking the loop.
+
+    A coroutine wakes every `interval` seconds and records how late it woke
+    in a histogram. A watchdog thread notices when the loop has not woken for
+    longer than `threshold`, then captures the loop thread's stack together
+    with the route of the request that owns it.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.05,
+        threshold: float = 0.1,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+        max_reports: int = 100,
+        on_block: typing.Callable[[dict], None] = None,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.reports: typing.Deque[dict] = collections.deque(maxlen=max_reports)
+        self.on_block = on_block
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: typing.Optional[int] = None
+        self._sampler: typing.Optional[asyncio.Future] = None
+        self._watchdog: typing.Optional[threading.Thread] = None
+        self._running = False
+
+    def record(self, lag: float):
+        self.counts[bisect.bisect_left(self.buckets, lag)] += 1
+        self.samples += 1
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def snapshot(self) -> dict:
+        histogram = {str(le): count for le, count in zip(self.buckets, self.counts)}
+        histogram["+Inf"] = self.counts[-1]
+        return {
+            "samples": self.samples,
+            "mean": self.total_lag / self.samples if self.samples else 0.0,
+            "max": self.max_lag,
+            "histogram": histogram,
+            "blocks": list(self.reports),
+        }
+
+    async def _sample(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.record(max(0.0, now - self._heartbeat - self.interval))
+            self._heartbeat = now
+
+    def _capture(self, stalled_for: float):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        report = {
+            "lag": stalled_for,
+            "route": find_route(frame),
+            "stack": "".join(traceback.format_stack(frame)),
+        }
+        del frame
+        self.reports.append(report)
+        logger.warning(
+            "Event loop blocked for %.3fs while serving %s\n%s",
+            stalled_for,
+            report["route"],
+            report["stack"],
+        )
+        if self.on_block:
+            self.on_block(report)
+
+    def _watch(self):
+        captured_beat = None
+        while self._running:
+            time.sleep(self.threshold / 4)
+            beat = self._heartbeat
+            stalled_for = time.monotonic() - beat - self.interval
+            # one capture per stall, taken while the blocking frame is live
+            if stalled_for > self.threshold and beat != captured_beat:
+                captured_beat = beat
+                self._capture(stalled_for)
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._sampler = asyncio.ensure_future(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-lag-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self):
+        self._running = False
+        if self._sampler and not self._sampler.done():
+            self._sampler.cancel()
+        self._sampler = None
+        self._watchdog = None
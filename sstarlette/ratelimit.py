@@ -0,0 +1,185 @@
+import ipaddress
+import math
+import time
+import typing
+
+from starlette.requests import Request
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+
+class Rate(typing.NamedTuple):
+    capacity: float
+    refill_rate: float
+
+
+def parse_rate(value: typing.Union[str, Rate, tuple]) -> Rate:
+    """"5/minute" allows bursts of 5 and refills one token every 12 seconds."""
+    if isinstance(value, tuple):
+        return Rate(*value)
+    count, _, period = value.partition("/")
+    return Rate(float(count), float(count) / PERIODS[period.strip().rstrip("s")])
+
+
+class MemoryBackend:
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated, seconds until the bucket is full again)
+        self.buckets: typing.Dict[str, typing.Tuple[float, float, float]] = {}
+
+    def _prune(self, now: float):
+        # a bucket that has refilled completely is the same as no bucket
+        self.buckets = {
+            key: value
+            for key, value in self.buckets.items()
+            if now - value[1] < value[2]
+        }
+
+    async def take(self, key: str, rate: Rate) -> typing.Tuple[bool, float]:
+        now = time.monotonic()
+        full_after = rate.capacity / rate.refill_rate
+        tokens, updated, _ = self.buckets.get(key, (rate.capacity, now, full_after))
+        tokens = min(rate.capacity, tokens + (now - updated) * rate.refill_rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now, full_after)
+            return False, (1 - tokens) / rate.refill_rate
+        if key not in self.buckets and len(self.buckets) >= self.max_keys:
+            self._prune(now)
+        self.buckets[key] = (tokens - 1, now, full_after)
+        return True, 0.0
+
+
+TAKE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * refill_rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisBackend:
+    """Buckets shared by all processes, updated atomically by a Lua script.
+
+    `redis` is an aioredis connection or pool.
+    """
+
+    def __init__(self, redis, prefix: str = "ratelimit:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: Rate) -> typing.Tuple[bool, float]:
+        allowed, tokens = await self.redis.eval(
+            TAKE_SCRIPT,
+            keys=[self.prefix + key],
+            args=[rate.capacity, rate.refill_rate, time.time()],
+        )
+        if allowed:
+            return True, 0.0
+        return False, (1 - float(tokens)) / rate.refill_rate
+
+
+def client_ip(request: Request, post_data: typing.Optional[dict]):
+    return request.client.host if request.client else None
+
+
+def forwarded_ip(trusted_proxies: typing.Iterable[str]) -> typing.Callable:
+    """An "ip" key that reads X-Forwarded-For behind the given proxies.
+
+    Addresses are taken from the right of the header until one is not a
+    trusted proxy, since anything to its left was sent by the client.
+    """
+    networks = [ipaddress.ip_network(x, strict=False) for x in trusted_proxies]
+
+    def is_trusted(address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in networks)
+
+    def key(request: Request, post_data: typing.Optional[dict]):
+        address = client_ip(request, post_data)
+        if address is None or not is_trusted(address):
+            return address
+        forwarded = request.headers.get("X-Forwarded-For") or ""
+        for value in reversed([x.strip() for x in forwarded.split(",") if x.strip()]):
+            address = value
+            if not is_trusted(value):
+                break
+        return address
+
+    return key
+
+
+def email_key(request: Request, post_data: typing.Optional[dict]):
+    email = (post_data or {}).get("email") or request.query_params.get("email")
+    return email.strip().lower() if isinstance(email, str) and email else None
+
+
+def provider_key(request: Request, post_data: typing.Optional[dict]):
+    post_data = post_data or {}
+    info = post_data.get("login_info") or post_data.get("signup_info") or {}
+    return info.get("provider") if isinstance(info, dict) else None
+
+
+KEY_FUNCTIONS = {"ip": client_ip, "email": email_key, "provider": provider_key}
+# keys that can be checked before the request body is read
+PRE_BODY_KEYS = {"ip"}
+
+
+class RateLimiter:
+    """Token bucket limits per route and per key.
+
+    A route's rules map a key name ("ip", "email", "provider" or one added
+    through `key_functions`) to a rate such as "5/minute". Behind a proxy or
+    load balancer pass its addresses as `trusted_proxies`, or every client
+    shares the proxy's "ip" bucket.
+    """
+
+    def __init__(
+        self,
+        backend: typing.Union[MemoryBackend, RedisBackend] = None,
+        key_functions: typing.Dict[str, typing.Callable] = None,
+        trusted_proxies: typing.Iterable[str] = None,
+    ):
+        self.backend = backend or MemoryBackend()
+        self.key_functions = dict(KEY_FUNCTIONS)
+        if trusted_proxies:
+            self.key_functions["ip"] = forwarded_ip(trusted_proxies)
+        self.key_functions.update(key_functions or {})
+        self.rejected: typing.Dict[str, int] = {}
+
+    async def check(
+        self,
+        path: str,
+        rules: typing.Dict[str, typing.Union[str, Rate]],
+        request: Request,
+        post_data: dict = None,
+        body_parsed: bool = False,
+    ) -> typing.Optional[int]:
+        """Returns the seconds to wait when the request is over a limit."""
+        for name, rate in rules.items():
+            if (name in PRE_BODY_KEYS) == body_parsed:
+                continue
+            value = self.key_functions[name](request, post_data)
+            if value is None:
+                continue
+            allowed, retry_after = await self.backend.take(
+                f"{path}:{name}:{value}", parse_rate(rate)
+            )
+            if not allowed:
+                rule = f"{path}:{name}"
+                self.rejected[rule] = self.rejected.get(rule, 0) + 1
+                return max(1, math.ceil(retry_after))
+        return None
@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import logging
+import time
+import typing
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float = 0):
+        super().__init__(name)
+        self.retry_after = retry_after
+
+
+class BulkheadFullError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops calling a failing dependency until it has had time to recover.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    are rejected for `recovery_timeout` seconds. Then up to
+    `half_open_max_calls` probes are let through: one success closes the
+    circuit again, one failure reopens it.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        half_open_max_calls: int = 1,
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+        self._probes = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at >= self.recovery_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes < self.half_open_max_calls:
+            self._probes += 1
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probes = 0
+
+    def release_probe(self):
+        # a probe that ended without an outcome must not keep its slot
+        if self._probes:
+            self._probes -= 1
+
+    @property
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0
+        return max(self.recovery_timeout - (time.monotonic() - self.opened_at), 0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._probes = 0
+
+
+class Bulkhead:
+    """Caps how many calls to one dependency can be in flight at once."""
+
+    def __init__(self, max_concurrency: int = 100, max_wait: float = 0):
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.active = 0
+        self._semaphore: typing.Optional[asyncio.Semaphore] = None
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and not self.max_wait:
+            raise BulkheadFullError()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.max_wait or None)
+        except asyncio.TimeoutError:
+            raise BulkheadFullError()
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+
+def is_async_callable(func) -> bool:
+    # callable instances, like NotificationDispatcher, have an async __call__
+    return asyncio.iscoroutinefunction(func) or asyncio.iscoroutinefunction(
+        getattr(func, "__call__", None)
+    )
+
+
+class HookMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.fallbacks = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "rejected": self.rejected,
+            "fallbacks": self.fallbacks,
+        }
+
+
+class GuardedHook:
+    """Calls a hook behind a bulkhead and a circuit breaker.
+
+    `func` is swapped for whatever the utils currently return, so the breaker
+    state survives `build_utils()` handing out new function objects. Sync
+    hooks run in the threadpool. The bulkhead is only used when
+    `max_concurrency` is set, and never lets fewer calls through than a
+    batching hook's `max_batch`, since those calls wait for their batch
+    together. When the call is rejected or fails, `fallback` is used if one
+    was configured: a callable gets the hook's arguments, anything else is
+    returned as is.
+    """
+
+    _missing = object()
+
+    def __init__(
+        self,
+        name: str,
+        func: typing.Callable[..., typing.Awaitable],
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+        half_open_max_calls: int = 1,
+        max_concurrency: typing.Optional[int] = None,
+        max_wait: float = 0,
+        timeout: typing.Optional[float] = None,
+        fallback: typing.Any = _missing,
+    ):
+        self.name = name
+        self.func = func
+        self.timeout = timeout
+        self.fallback = fallback
+        self.breaker = CircuitBreaker(
+            failure_threshold, recovery_timeout, half_open_max_calls
+        )
+        self.bulkhead: typing.Optional[Bulkhead] = None
+        if max_concurrency:
+            max_batch = getattr(func, "max_batch", 0)
+            self.bulkhead = Bulkhead(max(max_concurrency, max_batch), max_wait)
+        self.metrics = HookMetrics()
+
+    async def _fallback(self, error: Exception, args, kwargs):
+        if self.fallback is self._missing:
+            raise error
+        self.metrics.fallbacks += 1
+        if not callable(self.fallback):
+            return self.fallback
+        result = self.fallback(*args, **kwargs)
+        if asyncio.iscoroutine(result):
+            return await result
+        return result
+
+    async def _call(self, args, kwargs):
+        if is_async_callable(self.func):
+            return await self.func(*args, **kwargs)
+        result = await run_in_threadpool(self.func, *args, **kwargs)
+        if asyncio.iscoroutine(result):
+            return await result
+        return result
+
+    async def __call__(self, *args, **kwargs):
+        self.metrics.calls += 1
+        if not self.breaker.allow():
+            self.metrics.rejected += 1
+            error = CircuitOpenError(self.name, self.breaker.retry_after)
+            return await self._fallback(error, args, kwargs)
+        if self.bulkhead:
+            try:
+                await self.bulkhead.acquire()
+            except BulkheadFullError as e:
+                self.breaker.release_probe()
+                self.metrics.rejected += 1
+                return await self._fallback(e, args, kwargs)
+        try:
+            try:
+                result = await asyncio.wait_for(self._call(args, kwargs), self.timeout)
+            finally:
+                if self.bulkhead:
+                    self.bulkhead.release()
+        except Exception as e:
+            self.metrics.failures += 1
+            self.breaker.record_failure()
+            logger.warning("Hook %s failed: %r", self.name, e)
+            return await self._fallback(e, args, kwargs)
+        except BaseException:
+            # cancelled, e.g. by a request deadline, says nothing of the hook
+            self.breaker.release_probe()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.failures,
+            "in_flight": self.bulkhead.active if self.bulkhead else None,
+            **self.metrics.as_dict(),
+        }
+
+
+class HookGuard:
+    """Hands out one guarded coroutine function per hook name.
+
+    Only hooks with a policy are guarded: `policies` maps hook names to
+    `GuardedHook` options, with a "default" entry applying to hooks that are
+    not listed. Hooks in `no_fallback` guard logins and signups, so their
+    failures always raise: a fallback of their own is refused and the
+    default one is not applied to them.
+    """
+
+    no_fallback = ("provider_verification",)
+
+    def __init__(self, policies: typing.Dict[str, dict] = None):
+        self.policies = policies or {}
+        for name in self.no_fallback:
+            if "fallback" in self.policies.get(name, {}):
+                raise ValueError(f"{name} can not have a fallback")
+        self.hooks: typing.Dict[str, GuardedHook] = {}
+        self._wrappers: typing.Dict[str, typing.Callable[..., typing.Awaitable]] = {}
+
+    def wrap(
+        self, name: str, func: typing.Optional[typing.Callable[..., typing.Awaitable]]
+    ) -> typing.Optional[typing.Callable[..., typing.Awaitable]]:
+        if func is None:
+            return None
+        wrapper = self._wrappers.get(name)
+        if wrapper is None:
+            policy = self.policy_for(name)
+            if policy is None:
+                return func
+            hook = self.hooks[name] = GuardedHook(name, func, **policy)
+
+            # a plain coroutine function so background task runners await it
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await hook(*args, **kwargs)
+
+            self._wrappers[name] = wrapper
+        self.hooks[name].func = wrapper.__wrapped__ = func
+        return wrapper
+
+    def policy_for(self, name: str) -> typing.Optional[dict]:
+        policy = self.policies.get(name, self.policies.get("default"))
+        if policy is not None and name in self.no_fallback:
+            policy = {k: v for k, v in policy.items() if k != "fallback"}
+        return policy
+
+    def snapshot(self) -> dict:
+        return {name: hook.snapshot() for name, hook in self.hooks.items()}
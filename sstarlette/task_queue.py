@@ -0,0 +1,333 @@
+import asyncio
+import importlib
+import json
+import logging
+import sqlite3
+import sys
+import threading
+import time
+import typing
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# arguments can carry tokens, so dead jobs only keep their name and error
+SCRUBBED_PAYLOAD = '{"scrubbed": true}'
+
+
+class Job(typing.NamedTuple):
+    id: int
+    name: str
+    payload: str
+    attempts: int
+
+
+class SQLiteBackend:
+    def __init__(self, path: str, table_name: str = "task_queue"):
+        self.path = path
+        self.table_name = table_name
+        self._connection: typing.Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _execute(self, callback):
+        with self._lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(
+                    self.path, check_same_thread=False, isolation_level=None
+                )
+            return callback(self._connection)
+
+    async def setup(self):
+        def create(connection):
+            connection.execute(
+                f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    run_at REAL NOT NULL,
+                    last_error TEXT
+                )"""
+            )
+            connection.execute(
+                f"""CREATE INDEX IF NOT EXISTS {self.table_name}_ready_idx
+                ON {self.table_name} (status, run_at)"""
+            )
+
+        await run_in_threadpool(self._execute, create)
+
+    async def enqueue(self, name: str, payload: str, run_at: float):
+        await run_in_threadpool(
+            self._execute,
+            lambda connection: connection.execute(
+                f"""INSERT INTO {self.table_name} (name, payload, run_at)
+                VALUES (?, ?, ?)""",
+                (name, payload, run_at),
+            ),
+        )
+
+    async def claim(self, limit: int, now: float, lease: float) -> typing.List[Job]:
+        def claim(connection):
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                rows = connection.execute(
+                    f"""SELECT id, name, payload, attempts FROM {self.table_name}
+                    WHERE status IN ('pending', 'running') AND run_at <= ?
+                    ORDER BY run_at LIMIT ?""",
+                    (now, limit),
+                ).fetchall()
+                # the lease makes jobs of a crashed worker claimable again
+                connection.executemany(
+                    f"""UPDATE {self.table_name}
+                    SET status = 'running', attempts = attempts + 1, run_at = ?
+                    WHERE id = ?""",
+                    [(now + lease, row[0]) for row in rows],
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            return [Job(row[0], row[1], row[2], row[3] + 1) for row in rows]
+
+        return await run_in_threadpool(self._execute, claim)
+
+    async def complete(self, job_id: int):
+        await run_in_threadpool(
+            self._execute,
+            lambda connection: connection.execute(
+                f"DELETE FROM {self.table_name} WHERE id = ?", (job_id,)
+            ),
+        )
+
+    async def fail(self, job_id: int, error: str, run_at: typing.Optional[float]):
+        status = "pending" if run_at is not None else "dead"
+        payload = SCRUBBED_PAYLOAD if run_at is None else None
+        await run_in_threadpool(
+            self._execute,
+            lambda connection: connection.execute(
+                f"""UPDATE {self.table_name}
+                SET status = ?, last_error = ?, run_at = COALESCE(?, run_at),
+                    payload = COALESCE(?, payload)
+                WHERE id = ?""",
+                (status, error, run_at, payload, job_id),
+            ),
+        )
+
+    async def close(self):
+        if self._connection is not None:
+            self._execute(lambda connection: connection.close())
+            self._connection = None
+
+
+class PostgresBackend:
+    def __init__(self, database, table_name: str = "task_queue"):
+        self.database = database
+        self.table_name = table_name
+
+    async def setup(self):
+        await self.database.execute(
+            query=f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                id BIGSERIAL PRIMARY KEY,
+                name TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status VARCHAR(10) NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                run_at DOUBLE PRECISION NOT NULL,
+                last_error TEXT
+            )"""
+        )
+        await self.database.execute(
+            query=f"""CREATE INDEX IF NOT EXISTS {self.table_name}_ready_idx
+            ON {self.table_name} (status, run_at)"""
+        )
+
+    async def enqueue(self, name: str, payload: str, run_at: float):
+        await self.database.execute(
+            query=f"""INSERT INTO {self.table_name} (name, payload, run_at)
+            VALUES (:name, :payload, :run_at)""",
+            values={"name": name, "payload": payload, "run_at": run_at},
+        )
+
+    async def claim(self, limit: int, now: float, lease: float) -> typing.List[Job]:
+        records = await self.database.fetch_all(
+            query=f"""UPDATE {self.table_name}
+            SET status = 'running', attempts = attempts + 1, run_at = :lease
+            WHERE id IN (
+                SELECT id FROM {self.table_name}
+                WHERE status IN ('pending', 'running') AND run_at <= :now
+                ORDER BY run_at LIMIT :limit FOR UPDATE SKIP LOCKED
+            ) RETURNING id, name, payload, attempts""",
+            values={"now": now, "lease": now + lease, "limit": limit},
+        )
+        return [Job(x["id"], x["name"], x["payload"], x["attempts"]) for x in records]
+
+    async def complete(self, job_id: int):
+        await self.database.execute(
+            query=f"DELETE FROM {self.table_name} WHERE id = :id", values={"id": job_id}
+        )
+
+    async def fail(self, job_id: int, error: str, run_at: typing.Optional[float]):
+        await self.database.execute(
+            query=f"""UPDATE {self.table_name}
+            SET status = :status, last_error = :error,
+                run_at = COALESCE(:run_at, run_at),
+                payload = COALESCE(:payload, payload)
+            WHERE id = :id""",
+            values={
+                "id": job_id,
+                "error": error,
+                "run_at": run_at,
+                "status": "pending" if run_at is not None else "dead",
+                "payload": SCRUBBED_PAYLOAD if run_at is None else None,
+            },
+        )
+
+    async def close(self):
+        pass
+
+
+def resolve(name: str) -> typing.Callable:
+    module_name, _, qualname = name.partition(":")
+    value = importlib.import_module(module_name)
+    for attribute in qualname.split("."):
+        value = getattr(value, attribute)
+    return value
+
+
+class DurableTaskQueue:
+    """Persists `SResult.task` entries so a separate worker can run them.
+
+    Only tasks that can be found again by name are persisted: functions added
+    with `register()` or importable module level functions, called with JSON
+    serializable arguments. Anything else keeps running in-process. Failed
+    jobs are retried with exponential backoff and marked dead after
+    `max_attempts`. Completed jobs are deleted and dead jobs lose their
+    arguments, so tokens passed to a task do not outlive it. Sync functions
+    run in the threadpool.
+    """
+
+    def __init__(
+        self,
+        backend: typing.Union[SQLiteBackend, PostgresBackend],
+        max_attempts: int = 5,
+        backoff: float = 2,
+        max_backoff: float = 300,
+        batch_size: int = 20,
+        lease: float = 60,
+        timeout: typing.Optional[float] = 30,
+    ):
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.lease = lease
+        self.timeout = timeout
+        self.registry: typing.Dict[str, typing.Callable] = {}
+
+    def register(self, func: typing.Callable = None, name: str = None):
+        def decorator(func):
+            self.registry[name or f"{func.__module__}:{func.__qualname__}"] = func
+            return func
+
+        if func is None:
+            return decorator
+        return decorator(func)
+
+    def name_for(self, func: typing.Callable) -> typing.Optional[str]:
+        # guarded hooks are persisted as the hook they wrap
+        func = getattr(func, "__wrapped__", func)
+        for name, value in self.registry.items():
+            if value is func:
+                return name
+        module = getattr(func, "__module__", None)
+        qualname = getattr(func, "__qualname__", None)
+        if not module or not qualname or "<" in qualname:
+            return None
+        name = f"{module}:{qualname}"
+        try:
+            if resolve(name) is not func:
+                return None
+        except (ImportError, AttributeError):
+            return None
+        return name
+
+    def get(self, name: str) -> typing.Callable:
+        if name in self.registry:
+            return self.registry[name]
+        return resolve(name)
+
+    async def setup(self):
+        await self.backend.setup()
+
+    async def enqueue(self, func: typing.Callable, *args, **kwargs) -> bool:
+        """Returns False when the task can not be persisted."""
+        name = self.name_for(func)
+        if not name:
+            return False
+        try:
+            payload = json.dumps({"args": args, "kwargs": kwargs})
+        except (TypeError, ValueError):
+            return False
+        await self.backend.enqueue(name, payload, time.time())
+        return True
+
+    async def _execute(self, job: Job):
+        # a job that keeps killing its worker is only seen through the lease
+        if job.attempts > self.max_attempts:
+            await self.backend.fail(job.id, "Exceeded max attempts", None)
+            return
+        try:
+            func = self.get(job.name)
+            payload = json.loads(job.payload)
+            args, kwargs = payload["args"], payload["kwargs"]
+            if asyncio.iscoroutinefunction(func):
+                result = await asyncio.wait_for(func(*args, **kwargs), self.timeout)
+            else:
+                # a sync task would block every other job on the loop
+                result = await asyncio.wait_for(
+                    run_in_threadpool(func, *args, **kwargs), self.timeout
+                )
+            if asyncio.iscoroutine(result):
+                await asyncio.wait_for(result, self.timeout)
+        except Exception as e:
+            run_at = None
+            if job.attempts < self.max_attempts:
+                delay = min(self.max_backoff, self.backoff ** job.attempts)
+                run_at = time.time() + delay
+            logger.exception("Task %s failed on attempt %s", job.name, job.attempts)
+            await self.backend.fail(job.id, repr(e), run_at)
+        else:
+            await self.backend.complete(job.id)
+
+    async def run_once(self) -> int:
+        jobs = await self.backend.claim(self.batch_size, time.time(), self.lease)
+        await asyncio.gather(*[self._execute(job) for job in jobs])
+        return len(jobs)
+
+    async def run_worker(self, poll_interval: float = 1):
+        await self.setup()
+        while True:
+            # keep draining while there is work, poll when the queue is empty
+            if not await self.run_once():
+                await asyncio.sleep(poll_interval)
+
+
+async def run_worker(queue: DurableTaskQueue, poll_interval: float = 1):
+    database = getattr(queue.backend, "database", None)
+    if database is not None and not database.is_connected:
+        await database.connect()
+    try:
+        await queue.run_worker(poll_interval=poll_interval)
+    finally:
+        await queue.backend.close()
+        if database is not None and database.is_connected:
+            await database.disconnect()
+
+
+if __name__ == "__main__":
+    # python -m sstarlette.task_queue package.module:queue
+    queue = resolve(sys.argv[1])
+    asyncio.get_event_loop().run_until_complete(run_worker(queue))
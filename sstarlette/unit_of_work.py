@@ -0,0 +1,87 @@
+import contextvars
+import copy
+import typing
+
+_current: contextvars.ContextVar[
+    typing.Optional["UnitOfWork"]
+] = contextvars.ContextVar("sstarlette_unit_of_work", default=None)
+
+
+def current_unit_of_work() -> typing.Optional["UnitOfWork"]:
+    return _current.get()
+
+
+def _plain(value):
+    if hasattr(value, "get_secret_value"):
+        return value.get_secret_value()
+    return value
+
+
+def _state(instance) -> dict:
+    return {key: _plain(value) for key, value in instance.dict().items()}
+
+
+class UnitOfWork:
+    """Runs a service call in one transaction with its saves deferred to commit.
+
+    `databases` binds the transaction's connection to the running task, so
+    every query the call awaits goes through that one connection; work
+    handed to other tasks, like a batched lookup, is outside of it. Instances
+    passed to `track()` are snapshotted when loaded; those passed to
+    `save_later()` are written once at commit, and only when a field differs
+    from the snapshot. Instances with `save_fields(fields)` write just the
+    changed fields, others are saved whole. Errors, and results carrying
+    `errors`, roll back.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._snapshots: typing.Dict[int, typing.Tuple[typing.Any, dict]] = {}
+        self._pending: typing.Dict[int, typing.Any] = {}
+
+    def track(self, instance):
+        if id(instance) not in self._snapshots and hasattr(instance, "dict"):
+            self._snapshots[id(instance)] = (instance, copy.deepcopy(_state(instance)))
+
+    def save_later(self, instance):
+        self._pending[id(instance)] = instance
+
+    def dirty_fields(self, instance) -> typing.Set[str]:
+        state = _state(instance)
+        if id(instance) not in self._snapshots:
+            return set(state)
+        _, snapshot = self._snapshots[id(instance)]
+        return {key for key, value in state.items() if snapshot.get(key) != value}
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for instance in pending.values():
+            fields = self.dirty_fields(instance)
+            if not fields:
+                continue
+            save_fields = getattr(instance, "save_fields", None)
+            # without a snapshot every field counts as changed
+            if save_fields is not None and id(instance) in self._snapshots:
+                await save_fields(fields)
+            else:
+                await instance.save()
+            self._snapshots[id(instance)] = (instance, copy.deepcopy(_state(instance)))
+
+    async def run(self, coroutine: typing.Awaitable):
+        token = _current.set(self)
+        transaction = self.database.transaction()
+        await transaction.start()
+        try:
+            result = await coroutine
+            if getattr(result, "errors", None):
+                await transaction.rollback()
+                return result
+            await self.flush()
+        except BaseException:
+            await transaction.rollback()
+            raise
+        else:
+            await transaction.commit()
+            return result
+        finally:
+            _current.reset(token)
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from sstarlette.background import TaskScheduler, task_name
+
+
+@pytest.mark.run_loop
+async def test_scheduler_bounds_concurrency_and_times_out():
+    scheduler = TaskScheduler(max_concurrency=2, max_queue=10, timeout=0.05)
+    scheduler.start()
+    running = []
+    peak = []
+
+    async def send_mail(email):
+        running.append(email)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(email)
+
+    async def hang():
+        await asyncio.sleep(1)
+
+    for i in range(6):
+        assert scheduler.schedule(send_mail, f"user{i}@example.com")
+    assert scheduler.schedule(hang)
+    await scheduler.stop()
+    assert max(peak) == 2
+    metrics = scheduler.snapshot()["tasks"]
+    assert metrics[task_name(send_mail)]["completed"] == 6
+    assert metrics[task_name(hang)]["timed_out"] == 1
+
+
+@pytest.mark.run_loop
+async def test_scheduler_overflow_policies():
+    async def noop():
+        pass
+
+    deferring = TaskScheduler(max_concurrency=1, max_queue=1)
+    shedding = TaskScheduler(max_concurrency=1, max_queue=1, overflow="shed")
+    for scheduler in (deferring, shedding):
+        scheduler.start()
+        assert scheduler.schedule(noop)
+    # the queue is full until the workers get a turn on the loop
+    assert not deferring.schedule(noop)
+    assert shedding.schedule(noop)
+    assert deferring.metrics[task_name(noop)].deferred == 1
+    assert shedding.metrics[task_name(noop)].shed == 1
+    await deferring.stop()
+    await shedding.stop()
@@ -0,0 +1,279 @@
+import contextlib
+import datetime
+import json
+import sqlite3
+
+import httpx
+import pytest
+
+from sstarlette.authentication import (
+    BulkImporter,
+    UserExporter,
+    build_abstract_user,
+    build_service_layer,
+)
+from sstarlette.authentication.service_layer import build_view
+from sstarlette.base import SStarlette
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+class Model:
+    @classmethod
+    def validate_model(cls, **kwargs):
+        if "@" not in kwargs.get("email", ""):
+            return {"email": ["value_error.email"]}
+        return None
+
+    @classmethod
+    def with_defaults(cls, kwargs):
+        now = datetime.datetime.now()
+        return {"created": now, "modified": now, **kwargs}
+
+
+class User(Model, build_abstract_user(Settings)):
+    async def get_permissions(self):
+        return [Permission("export users")] if self.is_staff else []
+
+
+class Permission:
+    def __init__(self, name):
+        self.name = name
+
+
+class URL:
+    dialect = "sqlite"
+
+
+class Database:
+    url = URL()
+
+    def __init__(self, emails=(), hidden=()):
+        self.emails = list(emails)
+        self.inserted = []
+        # taken by another request after the importer checked for them
+        self.hidden = set(hidden)
+
+    async def fetch_all(self, query, values):
+        # the importer looks emails up by lower(email)
+        return [
+            {"id": i, "email": x}
+            for i, x in enumerate(self.emails, 1)
+            if x.lower() in values.values() and x not in self.hidden
+        ]
+
+    async def execute(self, query, values):
+        if values["email"] in self.emails:
+            raise sqlite3.IntegrityError("UNIQUE constraint failed: users.email")
+        self.emails.append(values["email"])
+        self.inserted.append(values)
+
+    async def execute_many(self, query, values):
+        for value in values:
+            await self.execute(query, value)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        emails = list(self.emails)
+        try:
+            yield
+        except Exception:
+            self.emails = emails
+            raise
+
+
+async def run_import(importer, rows):
+    return [x async for x in importer.run(rows)]
+
+
+@pytest.mark.run_loop
+async def test_import_reports_invalid_and_duplicate_rows():
+    database = Database(emails=["taken@example.com"])
+    importer = BulkImporter(User, database, batch_size=2)
+    progress = await run_import(
+        importer,
+        [
+            {"full_name": "A", "email": "a@example.com", "password": "password"},
+            {"full_name": "B", "email": "not an email"},
+            {"full_name": "A", "email": "A@example.com"},
+            {"full_name": "T", "email": "taken@example.com"},
+            "not a row",
+        ],
+    )
+    assert [(x["processed"], x["imported"]) for x in progress] == [
+        (2, 1),
+        (4, 1),
+        (5, 1),
+    ]
+    errors = [x for entry in progress for x in entry["errors"]]
+    assert errors == [
+        {"row": 1, "errors": {"email": ["value_error.email"]}},
+        {"row": 2, "errors": {"email": ["value_error.duplicate"]}},
+        {"row": 3, "errors": {"email": ["value_error.duplicate"]}},
+        {"row": 4, "errors": {"row": ["type_error.dict"]}},
+    ]
+    assert database.emails == ["taken@example.com", "a@example.com"]
+
+
+@pytest.mark.run_loop
+async def test_rows_taken_during_the_import_fall_back_to_single_inserts():
+    database = Database(emails=["late@example.com"], hidden=["late@example.com"])
+    importer = BulkImporter(User, database)
+    progress = await run_import(
+        importer,
+        [
+            {"full_name": "A", "email": "a@example.com"},
+            {"full_name": "L", "email": "late@example.com"},
+            {"full_name": "B", "email": "b@example.com"},
+        ],
+    )
+    assert progress[0]["imported"] == 2
+    assert progress[0]["errors"] == [
+        {"row": 1, "errors": {"email": ["value_error.duplicate"]}}
+    ]
+    assert database.emails == ["late@example.com", "a@example.com", "b@example.com"]
+
+
+class Projection:
+    def __init__(self):
+        self.synced = []
+
+    async def upsert_many(self, users):
+        self.synced.extend((x.id, x.email) for x in users)
+
+
+@pytest.mark.run_loop
+async def test_imported_users_are_added_to_the_projection():
+    projection = Projection()
+
+    class ProjectedUser(
+        Model, build_abstract_user(Settings, principal_projection=projection)
+    ):
+        id: int = None
+
+    database = Database(emails=["taken@example.com"])
+    importer = BulkImporter(ProjectedUser, database)
+    progress = await run_import(
+        importer,
+        [
+            {"full_name": "A", "email": "a@example.com"},
+            # emails differing only in case are the same account
+            {"full_name": "T", "email": "Taken@example.com"},
+            {"full_name": "B", "email": "b@example.com"},
+        ],
+    )
+    assert progress[0]["imported"] == 2
+    assert progress[0]["errors"] == [
+        {"row": 1, "errors": {"email": ["value_error.duplicate"]}}
+    ]
+    assert projection.synced == [(2, "a@example.com"), (3, "b@example.com")]
+
+
+@pytest.mark.run_loop
+async def test_staff_imports_can_not_grant_roles():
+    staff = User(
+        **User.with_defaults(
+            {"full_name": "S", "email": "staff@example.com", "roles": ["Staff"]}
+        )
+    )
+    database = Database()
+
+    class Util:
+        klass = User
+        user_importer = BulkImporter(User, database)
+
+        @staticmethod
+        async def get_user(email):
+            return staff
+
+    service_layer = build_service_layer(Settings, Util, lambda: {})
+    app = SStarlette(
+        auth_token_verify_user_callback=service_layer["verify-access-token"],
+        service_layer=build_view(service_layer),
+    )
+    rows = [
+        {"full_name": "A", "email": "a@example.com", "roles": ["admin"]},
+        {"full_name": "B", "email": "b@example.com", "signup_info": {"verified": 1}},
+        {"full_name": "C", "email": "c@example.com"},
+    ]
+    headers = {"Authorization": f"Bearer {await staff.generate_access_token()}"}
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.post(
+            "/import-users", json={"users": rows}, headers=headers
+        )
+    [progress] = [json.loads(x) for x in response.text.splitlines()]
+    assert progress["imported"] == 1
+    assert progress["errors"] == [
+        {"row": 0, "errors": {"roles": ["value_error.not_allowed"]}},
+        {"row": 1, "errors": {"signup_info": ["value_error.not_allowed"]}},
+    ]
+    assert database.emails == ["c@example.com"]
+    assert json.loads(database.inserted[0]["roles"]) == []
+    assert json.loads(database.inserted[0]["signup_info"]) == {"verified": False}
+
+
+class ExportDatabase:
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    async def iterate(self, query):
+        self.queries.append(query)
+        for record in self.records:
+            yield record
+
+
+@pytest.mark.run_loop
+async def test_export_is_streamed_to_staff():
+    users = {
+        x: User(**User.with_defaults({"full_name": "A", "email": x, "roles": roles}))
+        for x, roles in [("staff@example.com", ["Staff"]), ("a@example.com", [])]
+    }
+    records = [
+        {"id": i, "email": f"user{i}@example.com", "roles": '["Tutor"]'}
+        for i in range(1, 4)
+    ]
+    database = ExportDatabase(records)
+
+    class Util:
+        klass = User
+        user_exporter = UserExporter(User, database, chunk_size=2)
+
+        @staticmethod
+        async def get_user(email):
+            return users[email]
+
+    service_layer = build_service_layer(Settings, Util, lambda: {})
+    app = SStarlette(
+        auth_token_verify_user_callback=service_layer["verify-access-token"],
+        service_layer=build_view(service_layer),
+    )
+    staff_token = await users["staff@example.com"].generate_access_token()
+    client_token = await users["a@example.com"].generate_access_token()
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get(
+            "/export-users", headers={"Authorization": f"Bearer {client_token}"}
+        )
+        assert response.status_code == 403
+        staff = {"Authorization": f"Bearer {staff_token}"}
+        response = await client.get("/export-users?columns=id,password", headers=staff)
+        assert response.status_code == 400
+        response = await client.get("/export-users?columns=email,roles", headers=staff)
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        assert [json.loads(x) for x in response.text.splitlines()] == [
+            {"email": f"user{i}@example.com", "roles": ["Tutor"]} for i in range(1, 4)
+        ]
+        response = await client.get(
+            "/export-users?columns=id,roles&format=csv", headers=staff
+        )
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text.splitlines() == [
+            "id,roles",
+            '1,"[""Tutor""]"',
+            '2,"[""Tutor""]"',
+            '3,"[""Tutor""]"',
+        ]
+    assert database.queries[-1] == "SELECT id, roles FROM users ORDER BY id"
@@ -0,0 +1,40 @@
+import asyncio
+
+import httpx
+import pytest
+
+from sstarlette.base import SResult, SStarlette
+from sstarlette.context import remaining_time
+
+
+async def slow(**kwargs):
+    await asyncio.sleep(1)
+    return SResult(data={"msg": "done"})
+
+
+async def budget(**kwargs):
+    return SResult(
+        data={
+            "remaining": remaining_time(),
+            "has_deadline": hasattr(kwargs["request"].state, "deadline"),
+        }
+    )
+
+
+@pytest.mark.run_loop
+async def test_routes_time_out_with_504():
+    app = SStarlette(
+        default_timeout=5,
+        service_layer={
+            "/slow": {"func": slow, "methods": ["GET"], "timeout": 0.05},
+            "/budget": {"func": budget, "methods": ["GET"]},
+        },
+    )
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/slow")
+        assert response.status_code == 504
+        assert response.json() == {"status": False, "msg": "Request timed out"}
+        response = await client.get("/budget")
+        data = response.json()["data"]
+        assert data["has_deadline"] and 4 < data["remaining"] <= 5
+    assert remaining_time() is None
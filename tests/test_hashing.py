@@ -0,0 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from sstarlette.authentication import PasswordHasher
+
+
+@pytest.mark.run_loop
+async def test_hashing_uses_threads_by_default():
+    hasher = PasswordHasher()
+    assert hasher.executor is None
+    hashed = await hasher.hash("password")
+    assert await hasher.verify("password", hashed)
+    assert not await hasher.verify("wrong password", hashed)
+
+
+@pytest.mark.run_loop
+async def test_configured_process_pool_is_shut_down():
+    hasher = PasswordHasher(max_workers=1)
+    assert isinstance(hasher.executor, ProcessPoolExecutor)
+    assert await hasher.verify("password", await hasher.hash("password"))
+    hasher.shutdown()
+    assert hasher._executor is None
@@ -0,0 +1,61 @@
+import asyncio
+
+import httpx
+import pytest
+
+from sstarlette.base import SResult, SStarlette
+
+
+@pytest.mark.run_loop
+async def test_retries_replay_the_first_response():
+    calls = []
+    sent = []
+
+    async def send_email(email):
+        sent.append(email)
+
+    async def signup(post_data, **kwargs):
+        calls.append(post_data["email"])
+        await asyncio.sleep(0.05)
+        return SResult(
+            data={"access_token": f"token-{len(calls)}"},
+            task=[[send_email, post_data["email"]]],
+        )
+
+    app = SStarlette(
+        service_layer={
+            "/signup": {"func": signup, "methods": ["POST"], "idempotent": True}
+        }
+    )
+    # signup is anonymous, provider tokens do not come as Authorization
+    headers = {"Idempotency-Key": "signup-1"}
+    body = {"email": "fredo@example.com"}
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        first, duplicate = await asyncio.gather(
+            client.post("/signup", json=body, headers=headers),
+            client.post("/signup", json=body, headers=headers),
+        )
+        retry = await client.post("/signup", json=body, headers=headers)
+        assert first.json() == duplicate.json() == retry.json()
+        assert retry.headers["Idempotent-Replayed"] == "true"
+        assert retry.headers["Idempotent-Tasks"] == "completed"
+        # another anonymous client that picked the same key is not replayed
+        response = await client.post(
+            "/signup", json={"email": "shola@example.com"}, headers=headers
+        )
+        assert "Idempotent-Replayed" not in response.headers
+        await client.post("/signup", json=body)
+        # authenticated clients are told when they reuse a key
+        owner = {**headers, "Authorization": "Bearer token"}
+        await client.post("/signup", json=body, headers=owner)
+        response = await client.post(
+            "/signup", json={"email": "shola@example.com"}, headers=owner
+        )
+        assert response.status_code == 422
+    assert calls == [
+        "fredo@example.com",
+        "shola@example.com",
+        "fredo@example.com",
+        "fredo@example.com",
+    ]
+    assert sent == calls
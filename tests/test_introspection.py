@@ -0,0 +1,99 @@
+import datetime
+
+import httpx
+import pytest
+
+from sstarlette.authentication import build_abstract_user, build_service_layer
+from sstarlette.authentication.service_layer import build_view
+from sstarlette.base import SStarlette
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+class Permission:
+    def __init__(self, name):
+        self.name = name
+
+
+class User(build_abstract_user(Settings)):
+    async def get_permissions(self):
+        return [Permission("edit account")] if self.roles else []
+
+
+def build_users():
+    users = {}
+    loaded = []
+
+    def create(email, roles=()):
+        users[email] = User(
+            full_name="Danny Novak",
+            email=email,
+            roles=list(roles),
+            created=datetime.datetime.now(),
+            modified=datetime.datetime.now(),
+        )
+        return users[email]
+
+    class Util:
+        klass = User
+
+        @staticmethod
+        async def get_user(email):
+            loaded.append(email)
+            return users.get(email)
+
+    return create, Util, loaded
+
+
+@pytest.mark.run_loop
+async def test_introspect_tokens():
+    create, Util, loaded = build_users()
+    service_layer = build_service_layer(Settings, Util, lambda: {})
+    staff = create("staff@example.com", ["Staff"])
+    client = create("client@example.com")
+    staff_token = await staff.generate_access_token(expires=60)
+    client_token = await client.create_user_token()
+    result = await service_layer["introspect-tokens"](
+        [staff_token, client_token, staff_token, "garbage"]
+    )
+    tokens = result.data["tokens"]
+    assert [x["active"] for x in tokens] == [True, True, True, False]
+    assert tokens[0]["auth_roles"] == ["authenticated", "staff"]
+    assert 0 < tokens[0]["ttl"] <= 60
+    assert tokens[1]["auth_roles"] == ["authenticated"]
+    # each user is only loaded once
+    assert sorted(loaded) == ["client@example.com", "staff@example.com"]
+    result = await service_layer["introspect-tokens"]("not a list")
+    assert result.errors
+
+
+@pytest.mark.run_loop
+async def test_introspect_route_is_for_staff():
+    create, Util, _ = build_users()
+    service_layer = build_service_layer(Settings, Util, lambda: {})
+    app = SStarlette(
+        auth_token_verify_user_callback=service_layer["verify-access-token"],
+        service_layer=build_view(service_layer),
+    )
+    staff_token = await create("staff@example.com", ["Staff"]).generate_access_token()
+    client_token = await create("client@example.com").create_user_token()
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.post("/introspect", json={"tokens": [client_token]})
+        assert response.status_code == 403
+        response = await client.post(
+            "/introspect",
+            json={"tokens": [client_token]},
+            headers={"Authorization": f"Bearer {client_token}"},
+        )
+        assert response.status_code == 403
+        staff = {"Authorization": f"Bearer {staff_token}"}
+        response = await client.post("/introspect", json=[client_token], headers=staff)
+        assert response.status_code == 400
+        response = await client.post(
+            "/introspect", json={"tokens": [client_token]}, headers=staff
+        )
+        assert response.status_code == 200
+        assert response.json()["data"]["tokens"][0]["email"] == "client@example.com"
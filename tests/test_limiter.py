@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from sstarlette.limiter import AdaptiveLimiter
+
+
+@pytest.mark.run_loop
+async def test_waiters_are_served_by_priority():
+    limiter = AdaptiveLimiter(initial_limit=1, max_queue_time=1)
+    assert await limiter.acquire("normal")
+    served = []
+
+    async def request(priority):
+        assert await limiter.acquire(priority)
+        served.append(priority)
+        limiter.release(0.01)
+
+    waiting = [asyncio.ensure_future(request(x)) for x in ("low", "normal", "high")]
+    await asyncio.sleep(0)
+    limiter.release(0.01)
+    await asyncio.gather(*waiting)
+    assert served == ["high", "normal", "low"]
+
+
+@pytest.mark.run_loop
+async def test_rejects_fast_and_backs_off_when_slow():
+    limiter = AdaptiveLimiter(initial_limit=2, target_latency=0.1)
+    assert await limiter.acquire() and await limiter.acquire()
+    # two slots busy and a tiny deadline: no point in queueing
+    assert not await limiter.acquire("low", budget=0.001)
+    assert limiter.snapshot()["rejected"]["low"] == 1
+    limiter.release(0.5)
+    limiter.release(0.5)
+    assert limiter.snapshot()["limit"] == 1
@@ -0,0 +1,179 @@
+import asyncio
+import datetime
+from unittest import mock
+
+import pytest
+
+from sstarlette.authentication import build_abstract_user
+from sstarlette.authentication.loader import UserLoader
+from sstarlette.authentication.service_layer import BaseModelUtil
+from sstarlette.context import RequestCacheMiddleware, request_cache
+from sstarlette.unit_of_work import UnitOfWork, current_unit_of_work
+
+
+class User:
+    def __init__(self, email):
+        self.email = email
+
+
+def build_util(calls):
+    class Util:
+        @staticmethod
+        async def get_user(email):
+            calls.append(email)
+            return User(email)
+
+        @staticmethod
+        async def get_users(emails):
+            calls.append(emails)
+            return [User(email) for email in emails if email != "missing@example.com"]
+
+    return Util
+
+
+@pytest.mark.run_loop
+async def test_concurrent_lookups_are_batched():
+    calls = []
+    loader = UserLoader(build_util(calls))
+    users = await asyncio.gather(
+        loader.load("fredo@example.com"),
+        loader.load("shola@example.com"),
+        loader.load("fredo@example.com"),
+        loader.load("missing@example.com"),
+    )
+    assert [getattr(x, "email", None) for x in users] == [
+        "fredo@example.com",
+        "shola@example.com",
+        "fredo@example.com",
+        None,
+    ]
+    assert calls == [["fredo@example.com", "shola@example.com", "missing@example.com"]]
+
+
+@pytest.mark.run_loop
+async def test_users_are_memoized_per_request():
+    calls = []
+    loader = UserLoader(build_util(calls))
+    loaded = []
+
+    async def app(scope, receive, send):
+        assert request_cache() == {}
+        loaded.append(await loader.load("fredo@example.com"))
+        loaded.append(await loader.load("fredo@example.com"))
+
+    await RequestCacheMiddleware(app)({"type": "http"}, None, None)
+    assert loaded[0] is loaded[1]
+    assert calls == ["fredo@example.com"]
+    assert request_cache() is None
+
+
+@pytest.mark.run_loop
+async def test_units_of_work_read_on_their_own_connection():
+    seen = []
+
+    class Util:
+        @staticmethod
+        async def get_user(email):
+            seen.append(current_unit_of_work())
+            user = User(email)
+            user.signup_info = {"verified": False}
+            return user
+
+    class Transaction:
+        async def start(self):
+            pass
+
+        async def commit(self):
+            pass
+
+        async def rollback(self):
+            pass
+
+    class Database:
+        def transaction(self):
+            return Transaction()
+
+    loader = UserLoader(Util)
+    first, second = await asyncio.gather(
+        UnitOfWork(Database()).run(loader.load("fredo@example.com")),
+        loader.load("fredo@example.com"),
+    )
+    first.signup_info["verified"] = True
+    assert second.signup_info == {"verified": False}
+    # the unit of work reads in its own context, the batch in a fresh one
+    assert seen[0] is not None and seen[1:] == [None]
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+@pytest.mark.run_loop
+async def test_default_get_user_builds_rows_without_validation():
+    class Database:
+        def __init__(self):
+            self.queries = []
+
+        async def fetch_one(self, query, values):
+            self.queries.append(query)
+            return self.row(values["email"])
+
+        async def fetch_all(self, query, values):
+            self.queries.append(query)
+            return [x for x in map(self.row, values.values()) if x]
+
+        def row(self, email):
+            if email != "danny@example.com":
+                return None
+            return {
+                "id": 1,
+                "full_name": "Danny Novak",
+                "email": "danny@example.com",
+                "roles": '["Staff"]',
+                "signup_info": '{"verified": true}',
+                "created": datetime.datetime.now(),
+                "modified": datetime.datetime.now(),
+            }
+
+    class Util(BaseModelUtil):
+        klass = build_abstract_user(Settings)
+        database = Database()
+        table_name = "users"
+
+    def fail(*args, **kwargs):
+        raise AssertionError("stored rows are not validated again")
+
+    loader = UserLoader(Util)
+    with mock.patch.object(Util.klass, "__init__", fail):
+        user, missing = await asyncio.gather(
+            loader.load("danny@example.com"), loader.load("missing@example.com")
+        )
+        # a lookup that was not shared is neither copied nor decoded
+        # both emails came from one query
+        assert Util.database.queries == [
+            "SELECT * FROM users WHERE email IN (:email_0, :email_1)"
+        ]
+        assert isinstance(user.__dict__["signup_info"], str)
+        assert isinstance(user.__dict__["roles"], str)
+        assert user.is_staff
+        assert user.verified
+        assert missing is None
+        first, second = await asyncio.gather(
+            loader.load("danny@example.com"), loader.load("danny@example.com")
+        )
+    assert first is not second
+    assert isinstance(first.__dict__["signup_info"], str)
+    first.signup_info["verified"] = False
+    assert second.signup_info == {"verified": True}
+
+
+@pytest.mark.run_loop
+async def test_default_get_users_goes_through_an_overridden_get_user():
+    class Util(BaseModelUtil):
+        @staticmethod
+        async def get_user(email):
+            return None if email == "missing@example.com" else User(email)
+
+    users = await Util.get_users(["fredo@example.com", "missing@example.com"])
+    assert [x.email for x in users] == ["fredo@example.com"]
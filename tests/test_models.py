@@ -4,6 +4,7 @@ import jwt
 import pytest
 import asyncpg
 from datetime import datetime
+from pydantic import ValidationError
 from authentication_service import models
 from authentication_service.models.utils import decode_access_token
 from views.shared import clear_db
@@ -170,3 +171,36 @@ async def test_downgrade_token_access_from_staff_or_admin():
         decoded_value = decode_access_token(user_token)
         assert not decoded_value.get("aud")
 
+
+def test_user_from_db_row():
+    row = {
+        "full_name": "Danny Novak",
+        "email": "danny@example.com",
+        "password": "hashed",
+        "created": datetime.now(),
+        "modified": datetime.now(),
+        "signup_info": '{"verified": true}',
+        "roles": '["Staff"]',
+    }
+    user = models.User.from_db_row(row)
+    assert user.verified
+    assert user.is_staff
+    assert user.password.get_secret_value() == "hashed"
+    user.email = "not an email"
+    with pytest.raises(ValidationError):
+        user.ensure_valid()
+
+
+def test_json_fields_decoded_on_first_access():
+    row = {
+        "full_name": "Danny Novak",
+        "email": "danny@example.com",
+        "created": datetime.now(),
+        "modified": datetime.now(),
+        "signup_info": '{"verified": true, "provider": "google"}',
+        "roles": '["Staff"]',
+    }
+    user = models.User.from_db_row(row)
+    assert user.roles == ["Staff"]
+    assert isinstance(user.__dict__["signup_info"], str)
+    assert user.dict()["signup_info"] == {"verified": True, "provider": "google"}
@@ -0,0 +1,25 @@
+import asyncio
+import time
+
+import pytest
+
+from sstarlette.monitoring import LoopLagMonitor
+
+
+@pytest.mark.run_loop
+async def test_loop_lag_monitor_captures_blocking_frame():
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05)
+    monitor.start()
+    await asyncio.sleep(0.03)
+
+    def blocking_call():
+        time.sleep(0.2)
+
+    blocking_call()
+    await asyncio.sleep(0.03)
+    monitor.stop()
+    snapshot = monitor.snapshot()
+    assert snapshot["max"] >= 0.15
+    assert snapshot["histogram"]["0.25"] >= 1
+    assert len(snapshot["blocks"]) == 1
+    assert "blocking_call" in snapshot["blocks"][0]["stack"]
@@ -0,0 +1,93 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+
+from sstarlette.authentication import NotificationDispatcher
+
+
+def build_notification_service():
+    received = []
+    service = Starlette()
+
+    @service.route("/bulk", methods=["POST"])
+    async def bulk(request):
+        received.append((await request.json())["notifications"])
+        return JSONResponse({"status": True})
+
+    return service, received
+
+
+@pytest.mark.run_loop
+async def test_dispatcher_batches_and_dedupes():
+    service, received = build_notification_service()
+    dispatcher = NotificationDispatcher(
+        "http://notification-service/bulk",
+        window=0.01,
+        client=httpx.AsyncClient(app=service),
+    )
+    results = await asyncio.gather(
+        dispatcher("fredo@example.com", "token"),
+        dispatcher("shola@example.com", callback_url="http://google.com"),
+        # repeated forgot-password clicks only send one email
+        dispatcher("Shola@example.com", callback_url="http://google.com"),
+    )
+    assert results == [True, True, False]
+    assert not await dispatcher("shola@example.com", callback_url="http://google.com")
+    assert received == [
+        [
+            {"email": "fredo@example.com", "purpose": "verify-email", "token": "token"},
+            {
+                "email": "shola@example.com",
+                "purpose": "forgot-password",
+                "callback_url": "http://google.com",
+            },
+        ]
+    ]
+    await dispatcher.close()
+
+
+@pytest.mark.run_loop
+async def test_dispatcher_flushes_full_batches_immediately():
+    service, received = build_notification_service()
+    dispatcher = NotificationDispatcher(
+        "http://notification-service/bulk",
+        window=10,
+        max_batch=2,
+        client=httpx.AsyncClient(app=service),
+    )
+    await asyncio.gather(
+        dispatcher("a@example.com", "token"), dispatcher("b@example.com", "token")
+    )
+    assert len(received) == 1
+    pending = asyncio.ensure_future(dispatcher("c@example.com", "token"))
+    await asyncio.sleep(0)
+    await dispatcher.close()
+    assert await pending
+    assert [len(x) for x in received] == [2, 1]
+
+
+@pytest.mark.run_loop
+async def test_failed_sends_raise_and_can_be_retried():
+    service = Starlette()
+    received = []
+
+    @service.route("/bulk", methods=["POST"])
+    async def bulk(request):
+        received.append((await request.json())["notifications"])
+        # the first request fails
+        status_code = 503 if len(received) == 1 else 200
+        return JSONResponse({"status": status_code == 200}, status_code=status_code)
+
+    dispatcher = NotificationDispatcher(
+        "http://notification-service/bulk",
+        window=0.01,
+        client=httpx.AsyncClient(app=service),
+    )
+    with pytest.raises(httpx.HTTPError):
+        await dispatcher("fredo@example.com", "token")
+    assert await dispatcher("fredo@example.com", "token")
+    assert len(received) == 2
+    await dispatcher.close()
@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from sstarlette.authentication import PermissionCache
+
+
+def build_loader(rows):
+    async def loader():
+        return list(rows)
+
+    return loader
+
+
+@pytest.mark.run_loop
+async def test_permission_names_from_cache():
+    rows = [
+        ("Admin", "access entire site"),
+        ("Staff", "edit account"),
+        ("Admin", "edit account"),
+        (None, "teach group lessons"),
+    ]
+    cache = PermissionCache(build_loader(rows), poll_interval=0)
+    await cache.start()
+    assert cache.loaded
+    assert sorted(cache.permission_names(["Admin"])) == [
+        "access entire site",
+        "edit account",
+    ]
+    assert cache.permission_names(["Staff"], ["teach group lessons"]) in [
+        ["edit account", "teach group lessons"],
+        ["teach group lessons", "edit account"],
+    ]
+    # unknown additional permissions are ignored just like the db lookup
+    assert cache.permission_names(["User"], ["fly"]) == []
+    await cache.stop()
+
+
+@pytest.mark.run_loop
+async def test_reload_reports_changed_roles():
+    rows = [("Admin", "access entire site"), ("Staff", "edit account")]
+    cache = PermissionCache(build_loader(rows), poll_interval=0)
+    changes = []
+
+    @cache.on_change
+    async def record(changed):
+        changes.append(changed)
+
+    await cache.start()
+    rows.append(("Staff", "teach group lessons"))
+    await cache.invalidate()
+    assert changes == [{"Staff"}]
+    assert sorted(cache.permission_names(["Staff"])) == [
+        "edit account",
+        "teach group lessons",
+    ]
+    await cache.stop()
+
+
+@pytest.mark.run_loop
+async def test_notification_during_reload_reloads_again():
+    rows = [("Staff", "edit account")]
+    reading = asyncio.Event()
+    release = asyncio.Event()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        result = list(rows)
+        if len(calls) == 2:
+            reading.set()
+            await release.wait()
+        return result
+
+    cache = PermissionCache(loader, poll_interval=0)
+    await cache.start()
+    cache._on_notification()
+    await reading.wait()
+    # this change is committed after the running reload read its rows
+    rows.append(("Staff", "teach group lessons"))
+    cache._on_notification()
+    release.set()
+    await cache._pending
+    assert len(calls) == 3
+    assert sorted(cache.permission_names(["Staff"])) == [
+        "edit account",
+        "teach group lessons",
+    ]
+    await cache.stop()
@@ -0,0 +1,137 @@
+import contextlib
+import datetime
+import json
+
+import pytest
+
+from sstarlette.authentication import (
+    PermissionCache,
+    PrincipalProjection,
+    build_abstract_user,
+)
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+class Database:
+    def __init__(self, users):
+        self.users = users
+        self.written = []
+
+    async def fetch_all(self, query, values):
+        after = values.get("after", 0)
+        rows = [x for x in self.users if x["id"] > after]
+        return rows[: values["limit"]]
+
+    async def execute_many(self, query, values):
+        self.written.append([x["email"] for x in values])
+
+
+async def load_permissions():
+    return [("Staff", "edit account")]
+
+
+def user_row(id):
+    return {
+        "id": id,
+        "email": f"user{id}@example.com",
+        "roles": '["Staff"]',
+        "additional_permissions": "[]",
+        "is_active": True,
+        "signup_info": '{"verified": true}',
+    }
+
+
+@pytest.mark.run_loop
+async def test_rebuild_pages_through_users():
+    database = Database([user_row(x) for x in range(1, 6)])
+    projection = PrincipalProjection(database, PermissionCache(load_permissions))
+    assert await projection.rebuild(batch_size=2) == 5
+    assert database.written == [
+        ["user1@example.com", "user2@example.com"],
+        ["user3@example.com", "user4@example.com"],
+        ["user5@example.com"],
+    ]
+
+
+class RefreshDatabase:
+    def __init__(self, locked):
+        self.locked = locked
+        self.executed = []
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch_val(self, query, values):
+        assert "pg_try_advisory_xact_lock" in query
+        return self.locked
+
+    async def execute(self, query, values):
+        self.executed.append((query, values))
+
+
+@pytest.mark.run_loop
+async def test_role_changes_are_refreshed_once_in_one_statement():
+    rows = [("Staff", "edit account"), (None, "teach group lessons")]
+
+    async def loader():
+        return list(rows)
+
+    cache = PermissionCache(loader)
+    databases = [RefreshDatabase(locked=True), RefreshDatabase(locked=False)]
+    for database in databases:
+        PrincipalProjection(database, cache)
+    await cache.load()
+    rows.append(("Staff", "access entire site"))
+    await cache.load()
+    # the worker without the lock leaves the rows to the one holding it
+    assert databases[1].executed == []
+    [(query, values)] = databases[0].executed
+    assert query.startswith("UPDATE auth_principals AS principal")
+    assert values["roles"] == ["Staff"]
+    assert json.loads(values["role_permissions"]) == {
+        "Staff": ["access entire site", "edit account"]
+    }
+    assert values["permissions"] == [
+        "access entire site",
+        "edit account",
+        "teach group lessons",
+    ]
+
+
+class Projection:
+    def __init__(self):
+        self.synced = []
+
+    async def upsert(self, user):
+        self.synced.append((user.email, list(user.roles)))
+
+
+@pytest.mark.run_loop
+async def test_every_save_syncs_the_projection():
+    projection = Projection()
+
+    class Model:
+        async def save(self):
+            pass
+
+    class User(Model, build_abstract_user(Settings, principal_projection=projection)):
+        pass
+
+    user = User(
+        full_name="Danny Novak",
+        email="danny@example.com",
+        created=datetime.datetime.now(),
+        modified=datetime.datetime.now(),
+    )
+    user.roles = ["Staff"]
+    await user.save()
+    await user.verify_user()
+    assert projection.synced == [
+        ("danny@example.com", ["Staff"]),
+        ("danny@example.com", ["Staff"]),
+    ]
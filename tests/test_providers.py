@@ -0,0 +1,80 @@
+import json
+import time
+
+import httpx
+import jwt
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+
+from sstarlette.authentication import ProviderVerifier
+
+private_key = rsa.generate_private_key(
+    public_exponent=65537, key_size=2048, backend=default_backend()
+)
+
+
+def build_google_service():
+    calls = []
+    service = Starlette()
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk["kid"] = "key-1"
+
+    @service.route("/oauth2/v3/certs")
+    async def certs(request):
+        calls.append(1)
+        return JSONResponse(
+            {"keys": [jwk]}, headers={"Cache-Control": "public, max-age=600"}
+        )
+
+    return service, calls
+
+
+def google_token(email="fredo@example.com", aud="client-id"):
+    return jwt.encode(
+        {
+            "iss": "https://accounts.google.com",
+            "aud": aud,
+            "email": email,
+            "email_verified": True,
+            "exp": int(time.time()) + 3600,
+        },
+        private_key,
+        algorithm="RS256",
+        headers={"kid": "key-1"},
+    ).decode()
+
+
+@pytest.mark.run_loop
+async def test_google_tokens_are_verified_locally():
+    service, calls = build_google_service()
+    verifier = ProviderVerifier(
+        google_client_ids=["client-id"], client=httpx.AsyncClient(app=service)
+    )
+    token = google_token()
+    info = {"provider": "google"}
+    assert await verifier(info, token, {"email": "Fredo@example.com"}) is None
+    assert await verifier(info, google_token(), {"email": "fredo@example.com"}) is None
+    # keys are fetched once for all tokens
+    assert len(calls) == 1
+    assert await verifier(info, token, {"email": "shola@example.com"}) == {
+        "google": "Email does not match token"
+    }
+    assert await verifier(
+        info, google_token(aud="other-client"), {"email": "fredo@example.com"}
+    ) == {"google": "Invalid token"}
+    await verifier.close()
+
+
+@pytest.mark.run_loop
+async def test_google_tokens_need_configured_client_ids():
+    service, _ = build_google_service()
+    verifier = ProviderVerifier(client=httpx.AsyncClient(app=service))
+    info = {"provider": "google", "client_id": "other-client"}
+    token = google_token(aud="other-client")
+    assert await verifier(info, token, {"email": "fredo@example.com"}) == {
+        "google": "Invalid token"
+    }
+    await verifier.close()
@@ -0,0 +1,77 @@
+import httpx
+import pytest
+
+from sstarlette.base import SResult, SStarlette
+from starlette.requests import Request
+
+from sstarlette.ratelimit import MemoryBackend, forwarded_ip, parse_rate
+
+
+async def login(post_data, **kwargs):
+    return SResult(data={"email": post_data["email"]})
+
+
+def test_parse_rate():
+    assert parse_rate("6/minute") == (6, 0.1)
+    assert parse_rate("1/seconds") == (1, 1)
+
+
+@pytest.mark.run_loop
+async def test_bucket_refills():
+    backend = MemoryBackend()
+    rate = parse_rate("2/second")
+    assert (await backend.take("key", rate))[0]
+    assert (await backend.take("key", rate))[0]
+    allowed, retry_after = await backend.take("key", rate)
+    assert not allowed and 0 < retry_after <= 0.5
+
+
+@pytest.mark.run_loop
+async def test_pruning_keeps_buckets_of_slower_rates():
+    backend = MemoryBackend(max_keys=1)
+    await backend.take("login", parse_rate("1/minute"))
+    # a fast rate must not prune the minute bucket that is still refilling
+    await backend.take("ping", parse_rate("100/second"))
+    assert not (await backend.take("login", parse_rate("1/minute")))[0]
+
+
+def test_forwarded_ip_trusts_only_known_proxies():
+    key = forwarded_ip(["10.0.0.0/8"])
+
+    def request(host, forwarded):
+        return Request(
+            {
+                "type": "http",
+                "client": (host, 1234),
+                "headers": [(b"x-forwarded-for", forwarded.encode())],
+            }
+        )
+
+    assert key(request("10.0.0.2", "1.2.3.4, 10.0.0.7"), None) == "1.2.3.4"
+    assert key(request("10.0.0.2", "6.6.6.6, 1.2.3.4"), None) == "1.2.3.4"
+    # clients that connect directly can not pick their own key
+    assert key(request("5.5.5.5", "1.2.3.4"), None) == "5.5.5.5"
+
+
+@pytest.mark.run_loop
+async def test_routes_reject_over_the_limit():
+    app = SStarlette(
+        service_layer={
+            "/login": {
+                "func": login,
+                "methods": ["POST"],
+                "rate_limit": {"ip": "3/minute", "email": "1/minute"},
+            }
+        }
+    )
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.post("/login", json={"email": "fredo@example.com"})
+        assert response.status_code == 200
+        response = await client.post("/login", json={"email": "Fredo@example.com"})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) > 0
+        response = await client.post("/login", json={"email": "shola@example.com"})
+        assert response.status_code == 200
+        # the ip limit is hit before the (invalid) body is parsed
+        response = await client.post("/login", data="not json")
+        assert response.status_code == 429
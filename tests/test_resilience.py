@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+from sstarlette.base import SStarlette
+from sstarlette.resilience import CircuitOpenError, HookGuard
+
+
+@pytest.mark.run_loop
+async def test_circuit_opens_and_probes_after_recovery():
+    calls = []
+
+    async def get_email_from_number(number, endpoint):
+        calls.append(number)
+        if len(calls) <= 2:
+            raise ConnectionError("sms service down")
+        return "fredo@example.com"
+
+    guard = HookGuard(
+        {"get_email_from_number": {"failure_threshold": 2, "recovery_timeout": 0.05}}
+    )
+    hook = guard.wrap("get_email_from_number", get_email_from_number)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await hook("08012345678", "http://sms")
+    # open: the service is not called at all
+    with pytest.raises(CircuitOpenError):
+        await hook("08012345678", "http://sms")
+    assert len(calls) == 2
+    assert guard.snapshot()["get_email_from_number"]["state"] == "open"
+    await asyncio.sleep(0.06)
+    assert await hook("08012345678", "http://sms") == "fredo@example.com"
+    assert guard.snapshot()["get_email_from_number"]["state"] == "closed"
+
+
+@pytest.mark.run_loop
+async def test_bulkhead_rejects_to_fallback():
+    release = asyncio.Event()
+
+    async def email_verification(email, token):
+        await release.wait()
+        return True
+
+    guard = HookGuard({"default": {"max_concurrency": 1, "fallback": False}})
+    hook = guard.wrap("email_verification", email_verification)
+    assert hook.__wrapped__ is email_verification
+    first = asyncio.ensure_future(hook("a@example.com", "token"))
+    await asyncio.sleep(0)
+    assert await hook("b@example.com", "token") is False
+    release.set()
+    assert await first is True
+    metrics = guard.snapshot()["email_verification"]
+    assert metrics["rejected"] == 1 and metrics["fallbacks"] == 1
+
+
+@pytest.mark.run_loop
+async def test_cancelled_probe_frees_the_half_open_slot():
+    started = asyncio.Event()
+
+    async def verify(token):
+        if token == "slow":
+            started.set()
+            await asyncio.sleep(10)
+        raise ConnectionError("provider down")
+
+    guard = HookGuard({"verify": {"failure_threshold": 1, "recovery_timeout": 0}})
+    hook = guard.wrap("verify", verify)
+    with pytest.raises(ConnectionError):
+        await hook("fast")
+    probe = asyncio.ensure_future(hook("slow"))
+    await started.wait()
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    # the next call is let through as a probe instead of being rejected
+    with pytest.raises(ConnectionError):
+        await hook("fast")
+
+
+@pytest.mark.run_loop
+async def test_sync_hooks_run_in_threadpool():
+    def get_email_from_number(number, endpoint):
+        return "fredo@example.com"
+
+    guard = HookGuard({"default": {}})
+    hook = guard.wrap("get_email_from_number", get_email_from_number)
+    assert await hook("+2348000000000", "sms") == "fredo@example.com"
+
+
+@pytest.mark.run_loop
+async def test_hooks_without_a_policy_are_not_guarded():
+    async def email_verification(email, token):
+        return True
+
+    guard = HookGuard({"provider_verification": {"failure_threshold": 2}})
+    assert guard.wrap("email_verification", email_verification) is email_verification
+    assert guard.snapshot() == {}
+
+
+class Dispatcher:
+    max_batch = 3
+
+    def __init__(self):
+        self.threads = set()
+        self.pending = 0
+        self.sent = asyncio.Event()
+
+    async def __call__(self, email, token=None):
+        self.threads.add(threading.get_ident())
+        self.pending += 1
+        if self.pending == self.max_batch:
+            self.sent.set()
+        await self.sent.wait()
+        return True
+
+
+@pytest.mark.run_loop
+async def test_batching_hooks_can_fill_their_batch():
+    dispatcher = Dispatcher()
+    guard = HookGuard({"email_verification": {"max_concurrency": 1}})
+    hook = guard.wrap("email_verification", dispatcher)
+    emails = [f"user{i}@example.com" for i in range(3)]
+    assert await asyncio.gather(*[hook(x) for x in emails]) == [True] * 3
+    # the async __call__ is awaited on the loop, not in the threadpool
+    assert dispatcher.threads == {threading.get_ident()}
+    assert guard.snapshot()["email_verification"]["rejected"] == 0
+
+
+@pytest.mark.run_loop
+async def test_provider_verification_can_not_fall_back():
+    async def provider_verification(provider, token):
+        raise ConnectionError("provider down")
+
+    with pytest.raises(ValueError):
+        HookGuard({"provider_verification": {"fallback": None}})
+    guard = HookGuard({"default": {"fallback": None}})
+    hook = guard.wrap("provider_verification", provider_verification)
+    with pytest.raises(ConnectionError):
+        await hook("google", "token")
+
+
+@pytest.mark.run_loop
+async def test_open_circuits_are_reported_as_503():
+    async def email_verification(email, token):
+        raise ConnectionError("mail service down")
+
+    guard = HookGuard({"default": {"failure_threshold": 1, "recovery_timeout": 30}})
+    hook = guard.wrap("email_verification", email_verification)
+
+    async def resend(**kwargs):
+        await hook("a@example.com", "token")
+
+    app = SStarlette(service_layer={"/resend": {"func": resend, "methods": ["GET"]}})
+    with pytest.raises(ConnectionError):
+        await hook("a@example.com", "token")
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/resend")
+    assert response.status_code == 503
+    assert 0 < int(response.headers["Retry-After"]) <= 30
@@ -0,0 +1,120 @@
+import datetime
+import uuid
+
+import jwt
+import pytest
+
+from sstarlette.authentication import (
+    TokenRevocationList,
+    build_abstract_user,
+    build_service_layer,
+)
+from sstarlette.authentication.helpers import create_app_access_token
+from sstarlette.authentication.revocation import BloomFilter
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    revoked = [uuid.uuid4().hex for _ in range(1000)]
+    for jti in revoked:
+        bloom.add(jti)
+    assert all(jti in bloom for jti in revoked)
+    others = [uuid.uuid4().hex for _ in range(10000)]
+    false_positives = len([x for x in others if x in bloom])
+    assert false_positives < 300
+
+
+def test_access_tokens_carry_unique_jti():
+    tokens = [
+        create_app_access_token(
+            data={"email": "fredo@example.com"},
+            issuer="sstarlette",
+            secret_key="secret",
+            timestamp=1,
+        )
+        for _ in range(2)
+    ]
+    ids = {jwt.decode(x, verify=False)["jti"] for x in tokens}
+    assert len(ids) == 2
+
+
+class Database:
+    def __init__(self):
+        self.rows = []
+        self.lookups = []
+
+    async def execute(self, query, values=None):
+        if query.startswith("INSERT"):
+            if values["jti"] not in [x["jti"] for x in self.rows]:
+                self.rows.append({"id": len(self.rows) + 1, **values})
+
+    async def fetch_one(self, query, values):
+        self.lookups.append(values["jti"])
+        return next((x for x in self.rows if x["jti"] == values["jti"]), None)
+
+    async def fetch_all(self, query, values=None):
+        last_id = (values or {}).get("last_id", 0)
+        return [x for x in self.rows if x["id"] > last_id]
+
+
+@pytest.mark.run_loop
+async def test_bloom_hits_are_confirmed_in_the_table():
+    database = Database()
+    revoked = TokenRevocationList(database, refresh_interval=0)
+    await revoked.revoke("revoked-jti")
+    # another worker only knows about the row after a refresh
+    other = TokenRevocationList(database, refresh_interval=0)
+    assert not await other.is_revoked("revoked-jti")
+    await other.refresh()
+    assert await other.is_revoked("revoked-jti")
+    assert await other.is_revoked("revoked-jti")
+    assert database.lookups == ["revoked-jti"]
+    # a false positive of the filter is cleared by the table
+    other.bloom.add("valid-jti")
+    assert not await other.is_revoked("valid-jti")
+    assert database.lookups == ["revoked-jti", "valid-jti"]
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+@pytest.mark.run_loop
+async def test_revoked_tokens_are_rejected():
+    revocation = TokenRevocationList(Database(), refresh_interval=0)
+
+    class User(build_abstract_user(Settings)):
+        pass
+
+    user = User(
+        full_name="Danny Novak",
+        email="danny@example.com",
+        created=datetime.datetime.now(),
+        modified=datetime.datetime.now(),
+    )
+
+    class Util:
+        klass = User
+        token_revocation = revocation
+
+        @staticmethod
+        async def get_user(email):
+            return user
+
+    service_layer = build_service_layer(Settings, Util, lambda: {})
+    token = await user.create_user_token(expires=60)
+    verified = await service_layer["verify-access-token"](token)
+    forged = jwt.encode(
+        {**jwt.decode(token, verify=False), "jti": "other"}, "wrong", "HS256"
+    ).decode()
+    # only staff can revoke tokens other than their own
+    result = await service_layer["revoke-token"](verified, token, token=forged)
+    assert result.errors
+    result = await service_layer["revoke-token"](verified, forged)
+    assert result.errors == {"msg": "Invalid token"}
+    assert not await revocation.is_revoked("other")
+    result = await service_layer["revoke-token"](verified, token)
+    assert result.data == {"msg": "Token revoked"}
+    with pytest.raises(ValueError):
+        await service_layer["verify-access-token"](token)
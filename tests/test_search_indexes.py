@@ -0,0 +1,140 @@
+import pytest
+
+from sstarlette.authentication import UserQueries, UserSearch, build_abstract_user
+from sstarlette.authentication.indexes import (
+    SIGNUP_INFO_INDEXES,
+    USER_SEARCH_INDEXES,
+    json_index_statements,
+    search_index_statements,
+)
+from sstarlette.authentication.search import like_prefix
+
+CONFIG = {
+    "full_name": {"index": True, "search": "trigram"},
+    "email": {"unique": True, "search": ["trigram", "prefix"]},
+    "password": {},
+}
+
+
+def test_statements_for_declared_search_columns():
+    statements = search_index_statements("users", CONFIG)
+    assert statements[0] == "CREATE EXTENSION IF NOT EXISTS pg_trgm"
+    assert len(statements) == 4
+    assert "users_email_prefix_idx" in statements[-1]
+    assert "lower(email) text_pattern_ops" in statements[-1]
+
+
+def test_unknown_search_kind():
+    with pytest.raises(ValueError):
+        search_index_statements("users", {"email": {"search": "fulltext"}})
+
+
+def test_like_prefix_escapes_wildcards():
+    assert like_prefix("50%_off") == "50\\%\\_off%"
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+class User(build_abstract_user(Settings)):
+    pass
+
+
+class SearchableUser(User):
+    @classmethod
+    def dalchemy_index_config(cls):
+        return USER_SEARCH_INDEXES
+
+
+class Database:
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    async def fetch_all(self, query, values):
+        self.queries.append((query, values))
+        offset = values["offset"]
+        return self.records[offset : offset + values["limit"]]
+
+    async def iterate(self, query, values):
+        self.queries.append((query, values))
+        for record in self.records:
+            yield record
+
+
+def test_search_is_opt_in():
+    assert "search" not in User.dalchemy_table_config()["email"]
+    with pytest.raises(ValueError):
+        UserSearch(User, Database([]))
+
+
+@pytest.mark.run_loop
+async def test_user_search_pages_with_one_extra_row():
+    records = [
+        {"id": x, "full_name": f"Danny {x}", "email": f"danny{x}@example.com"}
+        for x in range(1, 6)
+    ]
+    for record in records:
+        record["roles"] = '["Staff"]'
+    database = Database(records)
+    search = UserSearch(SearchableUser, database)
+    users, has_more = await search.search(" Danny ", page=2, page_size=2)
+    assert has_more
+    assert [x["id"] for x in users] == [3, 4]
+    assert users[0]["roles"] == ["Staff"]
+    query, values = database.queries[0]
+    assert values == {"term": "danny", "prefix": "danny%", "limit": 3, "offset": 2}
+    assert "lower(full_name) % :term" in query
+    assert "lower(email) LIKE :prefix" in query
+    assert "lower(full_name) LIKE" not in query
+    users, has_more = await search.search("danny", page=3, page_size=2)
+    assert not has_more
+    assert [x["id"] for x in users] == [5]
+
+
+def test_json_index_statements():
+    config = {"signup_info": {"json_indexes": {"provider": "text"}, "gin": True}}
+    assert json_index_statements("users", config) == [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_signup_info_provider_idx "
+        "ON users (((signup_info->>'provider')))",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_signup_info_gin_idx "
+        "ON users USING gin ((signup_info::jsonb) jsonb_path_ops)",
+    ]
+
+
+class QueryableUser(User):
+    @classmethod
+    def dalchemy_index_config(cls):
+        return SIGNUP_INFO_INDEXES
+
+
+@pytest.mark.run_loop
+async def test_user_queries_use_the_indexed_expressions():
+    with pytest.raises(ValueError):
+        UserQueries(User, Database([])).conditions("signup_info", {"a": 1}, {})
+    record = {
+        "id": 1,
+        "full_name": "Danny Novak",
+        "email": "danny@example.com",
+        "signup_info": '{"provider": "staff", "department": "sales"}',
+    }
+    database = Database([record])
+    queries = UserQueries(QueryableUser, database)
+    users = [x async for x in queries.staff_in_department("sales")]
+    assert users[0].signup_info["department"] == "sales"
+    query, values = database.queries[-1]
+    assert "(signup_info->>'provider') = :signup_info_provider" in query
+    assert "(signup_info->>'department') = :signup_info_department" in query
+    assert values == {
+        "signup_info_provider": "staff",
+        "signup_info_department": "sales",
+    }
+    [x async for x in queries.where(provider="google", country="NG")]
+    query, values = database.queries[-1]
+    assert "(signup_info::jsonb) @> CAST(:signup_info_contains AS jsonb)" in query
+    assert values["signup_info_contains"] == '{"country": "NG"}'
+    [x async for x in queries.unverified_provider_users("google")]
+    query, _ = database.queries[-1]
+    assert "(signup_info->>'verified')::boolean IS NOT TRUE" in query
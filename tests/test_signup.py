@@ -0,0 +1,125 @@
+import asyncio
+import datetime
+import json
+
+import jwt
+import pytest
+
+from sstarlette.authentication import (
+    PermissionCache,
+    build_abstract_user,
+    build_service_layer,
+)
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+class Role:
+    def __init__(self, name):
+        self.name = name
+
+
+class Database:
+    def __init__(self):
+        self.queries = []
+
+    async def fetch_one(self, query, values):
+        self.queries.append((query, values))
+        return {"id": 7, **values, "permission_names": ["teach group lessons"]}
+
+
+def build_user(permission_cache=None):
+    class User(build_abstract_user(Settings, permission_cache=permission_cache)):
+        id: int = None
+
+        @classmethod
+        def validate_model(cls, **kwargs):
+            return None
+
+        @classmethod
+        def with_defaults(cls, kwargs):
+            now = datetime.datetime.now()
+            return {"created": now, "modified": now, **kwargs}
+
+        async def get_permissions(self):
+            raise AssertionError("permissions are returned by the insert")
+
+    return User
+
+
+def build_util(User, database):
+    class Util:
+        klass = User
+        table_name = "users"
+        permissions_query = "SELECT name FROM permissions WHERE role = :role"
+
+        @staticmethod
+        async def create_user(role=None, **kwargs):
+            role_task = asyncio.ensure_future(asyncio.sleep(0, Role(role)))
+            return await User.dalchemy_create_unverified_user(
+                User, role_task=role_task, **kwargs
+            )
+
+    Util.database = database
+    return Util
+
+
+@pytest.mark.run_loop
+async def test_signup_inserts_and_returns_permissions_in_one_query():
+    database = Database()
+    User = build_user()
+    service_layer = build_service_layer(
+        Settings, build_util(User, database), lambda: {}
+    )
+    result = await service_layer["signup"](
+        {
+            "full_name": "Danny Novak",
+            "email": "danny@example.com",
+            "password": "password",
+            "signup_info": {"role": "Tutor"},
+            # arguments the service layer passes are not taken from the body
+            "table_name": "admins",
+            "permissions_query": "SELECT name FROM permissions",
+            "email_verified": True,
+        },
+        {},
+    )
+    token = jwt.decode(result.data["access_token"], verify=False)
+    assert token["aud"] == ["teach group lessons"]
+    [(query, values)] = database.queries
+    assert query.startswith("WITH inserted AS (INSERT INTO users")
+    assert "ARRAY(SELECT name FROM permissions WHERE role = :role)" in query
+    assert values["role"] == "Tutor"
+    assert values["password"] != "password"
+    assert json.loads(values["signup_info"]) == {"verified": False}
+
+
+async def load_permissions():
+    return [("Tutor", "teach group lessons"), (None, "edit account")]
+
+
+@pytest.mark.run_loop
+async def test_additional_permissions_are_filtered_like_the_cache():
+    cache = PermissionCache(load_permissions)
+    await cache.load()
+    User = build_user(cache)
+    user = User.construct(
+        full_name="Danny Novak",
+        email="danny@example.com",
+        additional_permissions=["edit account", "removed permission"],
+    )
+    permissions = await user.dalchemy_insert(
+        Database(), "users", role="Tutor", permissions_query="SELECT 1"
+    )
+    assert sorted(permissions) == ["edit account", "teach group lessons"]
+    # without a loaded cache there is nothing to filter against
+    user = build_user().construct(additional_permissions=["removed permission"])
+    assert (
+        await user.dalchemy_insert(
+            Database(), "users", role="Tutor", permissions_query="SELECT 1"
+        )
+        is None
+    )
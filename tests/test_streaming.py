@@ -0,0 +1,28 @@
+import httpx
+import pytest
+
+from sstarlette.base import SResult, SStarlette
+
+
+async def progress():
+    for i in range(3):
+        yield f'{{"processed": {i}}}\n'
+
+
+async def stream_progress(**kwargs):
+    return SResult(stream=progress())
+
+
+@pytest.mark.run_loop
+async def test_results_can_stream():
+    app = SStarlette(
+        service_layer={"/progress": {"func": stream_progress, "methods": ["GET"]}}
+    )
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/progress")
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert response.text.splitlines() == [
+        '{"processed": 0}',
+        '{"processed": 1}',
+        '{"processed": 2}',
+    ]
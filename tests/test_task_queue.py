@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+import pytest
+
+from sstarlette.task_queue import SCRUBBED_PAYLOAD, DurableTaskQueue, SQLiteBackend
+
+sent = []
+attempts = []
+
+
+async def send_email(email, token=None):
+    sent.append((email, token))
+
+
+def send_sms(number):
+    sent.append((number, threading.current_thread() is threading.main_thread()))
+
+
+async def unreliable(value):
+    attempts.append(value)
+    raise RuntimeError("notification service down")
+
+
+@pytest.mark.run_loop
+async def test_durable_queue_runs_persisted_tasks(tmp_path):
+    queue = DurableTaskQueue(SQLiteBackend(str(tmp_path / "tasks.db")))
+    queue.register(send_email, name="send_email")
+    await queue.setup()
+    assert await queue.enqueue(send_email, "fredo@example.com", token="abc")
+    # closures can not be found again by a worker so they stay in-process
+    assert not await queue.enqueue(lambda: None)
+    assert await queue.run_once() == 1
+    assert sent == [("fredo@example.com", "abc")]
+    assert await queue.run_once() == 0
+
+
+@pytest.mark.run_loop
+async def test_durable_queue_retries_then_dead_letters(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "tasks.db"))
+    queue = DurableTaskQueue(backend, max_attempts=2, backoff=0.01)
+    queue.register(unreliable, name="unreliable")
+    await queue.setup()
+    await queue.enqueue(unreliable, 1)
+    for _ in range(4):
+        await queue.run_once()
+        await asyncio.sleep(0.02)
+    assert attempts == [1, 1]
+    rows = backend._execute(
+        lambda connection: connection.execute(
+            "SELECT status, attempts, payload FROM task_queue"
+        ).fetchall()
+    )
+    # the arguments of a dead job are not kept
+    assert rows == [("dead", 2, SCRUBBED_PAYLOAD)]
+
+
+@pytest.mark.run_loop
+async def test_sync_tasks_run_off_the_loop(tmp_path):
+    queue = DurableTaskQueue(SQLiteBackend(str(tmp_path / "tasks.db")))
+    queue.register(send_sms, name="send_sms")
+    await queue.setup()
+    await queue.enqueue(send_sms, "+2348000000000")
+    await queue.run_once()
+    assert ("+2348000000000", False) in sent
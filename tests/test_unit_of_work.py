@@ -0,0 +1,140 @@
+import datetime
+import json
+
+import pytest
+from pydantic import BaseModel
+
+from sstarlette.authentication import build_abstract_user
+from sstarlette.authentication.loader import UserLoader
+from sstarlette.authentication.service_layer import BaseModelUtil, build_service_layer
+from sstarlette.base import SResult
+from sstarlette.unit_of_work import UnitOfWork, current_unit_of_work
+
+
+class Transaction:
+    def __init__(self, events):
+        self.events = events
+
+    async def start(self):
+        self.events.append("begin")
+
+    async def commit(self):
+        self.events.append("commit")
+
+    async def rollback(self):
+        self.events.append("rollback")
+
+
+class Database:
+    def __init__(self):
+        self.events = []
+        self.rows = {}
+
+    def transaction(self):
+        return Transaction(self.events)
+
+    async def fetch_one(self, query, values):
+        self.events.append("select")
+        return self.rows.get(values["email"])
+
+    async def execute(self, query, values):
+        self.events.append((query, values))
+
+
+def build_user(database):
+    class User(BaseModel):
+        email: str
+        signup_info: dict = {}
+
+        async def save(self):
+            database.events.append(f"save {self.email}")
+
+        async def save_changes(self):
+            current_unit_of_work().save_later(self)
+
+    return User
+
+
+@pytest.mark.run_loop
+async def test_saves_are_coalesced_and_skipped_when_clean():
+    database = Database()
+    User = build_user(database)
+    fredo = User(email="fredo@example.com")
+    shola = User(email="shola@example.com")
+
+    async def confirm_email():
+        unit_of_work = current_unit_of_work()
+        unit_of_work.track(fredo)
+        unit_of_work.track(shola)
+        fredo.signup_info["verified"] = True
+        await fredo.save_changes()
+        await fredo.save_changes()
+        await shola.save_changes()
+        return SResult(data={"msg": "Done"})
+
+    await UnitOfWork(database).run(confirm_email())
+    assert database.events == ["begin", "save fredo@example.com", "commit"]
+    assert current_unit_of_work() is None
+
+
+@pytest.mark.run_loop
+async def test_errors_roll_back():
+    database = Database()
+    User = build_user(database)
+
+    async def failing():
+        user = User(email="fredo@example.com")
+        await user.save_changes()
+        return SResult(errors={"msg": "Invalid user or token"})
+
+    result = await UnitOfWork(database).run(failing())
+    assert result.errors
+    assert database.events == ["begin", "rollback"]
+
+
+class Settings:
+    SECRET_KEY = "secret"
+    JWT_ISSUER = "sstarlette"
+
+
+@pytest.mark.run_loop
+async def test_commit_writes_only_changed_fields_of_loaded_users():
+    database = Database()
+    database.rows["fredo@example.com"] = {
+        "id": 3,
+        "full_name": "Fredo",
+        "email": "fredo@example.com",
+        "password": "hash",
+        "signup_info": '{"verified": false}',
+        "roles": "[]",
+        "created": datetime.datetime.now(),
+        "modified": datetime.datetime.now(),
+    }
+
+    class User(build_abstract_user(Settings)):
+        id: int = None
+
+    class Util(BaseModelUtil):
+        klass = User
+        table_name = "users"
+
+    Util.database = database
+    build_service_layer(Settings, Util, lambda: {})
+    loader = UserLoader(Util)
+
+    async def confirm_email():
+        user = await loader.load("fredo@example.com")
+        await user.verify_user()
+        # read on the unit of work's connection, not batched with others
+        assert database.events == ["begin", "select"]
+        return SResult(data={"msg": "Done"})
+
+    await UnitOfWork(database).run(confirm_email())
+    [_, _, (query, values), commit] = database.events
+    assert query == (
+        "UPDATE users SET modified = :modified, signup_info = :signup_info "
+        "WHERE id = :id"
+    )
+    assert values["id"] == 3
+    assert json.loads(values["signup_info"]) == {"verified": True}
+    assert commit == "commit"